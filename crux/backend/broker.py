@@ -0,0 +1,442 @@
+##
+# crux daemon request broker
+# @author Patrick Kage
+
+import os
+import time
+import zmq
+import collections
+from crux.backend.pool import ProcessLoadError
+from crux.common.logging import Logger
+from crux.common.messaging import Message, MessageException
+
+# requests kept in flight on each replica serving in 'router' mode (ones in 'rep' mode take one at a time)
+ROUTER_DEPTH = 4
+
+# how often (in ms) to check that the replicas are still alive
+LIVENESS_INTERVAL = 1000
+
+# requests which continue a streamed reply, and go to the replica streaming it
+STREAM_REQUESTS = ('stream_next', 'stream_cancel')
+
+# how long (in ms) a caller can leave a stream without asking for more, before it's cancelled to free up its replica
+STREAM_IDLE = 60000
+
+class Replica:
+    """A running replica of a component, and the requests the broker has on it"""
+    addr = None
+    socket = None
+    depth = 1
+
+    # (caller's envelope, request name, request id, whether the reply goes back to the caller) of
+    # requests sent and not yet answered, oldest first (the broker cancels abandoned streams itself)
+    inflight = None
+    # streamed replies still open on it
+    streams = 0
+
+    def __init__(self, addr, socket, depth):
+        """Set up the replica
+
+        :param addr: its address
+        :param socket: DEALER socket connected to it
+        :param depth: how many requests it can take at once
+        """
+        self.addr = addr
+        self.socket = socket
+        self.depth = depth
+        self.inflight = []
+
+    def load(self):
+        """Count the requests outstanding on the replica (an open stream counts as one)
+
+        :returns: number of requests
+        """
+        return len(self.inflight) + self.streams
+
+class Service:
+    """A logical component: its replicas, and the requests waiting for one"""
+    name = None
+    path = None
+    replicas = None
+
+    # (caller's envelope, frames, request name, request id) of requests waiting, oldest first
+    queue = None
+
+    # whether a replica is being acquired, and whether the pool won't give us any more
+    growing = False
+    saturated = False
+
+    def __init__(self, name, path):
+        """Set up the component
+
+        :param name: the name callers know it by
+        :param path: its path
+        """
+        self.name = name
+        self.path = path
+        self.replicas = []
+        self.queue = collections.deque()
+
+class Broker:
+    """Routes requests for logical components to the least loaded of their replicas
+
+    Callers name the component they want in a request's 'component' header: its
+    path, the name of a component installed in the daemon's install location, or the
+    name of a component the daemon has running. Each request goes to whichever of its
+    replicas has the fewest requests outstanding, as long as that replica has room
+    for another (one request for components serving in 'rep' mode, ROUTER_DEPTH in
+    'router' mode). Otherwise it waits in the component's queue, while another
+    replica is acquired from the pool, up to the component's maximum.
+
+    Requests and replies are forwarded untouched, with the caller's envelope riding
+    along, so the replica's reply finds its way back (matched up with its request by
+    the caller's envelope and the request's id). A streamed reply keeps its replica to
+    the caller until the stream is over, or the caller has left it alone for
+    STREAM_IDLE, when the broker cancels it.
+
+    The broker lives on the daemon's loop thread; acquiring replicas is handed to
+    the daemon's workers.
+    """
+    __pool = None
+    __context = None
+    __poller = None
+    __send = None
+    __offload = None
+    __install_loc = None
+    __log = None
+
+    # name -> Service, socket -> (Service, Replica), caller's envelope -> (Service, Replica) of open
+    # streams, and caller's envelope -> when its stream was last asked for more
+    __services = None
+    __sockets = None
+    __streams = None
+    __stream_seen = None
+
+    __last_check = 0
+
+    def __init__(self, pool, context, poller, send, offload, install_loc=None, logging=True):
+        """Set up the broker
+
+        :param pool: ProcessPool to acquire replicas from
+        :param context: zmq context for the replicas' sockets
+        :param poller: zmq.Poller the daemon's loop polls (the replicas' sockets are registered on it)
+        :param send: function sending a list of frames (caller's envelope first) back to a caller
+        :param offload: function(fn, args, done) running fn(*args) on a worker, then done(future) on the loop
+        :param install_loc: where components are installed, to look up names in
+        :param logging: whether to log
+        """
+        self.__log = Logger(logging=logging, name='broker')
+        self.__pool = pool
+        self.__context = context
+        self.__poller = poller
+        self.__send = send
+        self.__offload = offload
+        self.__install_loc = install_loc
+
+        self.__services = {}
+        self.__sockets = {}
+        self.__streams = {}
+        self.__stream_seen = {}
+
+    def handles(self, envelope, msg):
+        """Check if a request is for the broker
+
+        :param envelope: the caller's envelope
+        :param msg: the request
+        :returns: True if so
+        """
+        return 'component' in msg.headers or (msg.name in STREAM_REQUESTS and tuple(envelope) in self.__streams)
+
+    def submit(self, envelope, frames, msg):
+        """Route a request to a replica, or queue it until there's one to spare
+
+        :param envelope: the caller's envelope
+        :param frames: the request, as received
+        :param msg: the request, unpacked (only the header is looked at)
+        """
+        request_id = msg.headers.get('id')
+
+        # the rest of a stream comes from the replica streaming it
+        if msg.name in STREAM_REQUESTS:
+            if tuple(envelope) not in self.__streams:
+                self.__fail(envelope, request_id, 'no stream open')
+                return
+            service, replica = self.__streams[tuple(envelope)]
+            self.__stream_seen[tuple(envelope)] = time.monotonic()
+            self.__forward(replica, envelope, frames, msg.name, request_id)
+            return
+
+        name = msg.headers['component']
+        if name not in self.__services:
+            path = self.__resolve(name)
+            if path is None:
+                self.__fail(envelope, request_id, 'unknown component "{}"'.format(name))
+                return
+            self.__services[name] = Service(name, path)
+
+        service = self.__services[name]
+        service.queue.append((envelope, frames, msg.name, request_id))
+        self.__dispatch(service)
+
+    def poll(self, events):
+        """Forward the replies which have arrived from replicas back to their callers
+
+        :param events: dict of socket to event, from the daemon's poller
+        """
+        for socket in [socket for socket in events if socket in self.__sockets]:
+            service, replica = self.__sockets[socket]
+            while socket in self.__sockets and socket.poll(0, zmq.POLLIN):
+                self.__returned(service, replica, socket.recv_multipart())
+            self.__dispatch(service)
+
+    def check(self):
+        """Drop replicas which have exited, failing the requests they had, and cancel abandoned streams
+
+        Only looks every LIVENESS_INTERVAL, however often it's called.
+        """
+        now = time.monotonic()
+        if len(self.__sockets) == 0 or now - self.__last_check < LIVENESS_INTERVAL / 1000:
+            return
+        self.__last_check = now
+
+        for key in [key for key, seen in self.__stream_seen.items() if now - seen > STREAM_IDLE / 1000]:
+            self.__expire(key)
+
+        alive = set(self.__pool.get_all_addrs())
+        for service in self.__services.values():
+            for replica in [replica for replica in service.replicas if replica.addr not in alive]:
+                self.__log.warn('replica {} of "{}" exited'.format(replica.addr, service.name))
+                self.__drop(service, replica, 'replica exited')
+            self.__dispatch(service)
+
+    def status(self):
+        """Describe the logical components and how loaded their replicas are
+
+        :returns: dict of name to {'path': path, 'queued': requests waiting, 'replicas': dict of address to requests outstanding}
+        """
+        return {
+            service.name: {
+                'path': service.path,
+                'queued': len(service.queue),
+                'replicas': {replica.addr: replica.load() for replica in service.replicas}
+            }
+            for service in self.__services.values()
+        }
+
+    def close(self):
+        """Fail every request still waiting or outstanding, and hand the replicas back to the pool"""
+        for service in self.__services.values():
+            for replica in list(service.replicas):
+                self.__drop(service, replica, 'daemon shutting down')
+                self.__pool.release(replica.addr)
+            while len(service.queue) > 0:
+                envelope, _, _, request_id = service.queue.popleft()
+                self.__fail(envelope, request_id, 'daemon shutting down')
+        self.__services = {}
+
+    def __resolve(self, name):
+        """Find the path of a component by name
+
+        :param name: a path, an installed component's name or a running component's name
+        :returns: the path, or None if there's no such component
+        """
+        if os.path.exists(os.path.join(name, 'crux.json')):
+            return name
+
+        if self.__install_loc is not None and os.path.exists(os.path.join(self.__install_loc, name, 'crux.json')):
+            return os.path.join(self.__install_loc, name)
+
+        status = self.__pool.get_all_status()
+        for addr, cruxfile in self.__pool.get_all_cruxfiles().items():
+            if cruxfile.get('name') == name and addr in status:
+                return status[addr]['path']
+
+        return None
+
+    def __dispatch(self, service):
+        """Send a component's waiting requests to its replicas, while they have room
+
+        :param service: the component
+        """
+        while len(service.queue) > 0:
+            spare = [replica for replica in service.replicas if replica.load() < replica.depth]
+            if len(spare) == 0:
+                self.__grow(service)
+                return
+
+            replica = min(spare, key=lambda replica: replica.load())
+            envelope, frames, name, request_id = service.queue.popleft()
+            self.__forward(replica, envelope, frames, name, request_id)
+
+    def __forward(self, replica, envelope, frames, name, request_id):
+        """Send a request on to a replica
+
+        :param replica: the replica
+        :param envelope: the caller's envelope
+        :param frames: the request, as received
+        :param name: the request's name
+        :param request_id: the request's id, if any
+        """
+        replica.socket.send_multipart(envelope + frames)
+        replica.inflight.append((tuple(envelope), name, request_id, True))
+
+    def __returned(self, service, replica, frames):
+        """Pass a reply from a replica back to its caller
+
+        :param service: the component
+        :param replica: the replica it came from
+        :param frames: the reply, caller's envelope first
+        """
+        # everything up to the empty delimiter is the caller's envelope
+        split = next((i + 1 for i, frame in enumerate(frames) if len(frame) == 0), 0)
+        key = tuple(frames[:split])
+
+        try:
+            reply = Message(data=frames[split:])
+        except (MessageException, ValueError, TypeError, KeyError, IndexError):
+            reply = None
+        reply_id = reply.headers.get('id') if reply is not None else None
+
+        # the caller's request with the reply's id (or its oldest, from replicas which don't echo ids)
+        requests = [request for request in replica.inflight if request[0] == key]
+        request = next((request for request in requests if request[2] == reply_id), None)
+        if request is None and reply_id is None and len(requests) > 0:
+            request = requests[0]
+        if request is None:
+            # the request was failed already (e.g. its replica was thought gone)
+            return
+        replica.inflight.remove(request)
+
+        try:
+            if reply is None:
+                self.__close_stream(key)
+            elif reply.name == 'stream' and request[1] not in STREAM_REQUESTS:
+                # the replica is the caller's until the stream is over
+                self.__streams[key] = (service, replica)
+                self.__stream_seen[key] = time.monotonic()
+                replica.streams += 1
+            elif request[1] == 'stream_next' and (not reply.success or reply.payload['done']):
+                self.__close_stream(key)
+            elif request[1] == 'stream_cancel':
+                self.__close_stream(key)
+        except (MessageException, TypeError, KeyError):
+            self.__close_stream(key)
+
+        if request[3]:
+            self.__send(frames)
+
+    def __close_stream(self, key):
+        """Forget a stream, freeing up its replica
+
+        :param key: the caller's envelope
+        """
+        self.__stream_seen.pop(key, None)
+        if key in self.__streams:
+            _, replica = self.__streams.pop(key)
+            replica.streams -= 1
+
+    def __expire(self, key):
+        """Cancel a stream its caller has stopped asking for more of
+
+        The replica's answer to the cancel isn't passed on, and the replica isn't given
+        anything else until it's answered. Streams with a request of the caller's still
+        outstanding aren't idle, however long the replica's taking over it.
+
+        :param key: the caller's envelope
+        """
+        service, replica = self.__streams[key]
+        if any(request[0] == key for request in replica.inflight):
+            return
+
+        self.__log.warn('cancelling stream of "{}" left idle for {}ms'.format(service.name, STREAM_IDLE))
+        self.__close_stream(key)
+        replica.socket.send_multipart(list(key) + Message(name='stream_cancel').pack())
+        replica.inflight.append((key, 'stream_cancel', None, False))
+
+    def __grow(self, service):
+        """Acquire another replica for a component, unless the pool has no more to give
+
+        :param service: the component
+        """
+        if service.growing or service.saturated:
+            return
+
+        service.growing = True
+        self.__offload(self.__acquire, (service.path,), lambda future, service=service: self.__grown(service, future))
+
+    def __acquire(self, path):
+        """Acquire a replica from the pool (on a worker)
+
+        :param path: the component's path
+        :raises ProcessLoadError: if it couldn't be started
+        :returns: (address, cruxfile)
+        """
+        addr = self.__pool.acquire(path)
+        return addr, self.__pool.get_all_cruxfiles([addr]).get(addr, {})
+
+    def __grown(self, service, future):
+        """Start using a newly acquired replica (on the loop)
+
+        :param service: the component
+        :param future: the finished __acquire()
+        """
+        service.growing = False
+        try:
+            addr, cruxfile = future.result()
+        except Exception as e:
+            reason = e.msg if isinstance(e, ProcessLoadError) else 'unable to start replica: {}'.format(e)
+            self.__log.error('unable to start "{}": {}'.format(service.name, reason))
+            while len(service.queue) > 0:
+                envelope, _, _, request_id = service.queue.popleft()
+                self.__fail(envelope, request_id, reason)
+            return
+
+        if addr in [replica.addr for replica in service.replicas]:
+            # the pool is handing out replicas we already have, so that's all of them
+            self.__pool.release(addr)
+            service.saturated = True
+            return
+
+        socket = self.__context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(addr)
+        self.__poller.register(socket, zmq.POLLIN)
+
+        replica = Replica(addr, socket, ROUTER_DEPTH if cruxfile.get('protocol') == 'router' else 1)
+        service.replicas.append(replica)
+        self.__sockets[socket] = (service, replica)
+        self.__log('brokering "{}" over {} replica(s)'.format(service.name, len(service.replicas)))
+
+        self.__dispatch(service)
+
+    def __drop(self, service, replica, reason):
+        """Stop using a replica, failing the requests it had
+
+        :param service: the component
+        :param replica: the replica
+        :param reason: what to tell the callers
+        """
+        for envelope, _, request_id, forward in replica.inflight:
+            if forward:
+                self.__fail(list(envelope), request_id, reason)
+        for key in [key for key in self.__streams if self.__streams[key][1] is replica]:
+            del self.__streams[key]
+            self.__stream_seen.pop(key, None)
+
+        self.__poller.unregister(replica.socket)
+        replica.socket.close()
+        del self.__sockets[replica.socket]
+        service.replicas.remove(replica)
+        service.saturated = False
+
+    def __fail(self, envelope, request_id, reason):
+        """Answer a request with a failure
+
+        :param envelope: the caller's envelope
+        :param request_id: the request's id, if any
+        :param reason: failure message
+        """
+        reply = Message(name='failure', payload=reason, success=False)
+        if request_id is not None:
+            reply.headers['id'] = request_id
+        self.__send(list(envelope) + reply.pack())
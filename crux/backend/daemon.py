@@ -2,13 +2,31 @@
 # crux main daemon
 # @author Patrick Kage
 
+import os
 import zmq
-from crux.backend.pool import ProcessPool, ProcessLoadError
+import queue
+import concurrent.futures
+from crux.backend.pool import ProcessPool, ProcessLoadError, MIN_REPLICAS, MAX_REPLICAS, READY_TIMEOUT
+from crux.backend.broker import Broker, LIVENESS_INTERVAL
 from crux.common.logging import Logger
-from crux.common.messaging import Message
+from crux.common.messaging import Message, MessageException
 from crux.pipeline.component import Component
 
+# threads to run slow API calls (launches) on
+DAEMON_WORKERS = 8
+
 class Daemon:
+    """The crux daemon, managing a pool of local components for its API's callers
+
+    API calls are taken off a ROUTER socket by a single loop. Quick calls are
+    answered straight away, and slow ones (see __offloaded) are handed to a pool
+    of workers and answered whenever they finish, so one caller's launch doesn't
+    hold up everyone else. Replies can therefore go out in a different order than
+    the calls came in; they're tagged with the call's request id, if it had one.
+
+    Requests naming a component in a 'component' header are brokered to its
+    replicas instead (see crux.backend.broker).
+    """
     # zmq stuff
     __context = None
     __apisock = None
@@ -26,7 +44,20 @@ class Daemon:
     # process pool
     __processes = None
 
-    def __init__(self, logging=True, debug=False, bind_addr='tcp://*:30020', pub_addr='tcp://*:30021', context=None, install_loc=None):
+    # workers for slow calls, and the calls which are slow
+    __workers = None
+    __offloaded = ('process_start', 'process_acquire')
+
+    # the loop's poller, and what workers have finished (run on the loop once it's woken)
+    __poller = None
+    __finished = None
+    __wake = None
+    __in_flight = 0
+
+    # brokers requests to component replicas
+    __broker = None
+
+    def __init__(self, logging=True, debug=False, bind_addr='tcp://*:30020', pub_addr='tcp://*:30021', context=None, install_loc=None, use_shm=False, spill_threshold=None, spill_dir=None, min_replicas=MIN_REPLICAS, max_replicas=MAX_REPLICAS, launcher='exec', ready_timeout=READY_TIMEOUT, workers=DAEMON_WORKERS):
         # logging!
         self.__log = Logger(logging=logging, name='daemon')
 
@@ -44,7 +75,7 @@ class Daemon:
         self.__pubsock_addr = pub_addr
 
         # create the API socket
-        self.__apisock = self.__context.socket(zmq.REP)
+        self.__apisock = self.__context.socket(zmq.ROUTER)
         self.__apisock.bind(self.__apisock_addr)
 
         # create the publishing socket
@@ -52,31 +83,172 @@ class Daemon:
         self.__pubsock.bind(self.__pubsock_addr)
 
         # initialize the process pool
-        self.__pool = ProcessPool()
+        self.__pool = ProcessPool(
+            use_shm=use_shm,
+            spill_threshold=spill_threshold,
+            spill_dir=spill_dir,
+            min_replicas=min_replicas,
+            max_replicas=max_replicas,
+            launcher=launcher,
+            ready_timeout=ready_timeout
+        )
+
+        self.__workers = concurrent.futures.ThreadPoolExecutor(workers)
+        self.__finished = queue.Queue()
+        self.__poller = zmq.Poller()
+        self.__poller.register(self.__apisock, zmq.POLLIN)
+
+        self.__broker = Broker(
+            self.__pool,
+            self.__context,
+            self.__poller,
+            self.__apisock.send_multipart,
+            self.__offload,
+            install_loc=install_loc,
+            logging=logging
+        )
 
         self.__log('initialized daemon')
 
     def listen(self):
         self.__log.info('daemon listening on {}'.format(self.__apisock_addr))
 
-        # loop until we stop
-        while not self.__should_stop:
-            message = Message(data=self.__apisock.recv())
-            try:
-                reply = self.__route(message)
-            except Exception as e:
-                reply = Message(name='failure', payload='internal error', success=False)
-                if self.__debug:
-                    self.__log.error(e)
-            self.__apisock.send(reply.pack())
+        # workers finish on their own threads, so they queue up what to do next and poke
+        # the loop through a pipe, the sockets are only ever touched from here
+        wake_r, self.__wake = os.pipe()
+        self.__poller.register(wake_r, zmq.POLLIN)
+
+        # loop until we stop, and the calls in flight are answered
+        try:
+            while not self.__should_stop or self.__in_flight > 0:
+                events = dict(self.__poller.poll(LIVENESS_INTERVAL))
+
+                if wake_r in events:
+                    os.read(wake_r, 4096)
+                    while not self.__finished.empty():
+                        self.__in_flight -= 1
+                        try:
+                            self.__finished.get()()
+                        except Exception as e:
+                            # a finished call going wrong mustn't take the loop down with it
+                            self.__log.error('failed finishing offloaded call: {}'.format(e))
+
+                self.__broker.poll(events)
+                self.__broker.check()
+
+                while self.__apisock.poll(0, zmq.POLLIN):
+                    envelope, frames, message = self.__recv()
+                    if message is None:
+                        reply = Message(name='malformed', success=False)
+                    elif self.__should_stop:
+                        reply = Message(name='failure', payload='daemon shutting down', success=False)
+                    elif self.__broker.handles(envelope, message):
+                        self.__broker.submit(envelope, frames, message)
+                        continue
+                    elif message.name in self.__offloaded:
+                        self.__offload(
+                            self.__handle,
+                            (message,),
+                            lambda future, envelope=envelope, message=message: self.__answer(envelope, message, future)
+                        )
+                        continue
+                    else:
+                        reply = self.__handle(message)
+                    self.__apisock.send_multipart(envelope + reply.pack())
+        finally:
+            self.__broker.close()
+            self.__poller.unregister(wake_r)
+            os.close(wake_r)
+            os.close(self.__wake)
+            self.__workers.shutdown(wait=False)
+
         self.__log.warn('stopping daemon!')
         self.__pool.terminate_all()
 
+    def __offload(self, fn, args, done):
+        """Run something on a worker, then finish up on the loop
+
+        :param fn: function to run on the worker
+        :param args: its arguments
+        :param done: function taking the finished future, called from the loop
+        """
+        def on_done(future):
+            self.__finished.put(lambda: done(future))
+            os.write(self.__wake, b'\0')
+
+        self.__in_flight += 1
+        self.__workers.submit(fn, *args).add_done_callback(on_done)
+
+    def __answer(self, envelope, msg, future):
+        """Send back the reply to an offloaded API call (on the loop)
+
+        :param envelope: the caller's envelope
+        :param msg: the call
+        :param future: the finished __handle()
+        """
+        try:
+            frames = future.result().pack()
+        except Exception as e:
+            self.__log.error('failed answering {}: {}'.format(msg.name, e))
+            reply = Message(name='failure', payload='internal error', success=False)
+            if 'id' in msg.headers:
+                reply.headers['id'] = msg.headers['id']
+            frames = reply.pack()
+        self.__apisock.send_multipart(envelope + frames)
+
+    def __recv(self):
+        """Receive an API call
+
+        :returns: (envelope to route the reply with, the call's frames, Message or None if it's malformed)
+        """
+        frames = self.__apisock.recv_multipart()
+
+        # everything up to the empty delimiter is the route back (REQ callers always send one)
+        split = next((i + 1 for i, frame in enumerate(frames) if len(frame) == 0), 1)
+        envelope, frames = frames[:split], frames[split:]
+
+        try:
+            return envelope, frames, Message(data=frames)
+        except (MessageException, ValueError, TypeError, KeyError, IndexError):
+            return envelope, frames, None
+
+    def __handle(self, msg):
+        """Answer an API call
+
+        Runs on the loop or on a worker, and never raises.
+
+        :param msg: the call
+        :returns: reply Message
+        """
+        try:
+            reply = self.__route(msg)
+        except Exception as e:
+            reply = Message(name='failure', payload='internal error', success=False)
+            if self.__debug:
+                self.__log.error(e)
+
+        # so callers with several calls out can tell which one this answers
+        if 'id' in msg.headers:
+            reply.headers['id'] = msg.headers['id']
+        return reply
+
     def __route(self, msg):
         if msg.name == 'process_start':
             return self.__process_start(msg)
+        elif msg.name == 'process_acquire':
+            return self.__process_acquire(msg)
+        elif msg.name == 'process_release':
+            return self.__process_release(msg)
         elif msg.name == 'process_list':
             return self.__process_list(msg)
+        elif msg.name == 'process_status':
+            return self.__process_status(msg)
+        elif msg.name == 'process_cruxfiles':
+            return self.__process_cruxfiles(msg)
+        elif msg.name == 'daemon_info':
+            return self.__daemon_info(msg)
+        elif msg.name == 'broker_status':
+            return self.__broker_status(msg)
         elif msg.name == 'process_killall':
             return self.__process_killall(msg)
         elif msg.name == 'daemon_shutdown':
@@ -91,14 +263,45 @@ class Daemon:
         path = msg.payload
 
         try:
+            # a process of the caller's own, nobody else is handed it
             addr = self.__pool.launch(path)
             return Message(name='return', payload=addr)
         except ProcessLoadError as ple:
             return Message(name='failure', success=False, payload=ple.msg)
 
+    def __process_acquire(self, msg):
+        if msg.payload is None:
+            return Message(name='malformed', success=False)
+
+        try:
+            # a warm replica if there's one to spare, to be released afterwards
+            addr = self.__pool.acquire(msg.payload)
+            return Message(name='return', payload=addr)
+        except ProcessLoadError as ple:
+            return Message(name='failure', success=False, payload=ple.msg)
+
+    def __process_release(self, msg):
+        if msg.payload is None:
+            return Message(name='malformed', success=False)
+
+        self.__pool.release(msg.payload, broken=msg.headers.get('broken', False))
+        return Message(name='return')
+
     def __process_list(self, msg):
         return Message(name='return', payload=self.__pool.get_all_addrs())
 
+    def __process_status(self, msg):
+        return Message(name='return', payload=self.__pool.get_all_status())
+
+    def __process_cruxfiles(self, msg):
+        return Message(name='return', payload=self.__pool.get_all_cruxfiles(msg.payload))
+
+    def __daemon_info(self, msg):
+        return Message(name='return', payload={'spill_dir': self.__pool.spill_dir})
+
+    def __broker_status(self, msg):
+        return Message(name='return', payload=self.__broker.status())
+
     def __process_killall(self, msg):
         self.__log.info('killing all managed processes...')
         self.__pool.terminate_all()
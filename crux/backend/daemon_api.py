@@ -3,11 +3,21 @@
 # @author Patrick Kage
 
 import zmq
-from crux.common.socket import ManagedSocket
+import zmq.asyncio
+from crux.common.socket import ManagedSocket, AsyncManagedSocket
 from crux.common.logging import Logger
 from crux.common.messaging import Message
 
 class DaemonAPI:
+    """Calls to a crux daemon
+
+    Every call builds its request here and goes through the one round trip in
+    __call(), so AsyncDaemonAPI only has to swap the socket out.
+    """
+    # the socket (and the context to make one with, if none is given) the calls go over
+    SOCKET = ManagedSocket
+    CONTEXT = zmq.Context
+
     # zmq stuff
     __socket = None
     __context = None
@@ -21,22 +31,23 @@ class DaemonAPI:
         """Initialize the daemon api pointing at a remote API
 
         :param daemon_addr: the daemon to connect to
-        :param context: zmq context to use
+        :param context: zmq context to use (a zmq.asyncio.Context for AsyncDaemonAPI)
+        :param timeout: timeout in ms for each call
         """
         # init logger
         self.__log = Logger(logging=True, name='api_daemon')
 
         # set up context
         if context is None:
-            self.__log.warn('initializing a zmq context to connect to {}, this may mean something is wrong!'.format(context))
-            self.__context = zmq.Context()
+            self.__log.warn('initializing a zmq context to connect to {}, this may mean something is wrong!'.format(daemon_addr))
+            self.__context = self.CONTEXT()
         else:
             self.__context = context
 
         # create socket and connect
         self.__timeout = timeout
         self.__daemon_addr = daemon_addr
-        self.__socket = ManagedSocket(self.__context, zmq.REQ)
+        self.__socket = self.SOCKET(self.__context, zmq.REQ)
         self.__socket.connect(self.__daemon_addr)
 
     def get_addr(self):
@@ -62,6 +73,7 @@ class DaemonAPI:
         """Perform remote call
 
         :param msg: message to send
+        :returns: the reply (an awaitable of it, over an AsyncManagedSocket)
         """
         return self.__socket.call(msg, timeout=self.__timeout)
 
@@ -71,6 +83,19 @@ class DaemonAPI:
             payload=path
         ))
 
+    def process_acquire(self, path):
+        return self.__call(Message(
+            name='process_acquire',
+            payload=path
+        ))
+
+    def process_release(self, addr, broken=False):
+        return self.__call(Message(
+            name='process_release',
+            payload=addr,
+            headers={'broken': True} if broken else None
+        ))
+
     def process_killall(self):
         return self.__call(Message(
             name='process_killall'
@@ -81,7 +106,34 @@ class DaemonAPI:
             name='process_list'
         ))
 
+    def process_status(self):
+        return self.__call(Message(
+            name='process_status'
+        ))
+
+    def process_cruxfiles(self, addrs=None):
+        return self.__call(Message(
+            name='process_cruxfiles',
+            payload=addrs
+        ))
+
+    def broker_status(self):
+        return self.__call(Message(
+            name='broker_status'
+        ))
+
+    def daemon_info(self):
+        return self.__call(Message(
+            name='daemon_info'
+        ))
+
     def shutdown(self):
         return self.__call(Message(
             name='daemon_shutdown'
         ))
+
+
+class AsyncDaemonAPI(DaemonAPI):
+    """asyncio flavour of DaemonAPI, every call returns an awaitable of the reply"""
+    SOCKET = AsyncManagedSocket
+    CONTEXT = zmq.asyncio.Context
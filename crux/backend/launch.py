@@ -4,6 +4,8 @@
 
 import click
 from . import daemon
+from .daemon import DAEMON_WORKERS
+from .pool import MIN_REPLICAS, MAX_REPLICAS, READY_TIMEOUT
 
 # entry point for console script
 @click.command()
@@ -12,7 +14,15 @@ from . import daemon
 @click.option('--bind-addr', metavar='URI', default='tcp://*:30020', help='Bind URI for the daemon')
 @click.option('--pub-addr', metavar='URI', default='tcp://*:30021', help='Pub URI for the daemon vent')
 @click.option('--install-location', metavar='PATH', default='/opt/crux', help='Installation location for crux components')
-def main(debug, logging, bind_addr, pub_addr, install_location):
+@click.option('--shared-memory', default=False, help='Hand large payloads between local components over shared memory', is_flag=True)
+@click.option('--spill-threshold', metavar='BYTES', type=int, default=None, help='Spill payload fields of at least this size to disk')
+@click.option('--spill-dir', metavar='PATH', default=None, help='Scratch directory for spilled payload fields')
+@click.option('--min-replicas', metavar='N', type=int, default=MIN_REPLICAS, help='Warm replicas to keep of each component started')
+@click.option('--max-replicas', metavar='N', type=int, default=MAX_REPLICAS, help='Most replicas to start of each component')
+@click.option('--fork-server', default=False, help='Fork python components off a preloaded process instead of starting them from scratch', is_flag=True)
+@click.option('--ready-timeout', metavar='MS', type=int, default=READY_TIMEOUT, help='How long a started component may take to be ready to serve')
+@click.option('--workers', metavar='N', type=int, default=DAEMON_WORKERS, help='Threads to run slow API calls (launches) on')
+def main(debug, logging, bind_addr, pub_addr, install_location, shared_memory, spill_threshold, spill_dir, min_replicas, max_replicas, fork_server, ready_timeout, workers):
     """Launcher for the crux daemon"""
 
     # initialize the daemon
@@ -21,7 +31,15 @@ def main(debug, logging, bind_addr, pub_addr, install_location):
         debug=debug,
         bind_addr=bind_addr,
         pub_addr=pub_addr,
-        install_loc=install_location
+        install_loc=install_location,
+        use_shm=shared_memory,
+        spill_threshold=spill_threshold,
+        spill_dir=spill_dir,
+        min_replicas=min_replicas,
+        max_replicas=max_replicas,
+        launcher='fork' if fork_server else 'exec',
+        ready_timeout=ready_timeout,
+        workers=workers
     )
 
     # guarded here to make sure we flush the pool
@@ -3,12 +3,16 @@
 # @author Patrick Kage
 
 import zmq
+import collections
+from crux.common import packing
+from crux.common import transport
 from crux.common.logging import Logger
 from crux.common.exception import CruxException
-from crux.common.messaging import Message
+from crux.common.messaging import Message, merge_timing, format_timing
 from crux.common.validation import version_check
 from crux.pipeline.pipeline import Pipeline
-from crux.pipeline.component import Component
+from crux.pipeline.component import Component, StreamError
+from crux.pipeline.registry import shared_registry
 from crux.backend.daemon_api import DaemonAPI
 
 class PipelineAgentInitError(CruxException):
@@ -34,11 +38,13 @@ class PipelineAgent:
     __socket = None
     __context = None
 
-    # daemon api
+    # daemon api, and whether we've asked it where its components spill to
     __dapi = None
+    __spill_known = False
 
     # components used
     __cpool = None
+    __registry = None
 
     # logger
     __log = None
@@ -70,16 +76,77 @@ class PipelineAgent:
             self.__pool = pool
 
         self.__cpool = {}
+        self.__registry = shared_registry(context=self.__context)
 
-    def __process_start(self, path):
+    def __trust_spill_dir(self):
+        """Accept (and clean up) scratch files in the directory the daemon's components spill to"""
+        if self.__dapi is None or self.__spill_known:
+            return
+        self.__spill_known = True
+
+        reply = self.__dapi.daemon_info()
+        # older daemons don't say, which leaves the default spill directory
+        if reply.success and reply.payload.get('spill_dir') is not None:
+            transport.trust_spill_dir(reply.payload['spill_dir'])
+
+    def __process_acquire(self, path):
         """Start a path using the preferred mechanism
 
+        A warm replica of the component is handed out if one is idle.
+
         :param path: path to start
+        :raises PipelineAgentInitError: if the daemon can't start the component
+        :returns: address of the process
+        """
+        if self.__dapi is not None:
+            reply = self.__dapi.process_acquire(path)
+            if reply.name == 'nyi':
+                # older daemons don't keep replicas, just start one
+                reply = self.__dapi.process_start(path)
+            if not reply.success:
+                raise PipelineAgentInitError(reply.payload)
+            return reply.payload
+        else:
+            return self.__pool.acquire(path)
+
+    def __process_release(self, addr, broken=False):
+        """Hand a started process back, for the next run to reuse
+
+        :param addr: address of the process
+        :param broken: if the run broke, so the process may be in a bad state (it's stopped rather than reused)
+        """
+        if broken:
+            self.__registry.invalidate(addr)
+
+        if self.__dapi is not None:
+            # older daemons don't keep replicas, and just say so
+            self.__dapi.process_release(addr, broken=broken)
+        else:
+            self.__pool.release(addr, broken=broken)
+
+    def __process_status(self):
+        """Get the status of the launched processes
+
+        :returns: dict of address to {'pid': ..., ...}, or None if the launcher won't say
+        """
+        if self.__dapi is not None:
+            reply = self.__dapi.process_status()
+            return reply.payload if reply.success else None
+        else:
+            return self.__pool.get_all_status()
+
+    def __process_cruxfiles(self, addrs):
+        """Get the resolved cruxfiles of launched processes, without asking the processes
+
+        :param addrs: addresses of the processes
+        :returns: dict of address to cruxfile, missing any the launcher doesn't know
         """
         if self.__dapi is not None:
-            return self.__dapi.process_start(path).payload
+            reply = self.__dapi.process_cruxfiles(addrs)
+            # older daemons don't keep cruxfiles around
+            return reply.payload if reply.success else {}
         else:
-            return self.__pool.launch(path)
+            return self.__pool.get_all_cruxfiles(addrs)
 
     def __remap_input(self, inp, remap):
         newinp = {}
@@ -103,49 +170,285 @@ class PipelineAgent:
         :param pipeline: a dictionary object representing a pipeline
         """
 
-        # first set up all required components
-        for depname in pipeline['components']:
-            dep = pipeline['components'][depname]
+        self.__trust_spill_dir()
 
-            # launch the process, and bind a component handle to it
-            addr = self.__process_start(dep['src'])
-            self.__cpool[depname] = Component(addr, context=self.__context)
+        # first launch all required components (or borrow running ones)
+        addrs = {}
+        broken = False
+        try:
+            for depname in pipeline['components']:
+                addrs[depname] = self.__process_acquire(pipeline['components'][depname]['src'])
 
-            # check that the dependency satisfies the version requirements
-            if not version_check(self.__cpool[depname].cruxfile['version'], dep['version']):
-                raise UnmetDependencyError('dependency {}@{} does not match requirement {}'.format(
-                    depname,
-                    self.__cpool[depname].cruxfile['version'],
-                    dep['version']
-                ))
+            # cached handles to processes which have since died or been replaced are no good
+            status = self.__process_status()
+            if status is not None:
+                self.__registry.sync(status)
 
-        # kick off the pipeline
-        inp = {}
-        count = 0
-        for step in pipeline['pipeline']:
-            # perform a request to the specified component
-            result = self.__cpool[step['component']].request(Message(
-                name='execute',
-                payload={
-                    'parameters': step['parameters'],
-                    'inputs': inp
-                }
-            ))
-
-            # handle results
+            # the launcher already resolved their cruxfiles, so the handles don't need to ask
+            cruxfiles = self.__process_cruxfiles(list(addrs.values()))
+
+            for depname in pipeline['components']:
+                dep = pipeline['components'][depname]
+
+                # bind a component handle to the process
+                addr = addrs[depname]
+                self.__cpool[depname] = self.__registry.get(addr, cruxfile=cruxfiles.get(addr))
+
+                # check that the dependency satisfies the version requirements
+                if not version_check(self.__cpool[depname].cruxfile['version'], dep['version']):
+                    raise UnmetDependencyError('dependency {}@{} does not match requirement {}'.format(
+                        depname,
+                        self.__cpool[depname].cruxfile['version'],
+                        dep['version']
+                    ))
+
+            # out-of-band buffers (e.g. shared memory) the current intermediate points at,
+            # and the last step's output while it's still being streamed
+            live = set()
+            streams = []
+
+            # kick off the pipeline
+            try:
+                # a run which breaks (a step failing, a request timing out...) may leave
+                # components partway through requests, so they aren't reused
+                broken = True
+                yield from self.__run_steps(pipeline, live, streams)
+                broken = False
+            except GeneratorExit:
+                # the caller stopped between steps, with nothing outstanding unless it
+                # walked away from a stream
+                broken = len(streams) > 0
+                raise
+            finally:
+                for stream in streams:
+                    stream.close()
+                # the run is over (or broke), nothing will reference these again
+                self.__release(live)
+        finally:
+            # leave the components running for the next run
+            for addr in addrs.values():
+                self.__process_release(addr, broken=broken)
+
+    def __run_chain(self, chain, inp, live, outcome=None):
+        """Run a step, and the steps streaming from it
+
+        Pieces are dropped as soon as the next step has taken them, so the steps
+        before the last have no payload. The last step's pieces are joined into one
+        output, unless `outcome` is given: then its result is a 'stream' whose
+        payload is a generator over the pieces, run as it's pulled.
+
+        :param chain: the step, followed by the steps taking its output piece by piece
+        :param inp: inputs to the first step
+        :param live: set of out-of-band buffers to release if the run breaks, added to as they appear
+        :param outcome: dict to note in once the stream is through ('done') or has broken ('error'), to stream the last step's output
+        :raises BrokenPipelineError: if a step after the first fails
+        :returns: list of results, one per step (just the first step's, if it failed)
+        """
+        # pieces are passed on one at a time, and the next is always being made meanwhile
+        head = self.__cpool[chain[0]['component']].request(Message(
+            name='execute',
+            payload={
+                'parameters': chain[0]['parameters'],
+                'inputs': inp
+            }
+        ), credit=1 if len(chain) > 1 else None)
+
+        if not head.success:
+            return [head]
+
+        streamed = head.name == 'stream'
+        if not streamed and len(chain) == 1:
+            return [head]
+
+        # every stage notes the buffers its pieces point at and where the time went
+        exports = [head.headers.setdefault('exports', [])]
+        timings = [head.headers.get('timing', {})]
+        pieces = head.payload if streamed else (piece for piece in [head.payload])
+        for previous, step in zip(chain, chain[1:]):
+            exports.append([])
+            timings.append({})
+            pieces = self.__feed(step, previous, pieces, exports[-1], timings[-1])
+        pieces = self.__drive(chain[0], pieces, exports, live, outcome if outcome is not None else {})
+
+        results = [
+            Message(name='return', payload=None, success=True, headers={'exports': handles, 'timing': timing})
+            for handles, timing in zip(exports, timings)
+        ]
+        if outcome is not None:
+            results[-1].name = 'stream'
+            results[-1].payload = pieces
+        else:
+            # the next step takes the output whole
+            results[-1].payload = packing.join_chunks(pieces)
+        return results
+
+    def __drive(self, first, pieces, exports, live, outcome):
+        """Pull the pieces out of the last step of a chain
+
+        :param first: the first step of the chain
+        :param pieces: iterator of the last step's output for each piece
+        :param exports: lists of out-of-band buffers each step's results point at, added to live once the chain is over
+        :param live: set of out-of-band buffers to release if the run breaks
+        :param outcome: dict to note in once the pieces are through ('done') or have broken ('error')
+        :raises BrokenPipelineError: if a step fails
+        :returns: generator of the pieces
+        """
+        try:
+            for piece in pieces:
+                yield piece
+            outcome['done'] = True
+        except StreamError as se:
+            self.__log.error('{}: {}'.format(first['component'], se.msg))
+            outcome['error'] = se.msg
+            raise BrokenPipelineError(se.msg)
+        except BrokenPipelineError as bpe:
+            outcome['error'] = bpe.msg
+            raise
+        finally:
+            pieces.close()
+            for handles in exports:
+                live.update(handles)
+
+    def __feed(self, step, previous, pieces, exports, timing):
+        """Run a step on each piece of the previous step's output as it arrives
+
+        Each piece is left running while the next is pulled from upstream, so this step
+        works alongside the ones before it. Components which can take several requests
+        at once get a few pieces ahead.
+
+        :param step: the step to run
+        :param previous: the step the pieces come from
+        :param pieces: iterator of pieces of the previous step's output
+        :param exports: list to add out-of-band buffers the results point at to
+        :param timing: dict to add up the timing of the step's requests in
+        :raises BrokenPipelineError: if the step fails on a piece
+        :returns: generator of the step's output for each piece
+        """
+        component = self.__cpool[step['component']]
+        window = component.STREAM_CREDIT if component.pipelined else 1
+        tickets = collections.deque()
+
+        def settle(result):
+            # a piece's result may itself be streamed
+            if result.success and result.name == 'stream':
+                try:
+                    result.payload = packing.join_chunks(result.payload)
+                except StreamError as se:
+                    result.success = False
+                    result.payload = se.msg
+
+            exports.extend(result.headers.get('exports', []))
+            merge_timing(timing, result.headers.get('timing'))
             if not result.success:
-                # log & fail
-                self.__log.error('{}: {}'.format(
-                    step['component'],
-                    result.payload
-                ))
+                self.__log.error('{}: {}'.format(step['component'], result.payload))
                 raise BrokenPipelineError(result.payload)
-            else:
-                # generators are magic
-                yield (count, step, result)
-                if 'remap' in step:
-                    inp = self.__remap_input(result.payload, step['remap'])
+            return result.payload
+
+        try:
+            # the pieces in flight are worked on while the next one is pulled from upstream
+            for piece in pieces:
+                if len(tickets) >= window:
+                    yield settle(component.collect(tickets.popleft()))
+
+                if 'remap' in previous:
+                    piece = self.__remap_input(piece, previous['remap'])
+
+                tickets.append(component.submit(Message(
+                    name='execute',
+                    payload={
+                        'parameters': step['parameters'],
+                        'inputs': piece
+                    }
+                )))
+
+            while len(tickets) > 0:
+                yield settle(component.collect(tickets.popleft()))
+        finally:
+            pieces.close()
+
+    def __release(self, handles):
+        """Release out-of-band buffers
+
+        :param handles: handles from the 'exports' header of a result
+        """
+        for handle in handles:
+            transport.release(handle)
+        handles.clear()
+
+    def __run_steps(self, pipeline, live, streams):
+        """Execute each step of a pipeline
+
+        A step marked with "stream": true is run on each piece of the previous step's
+        streamed output as it arrives, rather than on the whole output once it's done,
+        so a run of such steps works at the same time. Each piece is dropped once the
+        next step has taken it, so the results of the steps before the last of such a
+        run are yielded without a payload.
+
+        The output of the last step of a streaming run is gathered up whole if a step
+        taking it whole follows. If it ends the pipeline, it's yielded as it's made
+        instead: the result is a 'stream' whose payload is a generator over the pieces
+        (as the component packed them), which the caller has to pull (or close)
+        before asking for the next step. Whatever it leaves is run through (and
+        thrown away) before the pipeline finishes.
+
+        :param pipeline: a dictionary object representing a pipeline
+        :param live: set of out-of-band buffers referenced by the current intermediate, kept up to date
+        :param streams: list holding the last step's streamed output while the caller has it
+        """
+        steps = pipeline['pipeline']
+        inp = {}
+        count = 0
+        while count < len(steps):
+            # gather up the steps streaming from this one
+            chain = [steps[count]]
+            while count + len(chain) < len(steps) and steps[count + len(chain)].get('stream', False):
+                chain.append(steps[count + len(chain)])
+
+            # the output of the pipeline's last step can be handed over as it's made
+            outcome = {} if count + len(chain) == len(steps) else None
+            results = self.__run_chain(chain, inp, live, outcome)
+
+            if results[-1].success and results[-1].name == 'stream':
+                # nothing is released until the stream is through (see run())
+                streams.append(results[-1].payload)
+                for step, result in zip(chain, results):
+                    yield (count, step, result)
+                    count += 1
+
+                for _ in results[-1].payload:
+                    pass
+                if 'error' in outcome:
+                    raise BrokenPipelineError(outcome['error'])
+                streams.remove(results[-1].payload)
+                break
+
+            for index, (step, result) in enumerate(zip(chain, results)):
+                # whatever the last intermediate pointed at and the ones still to come don't has been consumed
+                exports = set()
+                for later in results[index:]:
+                    exports.update(later.headers.get('exports', []))
+                self.__release(live - exports)
+                live.clear()
+                live.update(exports)
+
+                # handle results
+                if not result.success:
+                    # log & fail
+                    self.__log.error('{}: {}'.format(
+                        step['component'],
+                        result.payload
+                    ))
+                    raise BrokenPipelineError(result.payload)
                 else:
-                    inp = result.payload
-                count += 1
+                    if result.headers.get('timing'):
+                        self.__log('{} took {}'.format(step['component'], format_timing(result.headers['timing'])))
+
+                    # generators are magic
+                    yield (count, step, result)
+                    count += 1
+
+            if 'remap' in chain[-1]:
+                inp = self.__remap_input(results[-1].payload, chain[-1]['remap'])
+            else:
+                inp = results[-1].payload
         # done!
@@ -6,48 +6,142 @@ import os
 import sys
 import uuid
 import json
+import time
 import shlex
-import random
+import shutil
+import socket
 import tempfile
+import threading
 import subprocess
-from crux.common.messaging import Message
+import zmq
+from crux.common.messaging import Message, MessageException
 from crux.common.exception import CruxException
+from crux.common.transport import SHM_THRESHOLD, trust_spill_dir
+from crux.common.description import load_cruxfile
 from crux.pipeline.component import Component
+from crux.backend.zygote import Zygote, ZygoteError
+
+# warm replicas kept per component by acquire(), unless the pool or the cruxfile's "replicas" say otherwise
+MIN_REPLICAS = 1
+MAX_REPLICAS = 4
+
+# how long (in ms) a component may take to come up and report it's ready
+READY_TIMEOUT = 60000
+
+# how long (in ms) to wait for a component to report it's ready before asking it directly (components
+# which don't report readiness, e.g. ones not written with crux's python client, are ready once they answer)
+READY_PROBE = 1000
 
 class ProcessLoadError(CruxException):
     pass
 
 class ProcessPool:
-    """Load and run a pool of components as local processes"""
+    """Load and run a pool of components as local processes
+
+    Processes can either be launched outright (launch()), or borrowed from a set of
+    warm replicas kept per component (acquire() and release()), so that running the
+    same components again doesn't pay for starting them again.
+
+    The pool may be used from several threads at once. Launches don't hold up the
+    other calls while they wait for components to come up, though acquires of the
+    same component take turns.
+    """
 
     # simple (possibly sub-optimal?) way of holding onto processes
     pool    = {}
+    paths   = {}
+    cruxfiles = {}
+
+    # (component path, version) -> addresses of its replicas, address -> times it's currently handed out,
+    # and replicas handed back broken, to stop once nobody holds them
+    replicas = None
+    leases = None
+    __broken = None
+    min_replicas = MIN_REPLICAS
+    max_replicas = MAX_REPLICAS
+
+    # 'exec' to run each component's startup command, 'fork' to fork python components off a zygote
+    launcher = 'exec'
+    __zygote = None
+
+    # components report the endpoint they bound to here once they're ready to serve
+    ready_timeout = READY_TIMEOUT
+    __context = None
+    __ready = None
+    __ready_addr = None
+
+    # bookkeeping lock, per-component acquire locks, and the readiness socket's lock
+    # along with reports taken off it for launches other threads are waiting on
+    __lock = None
+    __acquiring = None
+    __ready_lock = None
+    __reports = None
+    __expected = None
+
     use_ipc = False
     ipc_dir = None
+    use_shm = False
+    shm_threshold = None
+    spill_threshold = None
+    spill_dir = None
 
-    def __get_temp_dir(self):
-        """set up the temp directory we'll use"""
+    def __get_temp_dir(self, name='crux_ipc'):
+        """set up the temp directory we'll use
+
+        :param name: name of the directory within the system temp dir
+        """
         # osx will use a weird temp dir which i can't be bother with
         tdir = '/tmp/' if sys.platform == 'darwin' else tempfile.gettempdir()
 
         # create the storage dir if it doesn't exist
-        tdir = os.path.join(tdir, 'crux_ipc')
+        tdir = os.path.join(tdir, name)
         if not os.path.exists(tdir):
             os.mkdir(tdir)
 
         return tdir
 
-    def __init__(self, use_ipc=False):
+    def __init__(self, use_ipc=False, use_shm=False, shm_threshold=SHM_THRESHOLD, spill_threshold=None, spill_dir=None, min_replicas=MIN_REPLICAS, max_replicas=MAX_REPLICAS, launcher='exec', ready_timeout=READY_TIMEOUT):
         """Create the pool
 
         :param use_ipc: whether to use TCP vs socket file transport
+        :param use_shm: whether components should hand large outputs over in shared memory
+        :param shm_threshold: minimum size in bytes of a field to put in shared memory
+        :param spill_threshold: if not None, components spill fields of at least this many bytes to disk
+        :param spill_dir: scratch directory for spilled fields (defaults to a temp dir)
+        :param min_replicas: replicas of each acquired component to keep running
+        :param max_replicas: most replicas of each component to start
+        :param launcher: 'exec' to run components' startup commands, or 'fork' to fork the ones started as python scripts off a preloaded zygote process (see crux.backend.zygote)
+        :param ready_timeout: how long (in ms) a launched component may take to be ready to serve
         """
+        self.__lock = threading.RLock()
+        self.__acquiring = {}
+        self.__ready_lock = threading.Lock()
+        self.__reports = {}
+        self.__expected = set()
+
+        self.ready_timeout = ready_timeout
+        if launcher not in ('exec', 'fork'):
+            raise ValueError('unknown launcher "{}"'.format(launcher))
+        self.launcher = launcher
+        self.replicas = {}
+        self.leases = {}
+        self.__broken = set()
+        self.min_replicas = min_replicas
+        self.max_replicas = max(min_replicas, max_replicas)
+
         self.use_ipc = use_ipc
         if self.use_ipc:
             self.ipc_dir = self.__get_temp_dir()
+        self.use_shm = use_shm
+        self.shm_threshold = shm_threshold
+        self.spill_threshold = spill_threshold
+        if self.spill_threshold is not None:
+            self.spill_dir = spill_dir if spill_dir is not None else self.__get_temp_dir('crux_spill')
+            # whoever runs pipelines on the pool removes what the components spill there
+            trust_spill_dir(self.spill_dir)
 
     def __convert_bind(self, addr):
-        """Convert a bind address to a connect-able address. IPC-aware
+        """Convert a bound endpoint to a connect-able address. IPC-aware
 
         :param addr: address to convert
         """
@@ -55,99 +149,501 @@ class ProcessPool:
             return addr
         else:
             # assuming we're only handling local components
-            return addr.replace('*', '127.0.0.1')
+            return addr.replace('0.0.0.0', '127.0.0.1').replace('*', '127.0.0.1')
 
-    def __create_bind(self):
+    def __create_bind(self, reported=False):
         """create a bind address for a component
 
+        :param reported: whether it's for a component reporting where it bound to (see __await()), which can take any free port
         :returns: a bindable zmq uri (as a string)
         """
         if self.use_ipc:
             return 'ipc://{}'.format(os.path.join(self.ipc_dir, str(uuid.uuid4())))
+        elif reported:
+            # picked by the component as it binds, so nothing can take it first
+            return 'tcp://127.0.0.1:*'
         else:
-            # this is gross, but should work? there isn't a great way of trying to find a free port
-            return 'tcp://*:{}'.format(random.randrange(50000, 65535))
+            # a free port, so we know where to find components which don't report in
+            # (it may be taken by someone else before the component binds it)
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+                probe.bind(('', 0))
+                return 'tcp://*:{}'.format(probe.getsockname()[1])
 
     def launch(self, path):
         """Launch a component, and return a address to connect to the component at
 
+        Returns once the component is ready to serve.
+
+        :param path: path to load (containing cruxfile)
+        :raises ProcessLoadError: on failure to load a component, or if it doesn't come up
+        :returns: address of the component
+        """
+        return self.__await([self.__start(path, self.__load(path))])[0]
+
+    def launch_many(self, paths):
+        """Launch several components at once, waiting until all of them are ready to serve
+
+        If any of them fails to come up, all of them are stopped.
+
+        :param paths: paths to load (each containing a cruxfile)
+        :raises ProcessLoadError: on failure to load a component, or if one doesn't come up
+        :returns: list of addresses of the components, in the same order
+        """
+        cruxfiles = [self.__load(path) for path in paths]
+
+        pending = []
+        try:
+            for path, cruxfile in zip(paths, cruxfiles):
+                pending.append(self.__start(path, cruxfile))
+        except ProcessLoadError:
+            for _, _, _, process, _ in pending:
+                process.terminate()
+            raise
+
+        return self.__await(pending)
+
+    def acquire(self, path):
+        """Get a component to use, reusing an idle replica of it if one is running
+
+        Replicas are kept per component path and version, between the minimum and
+        maximum count (the pool's, or the cruxfile's "replicas": {"min": ..., "max": ...}).
+        Once every replica is handed out and there are as many as allowed, the least
+        busy one is handed out again. Idle replicas of other versions of the component
+        are stopped.
+
         :param path: path to load (containing cruxfile)
-        :param context: the zeromq context to pass to the Component
         :raises ProcessLoadError: on failure to load a component
-        :returns: a crux.pipeline.Component, bound, connected, and ready to go
+        :returns: address of the component, to release() when done with it
         """
+        cruxfile = self.__load(path)
+        key = (os.path.realpath(path), cruxfile.get('version'))
+
+        limits = cruxfile.get('replicas', {})
+        low = limits.get('min', self.min_replicas)
+        high = max(low, limits.get('max', self.max_replicas))
+
+        # one acquire of a component at a time, so they don't start too many replicas between them
+        with self.__lock:
+            acquiring = self.__acquiring.setdefault(key[0], threading.Lock())
 
+        with acquiring:
+            with self.__lock:
+                self.poll_all()
+                self.__retire(key)
+
+                replicas = self.replicas.get(key, [])
+                idle = [addr for addr in replicas if self.leases[addr] == 0]
+
+                # start whatever's missing (one to hand out, and any to keep warm) all at once
+                wanted = max(low - len(replicas), 0 if len(idle) > 0 or len(replicas) >= high else 1)
+
+            started = self.__await([self.__start(path, cruxfile) for _ in range(wanted)])
+
+            with self.__lock:
+                replicas = self.replicas.setdefault(key, [])
+                replicas.extend(started)
+                addr = min(replicas, key=lambda addr: self.leases[addr])
+                self.leases[addr] += 1
+                return addr
+
+    def release(self, addr, broken=False):
+        """Hand back a component got from acquire(), leaving it running for the next
+
+        A component which may be in a bad state (e.g. a request to it timed out, or its
+        run broke partway) can be handed back broken instead. It isn't handed out
+        again, and is stopped as soon as nobody else holds it.
+
+        :param addr: address of the component
+        :param broken: whether to stop the component rather than keep it
+        """
+        with self.__lock:
+            if self.leases.get(addr, 0) > 0:
+                self.leases[addr] -= 1
+
+            if broken and addr in self.pool:
+                for key in list(self.replicas):
+                    if addr in self.replicas[key]:
+                        self.replicas[key].remove(addr)
+                    if len(self.replicas[key]) == 0:
+                        del self.replicas[key]
+                self.__broken.add(addr)
+
+            if addr in self.__broken and self.leases.get(addr, 0) == 0:
+                self.__broken.discard(addr)
+                if addr in self.pool:
+                    self.pool[addr].terminate()
+
+    def __retire(self, key):
+        """Stop idle replicas of other versions of a component
+
+        :param key: (path, version) of the current version
+        """
+        for other in list(self.replicas):
+            if other[0] != key[0] or other == key:
+                continue
+
+            for addr in [addr for addr in self.replicas[other] if self.leases[addr] == 0]:
+                self.pool[addr].terminate()
+                self.replicas[other].remove(addr)
+            if len(self.replicas[other]) == 0:
+                del self.replicas[other]
+
+    def __load(self, path):
+        """Load a component's cruxfile, resolving it exactly as the component will
+
+        :param path: path to load (containing cruxfile)
+        :raises ProcessLoadError: if the cruxfile is missing or broken
+        :returns: the cruxfile
+        """
         # attempt to open the cruxfile
         cruxfile = os.path.join(path, 'crux.json')
         if not os.path.exists(cruxfile):
             raise ProcessLoadError('no crux.json in "{}"!'.format(path))
 
-        # parse the cruxfile
+        # parse the cruxfile, resolving it exactly as the component will
         try:
-            with open(cruxfile, 'r') as cf:
-                cruxfile = json.load(cf)
-        except:
-            raise ProcessLoadError('unable to parse "{}"!'.format(os.path.join(path, 'cruxfile.json')))
+            cruxfile = load_cruxfile(cruxfile)
+        except (OSError, ValueError, KeyError):
+            raise ProcessLoadError('unable to parse "{}"!'.format(os.path.join(path, 'crux.json')))
 
         # double check the cruxfile contains a startup command
         if not 'startup' in cruxfile:
             raise ProcessLoadError('no startup script specified')
 
-        # create a bind address for the component
-        bind_addr = self.__create_bind()
+        # and that its replica counts (if any) are counts
+        limits = cruxfile.get('replicas', {})
+        if not isinstance(limits, dict) or not set(limits) <= {'min', 'max'}:
+            raise ProcessLoadError('"replicas" must be of the form {"min": ..., "max": ...}')
+        for bound, least in (('min', 0), ('max', 1)):
+            if bound in limits and (type(limits[bound]) is not int or limits[bound] < least):
+                raise ProcessLoadError('"replicas" {} must be an integer of at least {}'.format(bound, least))
+
+        return cruxfile
+
+    def __start(self, path, cruxfile):
+        """Start a process for a component, without waiting for it to come up
+
+        The component binds to any free port (CRUX_READY_BIND), and reports where along
+        with its launch id once it's ready (see __await()). Components which don't
+        report are given a port of their own to bind to (CRUX_BIND), to be probed at.
+
+        :param path: path of the component
+        :param cruxfile: its cruxfile
+        :raises ProcessLoadError: if the process couldn't be started
+        :returns: the pending launch, (launch id, path, cruxfile, process, address to connect to)
+        """
+        launch_id = str(uuid.uuid4())
+        with self.__ready_lock:
+            self.__expected.add(launch_id)
 
         # copy the current process's environment variables and patch in a CRUX_BIND
+        bind_addr = self.__create_bind()
         modified_env = os.environ.copy()
         modified_env['CRUX_BIND'] = bind_addr
+        modified_env['CRUX_READY'] = self.__control()
+        modified_env['CRUX_READY_BIND'] = bind_addr if self.use_ipc else self.__create_bind(reported=True)
+        modified_env['CRUX_LAUNCH'] = launch_id
+        if self.use_shm:
+            modified_env['CRUX_SHM'] = str(self.shm_threshold)
+        if self.spill_threshold is not None:
+            modified_env['CRUX_SPILL'] = str(self.spill_threshold)
+            modified_env['CRUX_SPILL_DIR'] = self.spill_dir
+
+        # launch, off the zygote if we can
+        argv = python_entry(cruxfile, path, modified_env.get('PATH')) if self.launcher == 'fork' else None
+        if argv is not None:
+            process = self.__fork(path, argv, modified_env, cruxfile.get('preload', []))
+        else:
+            try:
+                process = subprocess.Popen(
+                    shlex.split(cruxfile['startup']),
+                    env=modified_env,
+                    cwd=path
+                )
+            except OSError as e:
+                raise ProcessLoadError('unable to start "{}": {}'.format(path, e))
+
+        return (launch_id, path, cruxfile, process, self.__convert_bind(bind_addr))
+
+    def __await(self, pending):
+        """Wait for started components to report that they're ready to serve
+
+        Components which haven't reported in after READY_PROBE are asked for their
+        cruxfile as well, and are ready once they answer.
+
+        :param pending: list of pending launches from __start()
+        :raises ProcessLoadError: if one exits or doesn't come up in time (all of them are stopped then)
+        :returns: list of the components' addresses, in the same order
+        """
+        waiting = {launch[0]: index for index, launch in enumerate(pending)}
+        addrs = [None] * len(pending)
+        deadline = time.monotonic() + self.ready_timeout / 1000
+        probe_at = time.monotonic() + READY_PROBE / 1000
 
-        # change the bind addr into an address to connect to
-        connect_addr = self.__convert_bind(bind_addr)
-
-        # create the launch command
-        launch = shlex.split(cruxfile['startup'])
-
-        # launch
-        self.pool[connect_addr] = subprocess.Popen(
-            launch,
-            env=modified_env,
-            cwd=path
-        )
+        # launch id -> REQ socket asking the component for its cruxfile
+        probes = {}
+        context = None
 
-        # this can be passed right into a component constructor
-        return connect_addr
+        try:
+            while True:
+                self.__collect(waiting, addrs, 0)
+                if len(waiting) > 0 and time.monotonic() >= probe_at:
+                    context = context if context is not None else zmq.Context()
+                    self.__probe(context, pending, waiting, addrs, probes)
+                if len(waiting) == 0:
+                    break
+
+                for launch_id, index in waiting.items():
+                    _, path, _, process, _ = pending[index]
+                    if process.poll() is not None:
+                        raise ProcessLoadError('"{}" exited ({}) before it was ready'.format(path, process.returncode))
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ProcessLoadError('{} not ready after {}ms'.format(
+                        ', '.join('"{}"'.format(pending[index][1]) for index in waiting.values()),
+                        self.ready_timeout
+                    ))
+
+                self.__collect(waiting, addrs, min(100, int(remaining * 1000) + 1))
+        except ProcessLoadError:
+            for _, _, _, process, _ in pending:
+                process.terminate()
+            raise
+        finally:
+            # reports from launches we gave up on are ignored from now on
+            with self.__ready_lock:
+                for launch_id, _, _, _, _ in pending:
+                    self.__expected.discard(launch_id)
+                    self.__reports.pop(launch_id, None)
+
+            for probe in probes.values():
+                probe.close(linger=0)
+            if context is not None:
+                context.term()
+
+        with self.__lock:
+            for (_, path, cruxfile, process, _), addr in zip(pending, addrs):
+                self.pool[addr] = process
+                self.paths[addr] = path
+                self.cruxfiles[addr] = cruxfile
+                self.leases[addr] = 0
+
+        # these can be passed right into a component constructor
+        return addrs
+
+    def __collect(self, waiting, addrs, timeout):
+        """Take readiness reports off the socket, handing them to whichever launch is waiting
+
+        :param waiting: dict of launch id to index, of the launches this thread waits on (found ones are removed)
+        :param addrs: list to put the found launches' addresses in, by index
+        :param timeout: how long (in ms) to wait for a report
+        :raises ProcessLoadError: if the pool was shut down meanwhile
+        """
+        with self.__ready_lock:
+            if self.__ready is None:
+                raise ProcessLoadError('pool shut down while launching')
+
+            # another thread may already have taken ours off the socket
+            for launch_id in [launch_id for launch_id in waiting if launch_id in self.__reports]:
+                addrs[waiting.pop(launch_id)] = self.__reports.pop(launch_id)
+
+            while len(waiting) > 0 and self.__ready.poll(timeout):
+                timeout = 0
+                try:
+                    report = Message(data=self.__ready.recv_multipart()).payload
+                    launch_id, endpoint = report['id'], report['endpoint']
+                except (MessageException, TypeError, KeyError):
+                    continue
+
+                if launch_id in waiting:
+                    addrs[waiting.pop(launch_id)] = self.__convert_bind(endpoint)
+                elif launch_id in self.__expected:
+                    self.__reports[launch_id] = self.__convert_bind(endpoint)
+
+    def __probe(self, context, pending, waiting, addrs, probes):
+        """Ask launches which haven't reported in for their cruxfile, taking an answer as ready
+
+        :param context: zmq context to create the probes with
+        :param pending: list of pending launches from __start()
+        :param waiting: dict of launch id to index, of the launches still waited on (found ones are removed)
+        :param addrs: list to put the found launches' addresses in, by index
+        :param probes: dict of launch id to the REQ socket probing it, added to as probes are sent
+        """
+        for launch_id, index in list(waiting.items()):
+            addr = pending[index][4]
+            if launch_id not in probes:
+                probe = context.socket(zmq.REQ)
+                probe.setsockopt(zmq.LINGER, 0)
+                probe.connect(addr)
+                probe.send_multipart(Message(name='get_cruxfile').pack())
+                probes[launch_id] = probe
+            elif probes[launch_id].poll(0, zmq.POLLIN):
+                probes[launch_id].recv_multipart()
+                addrs[waiting.pop(launch_id)] = addr
+
+    def __control(self):
+        """Get the address components report readiness to, binding it if need be
+
+        :returns: address
+        """
+        with self.__ready_lock:
+            if self.__ready is None:
+                self.__context = zmq.Context()
+                self.__ready = self.__context.socket(zmq.PULL)
+                if self.use_ipc:
+                    self.__ready.bind('ipc://{}'.format(os.path.join(self.ipc_dir, str(uuid.uuid4()))))
+                else:
+                    self.__ready.bind('tcp://127.0.0.1:*')
+                self.__ready_addr = self.__ready.getsockopt_string(zmq.LAST_ENDPOINT)
+            return self.__ready_addr
+
+    def __fork(self, path, argv, env, preload):
+        """Fork a component off the zygote, starting it if need be
+
+        :param path: path of the component
+        :param argv: script to run and its arguments
+        :param env: the component's environment
+        :param preload: modules for the zygote to import first
+        :raises ProcessLoadError: if the zygote couldn't launch it
+        :returns: process handle
+        """
+        with self.__lock:
+            if self.__zygote is None or not self.__zygote.alive():
+                self.__zygote = Zygote()
+
+            try:
+                return self.__zygote.launch(os.path.abspath(path), argv, env, preload=preload)
+            except ZygoteError as ze:
+                raise ProcessLoadError('unable to fork "{}": {}'.format(path, ze.msg))
+
+    def __stop_zygote(self):
+        """Stop the zygote, if there is one"""
+        if self.__zygote is not None:
+            self.__zygote.close()
+            self.__zygote = None
+
+    def __close_control(self):
+        """Close the readiness socket, if it's open (it's reopened on the next launch)"""
+        with self.__ready_lock:
+            if self.__ready is not None:
+                self.__ready.close(linger=0)
+                self.__context.term()
+                self.__ready = None
+                self.__ready_addr = None
 
     def join_all(self):
         """Wait for all managed processes to exit on their own"""
-        for addr in self.pool:
-            self.pool[addr].wait()
+        with self.__lock:
+            processes = list(self.pool.values())
+        for process in processes:
+            process.wait()
 
     def kill_all(self):
         """Send SIGKILL on all managed processes"""
-        for addr in self.pool:
-            self.pool[addr].kill()
+        with self.__lock:
+            for addr in self.pool:
+                self.pool[addr].kill()
+            self.__stop_zygote()
+        self.__close_control()
 
     def terminate_all(self):
         """Send SIGTERM to all managed processes
 
         On Windows, this has the same effect as ComponentPool.kill_all()
         """
-        for addr in self.pool:
-            self.pool[addr].terminate()
+        with self.__lock:
+            for addr in self.pool:
+                self.pool[addr].terminate()
+            self.__stop_zygote()
+        self.__close_control()
+
+    def get_all_status(self):
+        """Get the status of all processes managed by this pool
+
+        The pid tells a restarted process apart from the one it replaced.
+
+        :returns: a dict of address to {'pid': process id, 'path': component path, 'leases': times it's handed out by acquire()}
+        """
+        with self.__lock:
+            self.poll_all()
+            return {
+                addr: {'pid': self.pool[addr].pid, 'path': self.paths[addr], 'leases': self.leases.get(addr, 0)}
+                for addr in self.pool
+            }
+
+    def get_all_cruxfiles(self, addrs=None):
+        """Get the resolved cruxfiles of processes managed by this pool
+
+        These are the same as what the components would answer 'get_cruxfile' with,
+        so handles can be built from them without asking the processes.
+
+        :param addrs: addresses to get cruxfiles for (defaults to all), unknown ones are left out
+        :returns: a dict of address to cruxfile
+        """
+        with self.__lock:
+            self.poll_all()
+            if addrs is None:
+                addrs = self.pool
+            return {addr: self.cruxfiles[addr] for addr in addrs if addr in self.cruxfiles}
 
     def get_all_addrs(self):
         """Get all addresses for all processes managed by this pool
 
         :returns: a list of addresses
         """
-        self.poll_all()
-        return [addr for addr in self.pool]
+        with self.__lock:
+            self.poll_all()
+            return [addr for addr in self.pool]
 
     def poll_all(self):
         """Poll all managed processes and remove stopped ones"""
-        deadprocs = []
-        for addr in self.pool:
-            if self.pool[addr].poll() is not None:
-                deadprocs.append(addr)
-
-        for addr in deadprocs:
-            del self.pool[addr]
+        with self.__lock:
+            deadprocs = []
+            for addr in self.pool:
+                if self.pool[addr].poll() is not None:
+                    deadprocs.append(addr)
+
+            for addr in deadprocs:
+                del self.pool[addr]
+                del self.paths[addr]
+                del self.cruxfiles[addr]
+                self.leases.pop(addr, None)
+                self.__broken.discard(addr)
+
+            for key in list(self.replicas):
+                self.replicas[key] = [addr for addr in self.replicas[key] if addr in self.pool]
+                if len(self.replicas[key]) == 0:
+                    del self.replicas[key]
+
+def python_entry(cruxfile, cwd='.', search_path=None):
+    """Work out which python script a component runs, to fork it off a zygote
+
+    Either the cruxfile's "entry" (e.g. "simulation.py --flag"), or the script of a
+    startup command like "python3 simulation.py", as long as that python is the one
+    we're running on (a component started with another interpreter, or in another
+    virtualenv, has to be started as usual).
+
+    :param cruxfile: the component's cruxfile
+    :param cwd: directory the startup command would run in
+    :param search_path: PATH the startup command would run with (ours if None)
+    :returns: list of the script and its arguments, or None if it isn't started as a python script
+    """
+    if 'entry' in cruxfile:
+        return shlex.split(cruxfile['entry'])
+
+    command = shlex.split(cruxfile['startup'])
+    if len(command) < 2 or not command[1].endswith('.py'):
+        return None
+
+    # find the interpreter just as starting the command would
+    executable = command[0] if os.sep not in command[0] else os.path.join(cwd, command[0])
+    executable = shutil.which(executable, path=search_path)
+    if executable is None or sys.executable in (None, ''):
+        return None
+
+    # the same file in the same directory (a virtualenv's python links to the base one)
+    same = os.path.dirname(os.path.abspath(executable)) == os.path.dirname(os.path.abspath(sys.executable))
+    if not same or not os.path.samefile(executable, sys.executable):
+        return None
+    return command[1:]
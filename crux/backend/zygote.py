@@ -0,0 +1,383 @@
+##
+# Crux fork-server ("zygote") component launcher
+# @author Patrick Kage
+
+import os
+import sys
+import json
+import time
+import queue
+import select
+import signal
+import runpy
+import importlib
+import traceback
+import threading
+import subprocess
+from crux.common.exception import CruxException
+
+class ZygoteError(CruxException):
+    """The zygote couldn't launch a component"""
+
+class ForkedProcess:
+    """Handle to a component forked by the zygote, quacking like a subprocess.Popen
+
+    The process is the zygote's child rather than ours, so the zygote reaps it and
+    tells us how it exited, and signals it for us (it can't have been reaped, and its
+    pid reused, while the zygote still counts it as running). If the zygote's gone,
+    all we can do is look for the process by pid.
+    """
+    pid = None
+    returncode = None
+    __zygote = None
+
+    def __init__(self, pid, zygote):
+        """Set up the handle
+
+        :param pid: the process's pid
+        :param zygote: the Zygote it was forked off
+        """
+        self.pid = pid
+        self.__zygote = zygote
+
+    def poll(self):
+        """Check if the process has exited
+
+        :returns: None if it's still running, otherwise its exit code (negative for a signal, -1 if unknown)
+        """
+        if self.returncode is None:
+            self.returncode = self.__zygote.exit_code(self.pid)
+
+        if self.returncode is None and not self.__zygote.watching():
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = -1
+            except PermissionError:
+                # pid reused by someone else's process
+                self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait for the process to exit
+
+        :param timeout: seconds to wait, forever if None
+        :raises subprocess.TimeoutExpired: if it's still running after the timeout
+        :returns: its exit code
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired('pid {}'.format(self.pid), timeout)
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, sig):
+        """Send a signal to the process, if it's still running
+
+        :param sig: the signal
+        """
+        if self.poll() is None:
+            self.__zygote.signal(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class Zygote:
+    """A preloaded python process which forks off components on request
+
+    The zygote imports crux (and zmq, msgpack) once, as well as each component's
+    "preload" modules the first time it launches that component. Each launch is
+    then a fork running the component's script, with none of those imports to do.
+    Only components started as python scripts can be launched this way, and they
+    run on the zygote's interpreter.
+
+    The zygote reports its components' exits as they happen, which a thread reading
+    its replies keeps track of.
+    """
+    __process = None
+    __requests = None
+    __replies = None
+    __reader = None
+
+    # one launch at a time (so replies match up), and one request written at a time
+    __launching = None
+    __writing = None
+
+    # launch replies, waiting for launch(); pid -> exit code of components which have exited
+    __launched = None
+    __exits = None
+
+    def __init__(self):
+        """Start the zygote process"""
+        # one pipe each way, so the components keep the zygote's stdout & stderr
+        request_r, request_w = os.pipe()
+        reply_r, reply_w = os.pipe()
+        self.__process = subprocess.Popen(
+            [sys.executable, '-c', 'from crux.backend import zygote; zygote.main()', str(request_r), str(reply_w)],
+            pass_fds=(request_r, reply_w)
+        )
+        os.close(request_r)
+        os.close(reply_w)
+
+        self.__requests = os.fdopen(request_w, 'w')
+        self.__replies = os.fdopen(reply_r, 'r')
+
+        self.__launching = threading.Lock()
+        self.__writing = threading.Lock()
+        self.__launched = queue.Queue()
+        self.__exits = {}
+
+        self.__reader = threading.Thread(target=self.__read, daemon=True)
+        self.__reader.start()
+
+    def launch(self, path, argv, env, preload=None):
+        """Fork off a component
+
+        :param path: directory to run the component in
+        :param argv: the script to run (relative to path) and its arguments
+        :param env: the component's environment
+        :param preload: modules to import into the zygote before forking
+        :raises ZygoteError: if the zygote is gone or the fork failed
+        :returns: ForkedProcess
+        """
+        with self.__launching:
+            self.__write({
+                'path': path,
+                'argv': argv,
+                'env': env,
+                'preload': preload if preload is not None else []
+            })
+            reply = self.__launched.get()
+
+        if reply is None:
+            raise ZygoteError('zygote exited')
+        if 'error' in reply:
+            raise ZygoteError(reply['error'])
+
+        return ForkedProcess(reply['pid'], self)
+
+    def signal(self, pid, sig):
+        """Have the zygote signal one of its components, unless it's exited
+
+        :param pid: the component's pid
+        :param sig: the signal
+        """
+        try:
+            self.__write({'signal': int(sig), 'pid': pid})
+        except ZygoteError:
+            # the zygote's gone, and the component's been orphaned
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def exit_code(self, pid):
+        """Get how one of the zygote's components exited
+
+        :param pid: the component's pid
+        :returns: its exit code, or None if the zygote hasn't reported it exited
+        """
+        return self.__exits.get(pid)
+
+    def watching(self):
+        """Check if the zygote is still reporting its components' exits
+
+        :returns: True if so
+        """
+        return self.__reader.is_alive()
+
+    def alive(self):
+        """Check if the zygote is still running
+
+        :returns: True if so
+        """
+        return self.__process.poll() is None
+
+    def close(self):
+        """Stop the zygote launching components
+
+        The components it launched keep running, and the zygote stays around to reap
+        them (and report how they exited) until the last one exits.
+        """
+        with self.__writing:
+            try:
+                self.__requests.close()
+            except OSError:
+                pass
+
+    def __write(self, request):
+        """Send the zygote a request
+
+        :param request: the request
+        :raises ZygoteError: if the zygote is gone
+        """
+        with self.__writing:
+            try:
+                self.__requests.write(json.dumps(request) + '\n')
+                self.__requests.flush()
+            except (OSError, ValueError) as e:
+                raise ZygoteError('zygote is gone: {}'.format(e))
+
+    def __read(self):
+        """Read the zygote's replies until it exits (on the reader thread)"""
+        try:
+            for line in self.__replies:
+                reply = json.loads(line)
+                if 'exited' in reply:
+                    self.__exits[reply['exited']] = reply['code']
+                else:
+                    self.__launched.put(reply)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.__replies.close()
+            # nothing more's coming, for a launch waiting or otherwise
+            self.__launched.put(None)
+            self.__process.wait()
+
+def _preload(modules):
+    """Import modules into the zygote, so components forked from it don't have to
+
+    :param modules: names of modules to import
+    """
+    for module in modules:
+        if module in sys.modules:
+            continue
+        try:
+            importlib.import_module(module)
+        except Exception:
+            # the component will find out for itself
+            traceback.print_exc()
+
+def _run(request, fds):
+    """Become a component (in the forked child)
+
+    :param request: the launch request
+    :param fds: the zygote's control pipes
+    """
+    for fd in fds:
+        os.close(fd)
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    code = 0
+    try:
+        os.chdir(request['path'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = list(request['argv'])
+        sys.path[0] = os.getcwd()
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit as se:
+        code = se.code if isinstance(se.code, int) else (0 if se.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+def _exit_code(status):
+    """Turn a wait status into an exit code, the way subprocess does
+
+    :param status: status from os.waitpid()
+    :returns: the exit code, or minus the signal which killed the process
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def serve(request_fd, reply_fd):
+    """Answer launch and signal requests until the pool closes the pipe, and its components have exited
+
+    Launch requests are answered with the component's pid (or an error), and each
+    component is reaped and reported, {"exited": pid, "code": exit code}, as it exits.
+
+    :param request_fd: fd to read requests from (one json object per line)
+    :param reply_fd: fd to write replies to
+    """
+    # SIGCHLD just wakes up the loop, which reaps the components
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.set_wakeup_fd(wake_w)
+
+    replies = os.fdopen(reply_fd, 'w')
+    children = set()
+    pending = b''
+    accepting = True
+
+    def reply(message):
+        replies.write(json.dumps(message) + '\n')
+        replies.flush()
+
+    while accepting or len(children) > 0:
+        readable, _, _ = select.select([request_fd, wake_r] if accepting else [wake_r], [], [])
+
+        if wake_r in readable:
+            try:
+                while len(os.read(wake_r, 4096)) > 0:
+                    pass
+            except BlockingIOError:
+                pass
+            # only our components, leaving any other children to whoever started them
+            for pid in list(children):
+                try:
+                    reaped, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    children.discard(pid)
+                    reply({'exited': pid, 'code': -1})
+                    continue
+                if reaped != 0:
+                    children.discard(pid)
+                    reply({'exited': pid, 'code': _exit_code(status)})
+
+        if request_fd not in readable:
+            continue
+
+        data = os.read(request_fd, 65536)
+        if len(data) == 0:
+            # no more requests, just components to see out
+            accepting = False
+            continue
+        pending += data
+        *lines, pending = pending.split(b'\n')
+
+        for line in lines:
+            request = json.loads(line)
+
+            if 'signal' in request:
+                # not yet reaped, so the pid is still theirs
+                if request['pid'] in children:
+                    os.kill(request['pid'], request['signal'])
+                continue
+
+            _preload(request['preload'])
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                pid = os.fork()
+            except OSError as e:
+                reply({'error': 'fork failed: {}'.format(e)})
+                continue
+
+            if pid == 0:
+                _run(request, (request_fd, reply_fd, wake_r, wake_w))
+
+            children.add(pid)
+            reply({'pid': pid})
+
+def main():
+    """Entry point of the zygote process, taking the control pipe's fds as arguments"""
+    # what every component will need anyway
+    import zmq
+    import msgpack
+    import crux.client
+    serve(int(sys.argv[1]), int(sys.argv[2]))
@@ -4,41 +4,131 @@
 
 import os
 import json
+import time
 import zmq
+import queue
+import collections
 import msgpack
+import concurrent.futures
 from crux.common import packing
 from crux.common.exception import CruxException
 from crux.common.messaging import Message, MessageException
+from crux.common.transport import from_environment
+from crux.common.description import load_cruxfile
+from crux.client.memo import Memo, MEMO_MAX_BYTES, MEMO_MAX_DISK_BYTES
 from crux.common.logging import Logger
 
+# how long (in ms) to wait for the requestor to ask for more of a stream, before giving up on it
+STREAM_IDLE = 60000
+
 class InstantiationException(CruxException):
     """Something went wrong with instantiating the client"""
 
 class NoResultError(CruxException):
     """No result has been returned and the socket is in an illegal state"""
 
+def _call_handler(handler, inputs, parameters, streaming=False):
+    """Call a serve() handler on a worker
+
+    A generator handler's partial outputs are handed back as an iterator, for the
+    loop to stream (pulled on the pool with _pull_chunks()).
+
+    :param handler: the handler
+    :param inputs: dict of inputs
+    :param parameters: dict of parameters
+    :param streaming: whether partial outputs can be streamed back from here
+    :returns: dict of outputs, or an iterator of partial outputs
+    :raises TypeError: if the handler gave partial outputs which can't be streamed
+    """
+    output = handler(inputs, parameters)
+    if output is not None and not isinstance(output, dict):
+        if not streaming:
+            raise TypeError('partial outputs can only be streamed from single executes on thread workers')
+        return iter(output)
+    return output
+
+def _pull_chunks(chunks, credit):
+    """Take the next few partial outputs from a streaming handler, on a worker
+
+    :param chunks: iterator of partial outputs
+    :param credit: how many to take at most
+    :returns: (list of partial outputs, whether the handler has finished)
+    """
+    pieces = []
+    try:
+        while len(pieces) < credit:
+            pieces.append(next(chunks))
+    except StopIteration:
+        return pieces, True
+    return pieces, False
+
 class CruxClient:
     # zeromq stuff
     __context = None
     __socket = None
     __dirty_socket = False # ;)
+    __codec = None
+    __transport = None
+
+    # router mode: routing envelope & id of the request being answered,
+    # and requests which arrived while we were busy streaming
+    __router = False
+    __envelope = None
+    __request_id = None
+    __backlog = None
+
+    # serving mode: worker pool size and requests handed to it but not yet answered
+    __workers = 1
+    __in_flight = 0
+    __completed = 0
+
+    # serving mode: streams open, by requestor envelope -> {'chunks': iterator of
+    # partial outputs, 'deadline': when it's abandoned unless asked for more,
+    # 'pulling': whether chunks are being taken on a worker, 'cancel': route of a
+    # stream_cancel to answer once they have been}
+    __streams = None
+
+    # batches: whether the current execute came as one, how many items it has, the
+    # items still to hand out and results so far (when unrolled by wait())
+    __batched = False
+    __batch_size = 0
+    __batch = None
+    __batch_results = None
+
+    # memoized results (if the cruxfile asks for it), and the key of the execute being run
+    __memo = None
+    __memo_key = None
+
+    # where the time of the request being answered went (phase -> ms, see
+    # messaging.TIMING_PHASES), and when it was handed to the component's code
+    __timing = None
+    __handed_out = None
+
+    # compiled I/O plans & parameter defaults
+    __input_plan = None
+    __output_plan = None
+    __defaults = None
 
     # description stuff
     inputs = None
     outputs = None
     parameters = None
+    codecs = None
+    protocol = None
     cruxfile = None
 
     # misc housekeeping
     __log = None
 
-    def __init__(self, description='crux.json', bind=None, context=None, logging=True):
+    def __init__(self, description='crux.json', bind=None, context=None, logging=True, transport=None, protocol=None):
         """Creates the CruxClient instance
 
         :param description: where to find the crux description file. defaults to 'crux.json'
         :param bind: the address to bind to. if launched by the crux server, this will be automatically set
         :param context: advanced; specifies a ZMQ context to use (for intra-process comms). if one is not specified, one will be created
         :param logging: if true, the crux client will log to stdout (on by default)
+        :param transport: out-of-band transport for large outputs (see crux.common.transport). if launched by a pool using shared memory or spilling, this will be automatically set
+        :param protocol: 'rep' (one request at a time) or 'router' (requests queue up and are answered in turn, with request ids). defaults to the cruxfile's 'protocol', or 'rep'
         :raises InstantiationException: can fail, error msg will have detail
         """
 
@@ -47,30 +137,65 @@ class CruxClient:
 
         # load in all the pieces of the crux description
         self.__log('loading cruxfile {}...'.format(description))
-        with open(description, 'r') as cfile:
-            self.cruxfile = json.load(cfile)
-
-            self.inputs = self.__open_all(self.cruxfile['inputs'])
-            self.cruxfile['inputs'] = self.inputs
+        self.cruxfile = load_cruxfile(description)
+        self.inputs = self.cruxfile['inputs']
+        self.outputs = self.cruxfile['outputs']
+        self.parameters = self.cruxfile['parameters']
+        self.codecs = self.cruxfile['codecs']
 
-            self.outputs = self.__open_all(self.cruxfile['outputs'])
-            self.cruxfile['outputs'] = self.outputs
+        # how requestors should talk to us
+        self.protocol = protocol if protocol is not None else self.cruxfile['protocol']
+        if self.protocol not in ('rep', 'router'):
+            raise InstantiationException('unknown protocol "{}"!'.format(self.protocol))
+        self.cruxfile['protocol'] = self.protocol
 
-            self.parameters = self.__open_all(self.cruxfile['parameters'])
-            self.cruxfile['parameters'] = self.parameters
+        # compile everything we need per message up front
+        self.__input_plan = packing.IOPlan(self.inputs)
+        self.__output_plan = packing.IOPlan(self.outputs)
+        self.__defaults = {
+            param: self.parameters[param]['default']
+            for param in self.parameters
+            if 'default' in self.parameters[param]
+        }
 
         # change the log name
         self.__log.set_name(self.cruxfile['name'])
         self.__log('loaded cruxfile (and subfiles) successfully!')
 
+        # repeated executes can be answered from a cache, if the component is pure
+        memoize = self.cruxfile.get('memoize', False)
+        if memoize:
+            memoize = memoize if isinstance(memoize, dict) else {}
+            directory = memoize.get('directory')
+            self.__memo = Memo(
+                max_bytes=memoize.get('max_bytes', MEMO_MAX_BYTES),
+                directory=os.path.join(os.path.dirname(description), directory) if directory is not None else None,
+                salt='{}@{}'.format(self.cruxfile['name'], self.cruxfile.get('version')),
+                max_disk_bytes=memoize.get('max_disk_bytes', MEMO_MAX_DISK_BYTES)
+            )
+            self.__log('memoizing results{}'.format(
+                ' (on disk in {})'.format(self.__memo.directory) if self.__memo.directory is not None else ''
+            ))
+
         # if the bind address is none, assume we're being run by the crux command line client
         # extract the bind address from the environment
-        if bind is None:
+        launched = bind is None
+        if launched:
             if not 'CRUX_BIND' in os.environ:
                 raise InstantiationException('no bind address provided and CRUX_BIND unset!')
             bind = os.environ['CRUX_BIND']
+            # a launcher we report to finds us from the report, so we can take any free port
+            if 'CRUX_READY' in os.environ and 'CRUX_READY_BIND' in os.environ:
+                bind = os.environ['CRUX_READY_BIND']
         self.__log('interpreted bind address as {}'.format(bind))
 
+        # the launcher may want large outputs moved out of band (shared memory, spilled to disk)
+        if transport is None:
+            transport = from_environment()
+            if transport is not None:
+                self.__log('moving large outputs out of band with {}'.format(type(transport).__name__))
+        self.__transport = transport
+
         # if the zeromq context is not provided, we'll make our own
         if context is not None:
             self.__context = context
@@ -78,41 +203,138 @@ class CruxClient:
             self.__context = zmq.Context()
 
         # make the socket and bind it
-        self.__socket = self.__context.socket(zmq.REP)
+        self.__router = self.protocol == 'router'
+        self.__backlog = collections.deque()
+        self.__streams = {}
+        self.__socket = self.__context.socket(zmq.ROUTER if self.__router else zmq.REP)
         self.__socket.bind(bind)
-        self.__log.info('component listening on {}!'.format(bind))
+        endpoint = self.__socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        self.__log.info('component listening on {} ({} mode)!'.format(endpoint, self.protocol))
+
+        # tell whoever launched us that we're up, and where
+        if launched and 'CRUX_READY' in os.environ:
+            self.__report_ready(os.environ['CRUX_READY'], os.environ.get('CRUX_LAUNCH'), endpoint)
+
+    def __report_ready(self, address, launch_id, endpoint):
+        """Let the launcher know we're ready to serve
+
+        :param address: address the launcher listens for readiness on
+        :param launch_id: id the launcher knows this launch by
+        :param endpoint: the endpoint we actually bound to
+        """
+        ready = self.__context.socket(zmq.PUSH)
+        # don't hang on exit if the launcher's gone
+        ready.setsockopt(zmq.LINGER, 5000)
+        ready.connect(address)
+        ready.send_multipart(Message(
+            name='ready',
+            payload={'id': launch_id, 'endpoint': endpoint, 'pid': os.getpid()}
+        ).pack())
+        ready.close()
 
     def wait(self):
         """Waits for a client to ask something
 
+        Batches of executes ('execute_batch') are handed out one item at a time; the
+        reply to the batch goes back once every item has had an output() or fail().
+        See wait_batch() to take a whole batch at once instead.
+
+        If the component memoizes, executes seen before are answered straight from the
+        cache, without being handed out.
+
         :returns: a triple (run inputs, run config, done status)
         """
+        if self.__dirty_socket:
+            raise NoResultError()
 
         while True:
-            if self.__dirty_socket:
-                raise NoResultError()
-            msg = Message(data=self.__socket.recv())
+            if self.__batch is not None and len(self.__batch) > 0:
+                # carry on with the rest of a batch
+                inputs, parameters, key = self.__batch.popleft()
+            else:
+                items, done = self.__wait()
+                if done:
+                    return (None, None, True)
+
+                if self.__batch_results is not None:
+                    # unroll the batch
+                    self.__batch = collections.deque(items[1:])
+                inputs, parameters, key = items[0]
+
+            cached = self.__recall(key)
+            if cached is None:
+                break
+
+            if self.__batch_results is not None:
+                self.__gather({'success': True, 'payload': cached})
+            else:
+                self.__send(Message(name='return', payload=cached, success=True), since=time.monotonic())
+                self.__completed += 1
+
+        # this is an execution, pass control back to the main loop (but needing closure)
+        self.__log('passing execution back...')
+        self.__dirty_socket = True
+        self.__memo_key = key
+        self.__handed_out = time.monotonic()
+        return (inputs, parameters, False)
+
+    def wait_batch(self):
+        """Waits for a client to ask something, taking batches of executes as one unit
+
+        Answer with output_batch(). A plain 'execute' comes back as a batch of one.
+        Batches taken this way bypass memoization.
+
+        :returns: a triple (list of run inputs, list of run configs, done status)
+        """
+        if self.__dirty_socket:
+            raise NoResultError()
+
+        items, done = self.__wait(batch=True)
+        if done:
+            return (None, None, True)
+
+        self.__log('passing batch of {} back...'.format(len(items)))
+        self.__dirty_socket = True
+        self.__handed_out = time.monotonic()
+        return ([inputs for inputs, _, _ in items], [parameters for _, parameters, _ in items], False)
+
+    def __wait(self, batch=False):
+        """Answer requests until an execute (or a batch of them) or a shutdown comes in
+
+        :param batch: whether the caller takes a batch as one unit
+        :returns: a pair (list of (inputs, parameters, memo key) to run, done status)
+        """
+        while True:
+            msg = self.__recv()
+            if msg is None:
+                continue
             reply = Message(name='ack')
             self.__log('received {}...'.format(msg.name))
 
             # route our reply
-            if msg.name == 'execute':
+            if msg.name in ('execute', 'execute_batch'):
                 # first check if the request is valid
-                if msg.payload is not None and 'parameters' in msg.payload and 'inputs' in msg.payload:
-                    # this is an execution, pass control back to the main loop (but needing closure)
-                    self.__log('passing execution back...')
-                    self.__dirty_socket = True
-                    return (
-                        packing.unpack_io_object(msg.payload['inputs'], defs=self.cruxfile['inputs']),
-                        self.__defaultify(msg.payload['parameters']),
-                        False
-                    )
-                else:
+                started = time.monotonic()
+                items = self.__items(msg)
+                self.__clock('unpack', started)
+                if items is None:
                     reply.name ='malformed'
                     reply.success = False
                     self.__log.error('received malformed execution request')
+                elif msg.name == 'execute':
+                    self.__batched = False
+                    return (items, False)
+                elif len(items) > 0:
+                    self.__batched = True
+                    self.__batch_size = len(items)
+                    self.__batch_results = None if batch else []
+                    return (items, False)
+                else:
+                    reply = Message(name='return_batch', payload={'results': []}, success=True)
             elif msg.name == 'get_cruxfile':
                 reply.payload = self.cruxfile
+            elif msg.name == 'get_status':
+                reply.payload = self.__status()
             elif msg.name == 'shutdown':
                 break
             else:
@@ -121,21 +343,475 @@ class CruxClient:
                 reply.success = False
 
             # skipped if there was a shutdown or execute instruction
-            self.__socket.send(reply.pack())
+            self.__send(reply)
             self.__dirty_socket = False
 
         # if we've broken out this side of the loop, assume we're shutting down
         self.__log('shutting down loop...')
-        self.__socket.send(reply.pack())
+        self.__send(reply)
         self.__dirty_socket = False
-        return (None, None, True)
+        return (None, True)
+
+    def __items(self, msg):
+        """Unpack the runs an execute or execute_batch asks for
+
+        :param msg: the request
+        :returns: list of (inputs, parameters, memo key), or None if the request is malformed
+        """
+        payload = msg.payload
+        if msg.name == 'execute':
+            payload = {'items': [payload]}
+
+        if not isinstance(payload, dict) or not isinstance(payload.get('items'), list):
+            return None
+
+        items = []
+        for item in payload['items']:
+            if not isinstance(item, dict) or not isinstance(item.get('parameters'), dict) or not isinstance(item.get('inputs'), dict):
+                return None
+            try:
+                parameters = self.__defaultify(item['parameters'])
+                items.append((
+                    self.__input_plan.unpack(item['inputs']),
+                    parameters,
+                    self.__memo.key(item['inputs'], parameters) if self.__memo is not None else None
+                ))
+            except (packing.PackingException, MessageException, KeyError, ValueError, TypeError) as e:
+                # inputs not matching their definitions fail the request, not the component
+                self.__log.error('unable to unpack execution request: {}'.format(repr(e)))
+                return None
+        return items
+
+    def __recall(self, key):
+        """Look up the memoized result of an execute
+
+        :param key: memo key of the execute (None if it isn't memoized)
+        :returns: the packed outputs, or None if they have to be computed
+        """
+        if key is None:
+            return None
+
+        cached = self.__memo.get(key)
+        if cached is not None:
+            self.__log('answering from memo')
+        return cached
+
+    def __memorize(self, key, result):
+        """Memoize the result of an execute, if it succeeded
+
+        :param key: memo key of the execute (None if it isn't memoized)
+        :param result: {'success': ..., 'payload': packed outputs or the error}
+        :returns: result
+        """
+        if key is not None and result['success']:
+            self.__memo.put(key, result['payload'])
+        return result
+
+    def serve(self, handler, workers=None, executor='thread', batch_handler=None):
+        """Serve executes with a handler function, several at once
+
+        Instead of a wait()/output() loop, each execute is handed to `handler(inputs,
+        parameters)` on a pool of workers, and its return value (a dict of outputs)
+        sent back as soon as it's ready. A handler raising an exception fails that
+        execute only. Returns once asked to shut down, after the executes in flight
+        have been answered.
+
+        Handlers may also be generators yielding partial outputs (e.g. one per
+        timestep). These are streamed back as they're yielded, so the next step of a
+        pipeline can start on them straight away; with a pool, the generator is run
+        on the workers a few pieces at a time, as the requestor asks for them, while
+        other executes carry on. Generators can't be sent back from 'process' workers
+        or as items of a batch, so partial outputs there fail the execute.
+
+        The items of a batch are spread over the workers like separate executes,
+        unless a `batch_handler(inputs, parameters)` is given to run the lists of a
+        whole batch at once (returning a list of outputs, with exceptions in place of
+        outputs for failed items).
+
+        Only components serving in 'router' mode can take more than one execute at a
+        time; in 'rep' mode the handler is simply called for each execute in turn.
+
+        How busy the pool is can be asked for with a 'get_status' request. Memoized
+        executes are answered without reaching the pool.
+
+        :param handler: function taking (inputs, parameters), returning a dict of outputs (or yielding partial ones)
+        :param workers: number of workers (defaults to the number of cores)
+        :param executor: 'thread', 'process' (the handler and its inputs must be picklable) or a concurrent.futures.Executor to use
+        :param batch_handler: function taking (list of inputs, list of parameters), returning a list of outputs
+        """
+        if not self.__router:
+            self.__log.warn('serving one execute at a time, set the protocol to "router" to run them concurrently')
+            self.__serve_serially(handler, batch_handler)
+            return
+
+        self.__workers = workers if workers is not None else (os.cpu_count() or 1)
+        if executor == 'thread':
+            pool = concurrent.futures.ThreadPoolExecutor(self.__workers)
+        elif executor == 'process':
+            pool = concurrent.futures.ProcessPoolExecutor(self.__workers)
+        else:
+            pool = executor
+        processes = isinstance(pool, concurrent.futures.ProcessPoolExecutor)
+        self.__log.info('serving with {} {} workers'.format(self.__workers, 'process' if processes else 'thread'))
+
+        # workers finish on their own threads, so they queue up what to send and
+        # poke the loop through a pipe, the socket is only ever touched from here
+        finished = queue.Queue()
+        wake_r, wake_w = os.pipe()
+
+        def dispatch(fn, args, route, done):
+            """Run fn(*args) on the pool, calling done(future) from the loop when it's finished"""
+            if processes:
+                # views into zmq frames can't be pickled
+                args = [self.__picklable(arg) for arg in args]
+
+            dispatched = time.monotonic()
+            future = pool.submit(fn, *args)
+            self.__in_flight += 1
+            if self.__in_flight == self.__workers + 1:
+                self.__log.warn('worker pool saturated, executes are queueing')
+
+            def on_done(future):
+                finished.put((route, dispatched, lambda: done(future)))
+                os.write(wake_w, b'\0')
+            future.add_done_callback(on_done)
+
+        def reply_batch(route, results):
+            """Answer a batch once every item has a result"""
+            self.__reroute(route)
+            self.__send(Message(name='return_batch', payload={'results': results}, success=True), since=time.monotonic())
+
+        poller = zmq.Poller()
+        poller.register(self.__socket, zmq.POLLIN)
+        poller.register(wake_r, zmq.POLLIN)
+
+        shutdown = None
+        try:
+            while shutdown is None or self.__in_flight > 0 or len(self.__streams) > 0:
+                # wake up for the first stream to be left idle too long
+                idle = [stream['deadline'] for stream in self.__streams.values() if not stream['pulling']]
+                events = dict(poller.poll(max(0, int((min(idle) - time.monotonic()) * 1000)) if len(idle) > 0 else None))
+
+                now = time.monotonic()
+                for key in [key for key, stream in self.__streams.items() if not stream['pulling'] and stream['deadline'] <= now]:
+                    self.__log.warn('stream abandoned, requestor idle for {}ms'.format(STREAM_IDLE))
+                    self.__close_stream(key)
+
+                if wake_r in events:
+                    os.read(wake_r, 4096)
+                    while not finished.empty():
+                        route, dispatched, done = finished.get()
+                        self.__in_flight -= 1
+                        self.__reroute(route)
+                        # (including any time spent queued for a worker)
+                        self.__clock('user', dispatched)
+                        done()
+
+                # drain the backlog as well as the socket
+                while len(self.__backlog) > 0 or self.__socket.poll(0, zmq.POLLIN):
+                    msg = self.__recv()
+                    if msg is None:
+                        continue
+                    self.__log('received {}...'.format(msg.name))
+
+                    if msg.name in ('execute', 'execute_batch') and shutdown is None:
+                        started = time.monotonic()
+                        items = self.__items(msg)
+                        self.__clock('unpack', started)
+                        route = self.__route()
+                        if items is None:
+                            self.__log.error('received malformed execution request')
+                            self.__send(Message(name='malformed', success=False))
+                        elif msg.name == 'execute':
+                            inputs, parameters, key = items[0]
+                            cached = self.__recall(key)
+                            if cached is not None:
+                                self.__completed += 1
+                                self.__send(Message(name='return', payload=cached, success=True), since=time.monotonic())
+                            else:
+                                dispatch(_call_handler, (handler, inputs, parameters, not processes), route, lambda future, key=key: self.__reply(future, key))
+                        elif len(items) == 0:
+                            reply_batch(route, [])
+                        elif batch_handler is not None:
+                            dispatch(
+                                batch_handler,
+                                ([inputs for inputs, _, _ in items], [parameters for _, parameters, _ in items]),
+                                route,
+                                lambda future, route=route, count=len(items): reply_batch(route, self.__settle_batch(future, count))
+                            )
+                        else:
+                            # gather the items' results as they finish, answer with the last
+                            results = [None] * len(items)
+                            left = [len(items)]
+                            def gather(future, index, key, route=route, results=results, left=left):
+                                results[index] = self.__settle(future, key)
+                                left[0] -= 1
+                                if left[0] == 0:
+                                    reply_batch(route, results)
+                            for index, (inputs, parameters, key) in enumerate(items):
+                                cached = self.__recall(key)
+                                if cached is not None:
+                                    self.__completed += 1
+                                    results[index] = {'success': True, 'payload': cached}
+                                    left[0] -= 1
+                                else:
+                                    dispatch(
+                                        _call_handler,
+                                        (handler, inputs, parameters),
+                                        route,
+                                        lambda future, index=index, key=key, gather=gather: gather(future, index, key)
+                                    )
+                            if left[0] == 0:
+                                reply_batch(route, results)
+                    elif msg.name in ('execute', 'execute_batch'):
+                        self.__send(Message(name='shutting_down', success=False))
+                    elif msg.name == 'stream_next' and tuple(self.__envelope) in self.__streams:
+                        key = tuple(self.__envelope)
+                        stream = self.__streams[key]
+                        if stream['pulling']:
+                            self.__send(Message(name='busy', success=False))
+                        else:
+                            stream['pulling'] = True
+                            credit = max(1, int(msg.payload)) if msg.payload is not None else 1
+                            dispatch(_pull_chunks, (stream['chunks'], credit), self.__route(), lambda future, key=key: self.__chunk(future, key))
+                    elif msg.name == 'stream_cancel' and tuple(self.__envelope) in self.__streams:
+                        key = tuple(self.__envelope)
+                        self.__log.warn('stream cancelled by requestor')
+                        if self.__streams[key]['pulling']:
+                            # answered once the worker is done with it
+                            self.__streams[key]['cancel'] = self.__route()
+                        else:
+                            self.__close_stream(key)
+                            self.__send(Message(name='ack'))
+                    elif msg.name == 'get_cruxfile':
+                        self.__send(Message(name='ack', payload=self.cruxfile))
+                    elif msg.name == 'get_status':
+                        self.__send(Message(name='ack', payload=self.__status()))
+                    elif msg.name == 'shutdown':
+                        self.__log('shutting down once {} executes finish...'.format(self.__in_flight))
+                        shutdown = self.__route()
+                    else:
+                        self.__send(Message(name='nyi', success=False))
+        finally:
+            if pool is not executor:
+                pool.shutdown()
+            for key in list(self.__streams):
+                self.__close_stream(key)
+            os.close(wake_r)
+            os.close(wake_w)
+
+        self.__reroute(shutdown)
+        self.__send(Message(name='ack'))
+        self.__log('shutting down loop...')
+
+    def __serve_serially(self, handler, batch_handler=None):
+        """Serve executes with a handler function, one at a time
+
+        :param handler: function taking (inputs, parameters), returning a dict of outputs
+        :param batch_handler: function taking (list of inputs, list of parameters), returning a list of outputs
+        """
+        while True:
+            if batch_handler is None:
+                inputs, parameters, done = self.wait()
+                if done:
+                    return
+                try:
+                    self.output(handler(inputs, parameters))
+                except Exception as e:
+                    self.fail(repr(e))
+            else:
+                inputs, parameters, done = self.wait_batch()
+                if done:
+                    return
+                try:
+                    outputs = batch_handler(inputs, parameters)
+                except Exception as e:
+                    outputs = [e] * len(inputs)
+                self.output_batch(outputs)
+
+    def __picklable(self, obj):
+        """Copy views into zmq frames out of a dict of inputs (or a list of them)
+
+        :param obj: inputs, or list of inputs
+        :returns: the same, safe to pickle
+        """
+        if isinstance(obj, list):
+            return [self.__picklable(item) for item in obj]
+        if isinstance(obj, dict):
+            return {key: bytes(value) if isinstance(value, memoryview) else value for key, value in obj.items()}
+        return obj
+
+    def __settle(self, future, key=None):
+        """Turn a finished handler call into a batch item result, counting the execute completed
+
+        :param future: the finished handler call
+        :param key: memo key of the execute, to memoize the result under
+        :returns: {'success': ..., 'payload': packed outputs or the error}
+        """
+        started = time.monotonic()
+        error = future.exception()
+        result = self.__memorize(key, self.__result(error if error is not None else future.result()))
+        self.__clock('pack', started)
+        self.__completed += 1
+        return result
+
+    def __settle_batch(self, future, count):
+        """Turn a finished batch handler call into batch item results, counting each item completed
+
+        :param future: the finished batch handler call
+        :param count: number of items in the batch
+        :returns: list of {'success': ..., 'payload': ...}
+        """
+        started = time.monotonic()
+        outputs = future.exception()
+        if outputs is None:
+            outputs = future.result()
+            if not isinstance(outputs, list) or len(outputs) != count:
+                outputs = TypeError('batch handlers must return a list of {} outputs'.format(count))
+        if not isinstance(outputs, list):
+            outputs = [outputs] * count
+        results = [self.__result(output) for output in outputs]
+        self.__clock('pack', started)
+        self.__completed += count
+        return results
+
+    def __result(self, output):
+        """Pack the outcome of one run
+
+        :param output: dict of outputs, or an exception if the run failed
+        :returns: {'success': ..., 'payload': packed outputs or the error}
+        """
+        if not isinstance(output, (BaseException, dict)):
+            output = TypeError('handlers must return a dict of outputs')
+
+        if not isinstance(output, BaseException):
+            try:
+                return {'success': True, 'payload': self.__output_plan.pack(output)}
+            except (packing.PackingException, KeyError, ValueError, TypeError) as e:
+                output = e
+
+        self.__log.error('execute failed: {}'.format(repr(output)))
+        return {'success': False, 'payload': repr(output)}
+
+    def __reply(self, future, key=None):
+        """Answer an execute with the result of its handler
+
+        :param future: the finished handler call
+        :param key: memo key of the execute, to memoize the result under
+        """
+        if future.exception() is None and future.result() is not None and not isinstance(future.result(), dict):
+            # partial outputs go back as a stream (never memoized)
+            # (counted completed once the stream's over)
+            self.__open_stream(future.result())
+            return
+        result = self.__settle(future, key)
+        self.__send(Message(name='return', payload=result['payload'], success=result['success']), since=time.monotonic())
+
+    def __open_stream(self, chunks):
+        """Start streaming partial outputs from a worker back to the requestor
+
+        The requestor pulls chunks with 'stream_next' messages, as in __stream(), each
+        taking that many from the iterator on a worker (see __chunk()).
+
+        :param chunks: iterator of partial output dicts
+        """
+        key = tuple(self.__envelope)
+        if key in self.__streams:
+            # (the replies of both would come in over the same stream_next messages)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.__send(Message(name='return', payload='a stream is already open to this requestor', success=False), since=time.monotonic())
+            self.__completed += 1
+            return
+
+        self.__streams[key] = {'chunks': chunks, 'deadline': time.monotonic() + STREAM_IDLE / 1000, 'pulling': False, 'cancel': None}
+        self.__send(Message(name='stream', success=True), since=time.monotonic())
+        self.__log('streaming output...')
+
+    def __chunk(self, future, key):
+        """Answer a 'stream_next' with the partial outputs a worker took for it
+
+        :param future: the finished _pull_chunks() call
+        :param key: envelope of the stream's requestor
+        """
+        stream = self.__streams[key]
+        stream['pulling'] = False
+
+        started = time.monotonic()
+        error = future.exception()
+        done = True
+        if error is None:
+            pieces, done = future.result()
+            try:
+                reply = Message(name='chunk', payload={'chunks': [self.__output_plan.pack(piece) for piece in pieces], 'done': done}, success=True)
+            except (packing.PackingException, KeyError, ValueError, TypeError) as e:
+                error = e
+        if error is not None:
+            done = True
+            self.__log.error('stream failed: {}'.format(repr(error)))
+            reply = Message(name='chunk', payload=repr(error), success=False)
+        self.__clock('pack', started)
+        self.__send(reply, since=time.monotonic())
+        stream['deadline'] = time.monotonic() + STREAM_IDLE / 1000
+
+        if done or stream['cancel'] is not None:
+            self.__close_stream(key)
+            if stream['cancel'] is not None:
+                self.__reroute(stream['cancel'])
+                self.__send(Message(name='ack'))
+            self.__log('finished stream')
+
+    def __close_stream(self, key):
+        """Forget a stream, letting go of its handler, and count its execute completed
+
+        Every stream ends here, whether finished, failed, cancelled or abandoned.
+
+        :param key: envelope of the stream's requestor
+        """
+        chunks = self.__streams.pop(key)['chunks']
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        self.__completed += 1
+
+    def __status(self):
+        """Describe how busy this component is
+
+        :returns: dict with the number of workers, executes being run, executes queued for a worker, whether every worker is busy and executes completed (and the memo's counters, if memoizing)
+        """
+        busy = min(self.__in_flight, self.__workers)
+        status = {
+            'workers': self.__workers,
+            'busy': busy,
+            'queued': self.__in_flight - busy,
+            'saturated': busy >= self.__workers,
+            'completed': self.__completed
+        }
+        if self.__memo is not None:
+            status['memo'] = self.__memo.stats()
+        return status
 
     def output(self, output):
         """Returns data to the client
 
+        If output is an iterator (or any non-dict iterable) of partial outputs, it is
+        streamed back in chunks, pulled only as the receiver grants credit.
+
         :param output: the data to send back
         """
 
+        since = self.__finished()
+
+        # part of an unrolled batch
+        if self.__batch_results is not None:
+            self.__collect(output, since=since)
+            return
+
+        # partial outputs go back as a stream (never memoized, counted completed once it's over)
+        key, self.__memo_key = self.__memo_key, None
+        if output is not None and not isinstance(output, dict):
+            self.__stream(iter(output), since)
+            return
+
         # create the return message
         reply = Message(
             name='return',
@@ -144,15 +820,57 @@ class CruxClient:
         )
 
         # pack & send off
-        self.__socket.send(reply.pack(defs=self.cruxfile['outputs']))
+        if key is not None:
+            reply.payload = self.__memorize(key, {'success': True, 'payload': self.__output_plan.pack(output)})['payload']
+            self.__send(reply, since=since)
+        else:
+            self.__send(reply, defs=self.__output_plan, since=since)
         self.__dirty_socket = False
+        self.__completed += 1
         self.__log('returned output')
 
+    def output_batch(self, outputs):
+        """Returns the outputs of a whole batch (see wait_batch()) to the client
+
+        :param outputs: list of outputs in the order of the batch, each a dict of outputs or an exception (failing that item)
+        """
+        if not self.__batched:
+            # a plain execute, taken as a batch of one
+            if not isinstance(outputs, list) or len(outputs) != 1:
+                self.fail(repr(ValueError('expected 1 output, got {}'.format(len(outputs) if isinstance(outputs, list) else type(outputs).__name__))))
+            elif isinstance(outputs[0], BaseException):
+                self.fail(repr(outputs[0]))
+            else:
+                self.output(outputs[0])
+            return
+
+        since = self.__finished()
+        if not isinstance(outputs, list):
+            outputs = [TypeError('expected a list of {} outputs'.format(self.__batch_size))] * self.__batch_size
+        elif len(outputs) != self.__batch_size:
+            outputs = [ValueError('expected {} outputs, got {}'.format(self.__batch_size, len(outputs)))] * self.__batch_size
+
+        self.__send(Message(
+            name='return_batch',
+            payload={'results': [self.__result(output) for output in outputs]},
+            success=True
+        ), since=since)
+        self.__dirty_socket = False
+        self.__completed += len(outputs)
+        self.__log('returned batch of {} outputs'.format(len(outputs)))
+
     def fail(self, msg=None):
         """Fail the current operation
 
         :param msg: An optional message to tell the client what's up
         """
+        self.__memo_key = None
+        since = self.__finished()
+
+        # part of an unrolled batch
+        if self.__batch_results is not None:
+            self.__collect(msg, success=False, since=since)
+            return
 
         # create the return message
         reply = Message(
@@ -162,50 +880,218 @@ class CruxClient:
         )
 
         # pack & send off
-        self.__socket.send(reply.pack())
+        self.__send(reply, since=since)
         self.__dirty_socket = False
+        self.__completed += 1
         self.__log('returned error message')
 
-    def __defaultify(self, parameters):
-        """Fill in missing parameters with the defaults
+    def __collect(self, output, success=True, since=None):
+        """Record the outcome of one item of an unrolled batch, answering the batch after the last
 
-        :param parameters: Parameters recvd. from the requestor
-        :returns: filled in parameters
+        :param output: dict of outputs, or the failure message
+        :param success: whether the item succeeded
+        :param since: time.monotonic() when the item's run finished
+        """
+        key, self.__memo_key = self.__memo_key, None
+        if not success:
+            result = {'success': False, 'payload': output}
+        elif output is not None and not isinstance(output, dict):
+            result = {'success': False, 'payload': 'items of a batch cannot be streamed'}
+        else:
+            result = self.__memorize(key, {'success': True, 'payload': self.__output_plan.pack(output)})
+        self.__clock('pack', since)
+        self.__gather(result)
+
+    def __gather(self, result):
+        """Record the result of one item of an unrolled batch, answering the batch after the last
+
+        :param result: {'success': ..., 'payload': packed outputs or the error}
+        """
+        self.__batch_results.append(result)
+        self.__dirty_socket = False
+        self.__completed += 1
+
+        if len(self.__batch_results) == self.__batch_size:
+            self.__send(Message(name='return_batch', payload={'results': self.__batch_results}, success=True), since=time.monotonic())
+            self.__batch = None
+            self.__batch_results = None
+            self.__log('returned batch of {} outputs'.format(self.__batch_size))
+
+    def __stream(self, chunks, since=None):
+        """Stream partial outputs back to the requestor
+
+        The requestor pulls chunks with 'stream_next' messages, each granting some
+        credit; at most that many chunks are taken from the iterator per reply, so a
+        slow consumer never makes this side buffer more than it asked for. A requestor
+        which doesn't ask for more within STREAM_IDLE is taken to have gone, and the
+        stream is abandoned.
+
+        :param chunks: iterator of partial output dicts
+        :param since: time.monotonic() when the component's code handed the iterator over
+        """
+        # tell the requestor a stream is coming
+        self.__send(Message(name='stream', success=True), since=since)
+        self.__log('streaming output...')
+
+        done = False
+        deadline = time.monotonic() + STREAM_IDLE / 1000
+        while not done:
+            if not self.__socket.poll(max(0, int((deadline - time.monotonic()) * 1000)), zmq.POLLIN):
+                self.__log.warn('stream abandoned, requestor idle for {}ms'.format(STREAM_IDLE))
+                break
+
+            msg = self.__recv(backlog=False)
+            if msg is None:
+                continue
+            if msg.name == 'stream_next':
+                deadline = time.monotonic() + STREAM_IDLE / 1000
+                credit = max(1, int(msg.payload)) if msg.payload is not None else 1
+
+                # pull at most as many chunks as we've been granted
+                packed = []
+                try:
+                    while len(packed) < credit:
+                        started = time.monotonic()
+                        chunk = next(chunks)
+                        started = self.__clock('user', started)
+                        packed.append(self.__output_plan.pack(chunk))
+                        self.__clock('pack', started)
+                except StopIteration:
+                    done = True
+                except Exception as e:
+                    self.__log.error('stream failed: {}'.format(repr(e)))
+                    self.__send(Message(name='chunk', payload=repr(e), success=False), since=time.monotonic())
+                    break
+
+                self.__send(Message(
+                    name='chunk',
+                    payload={'chunks': packed, 'done': done},
+                    success=True
+                ), since=time.monotonic())
+            elif msg.name == 'stream_cancel':
+                self.__log.warn('stream cancelled by requestor')
+                self.__send(Message(name='ack'))
+                done = True
+            elif msg.name == 'get_cruxfile':
+                self.__send(Message(name='ack', payload=self.cruxfile))
+            elif self.__router:
+                # queued up behind the stream, answer it afterwards
+                self.__backlog.append((self.__envelope, msg))
+            else:
+                self.__send(Message(name='busy', success=False))
+
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        self.__dirty_socket = False
+        self.__completed += 1
+        self.__log('finished stream')
+
+    def __recv(self, backlog=True):
+        """Receive a message without copying its frames
+
+        Replies to it will be compressed with the same codec, if we support it, and
+        (in router mode) routed back to its sender, tagged with its request id.
+
+        Messages which can't be made sense of are answered 'malformed' straight away.
+
+        :param backlog: take requests queued up during a stream first
+        :returns: Message, or None if it was malformed (and has been answered)
+        """
+        self.__timing = {}
+        if backlog and len(self.__backlog) > 0:
+            envelope, msg = self.__backlog.popleft()
+        else:
+            frames = [frame.buffer for frame in self.__socket.recv_multipart(copy=False)]
+            envelope = []
+            if self.__router:
+                # everything up to the empty delimiter is the route back (the sender's identity, at least)
+                split = next((i + 1 for i, frame in enumerate(frames) if frame.nbytes == 0), 1)
+                envelope = [frame.tobytes() for frame in frames[:split]]
+                frames = frames[split:]
+
+            try:
+                msg = Message(data=frames)
+            except (MessageException, ValueError, TypeError, KeyError, IndexError):
+                self.__envelope, self.__request_id, self.__codec = envelope, None, None
+                self.__log.error('received malformed message')
+                self.__send(Message(name='malformed', success=False))
+                return None
+
+        self.__envelope = envelope
+        self.__request_id = msg.headers.get('id')
+        self.__codec = msg.codec if msg.codec in self.codecs else None
+        return msg
+
+    def __route(self):
+        """Get where replies to the last message received go
+
+        :returns: opaque route, to hand to __reroute() later
+        """
+        return (self.__envelope, self.__request_id, self.__codec, self.__timing)
+
+    def __reroute(self, route):
+        """Send the next reply to an earlier message
+
+        :param route: route from __route()
+        """
+        self.__envelope, self.__request_id, self.__codec, self.__timing = route
+
+    def __clock(self, phase, since):
+        """Charge the time since a moment to a phase of the request being answered
+
+        :param phase: phase of the request (see messaging.TIMING_PHASES)
+        :param since: time.monotonic() when the phase started (nothing is charged if None)
+        :returns: time.monotonic() now
         """
+        now = time.monotonic()
+        if since is not None and self.__timing is not None:
+            self.__timing[phase] = self.__timing.get(phase, 0.0) + (now - since) * 1000
+        return now
 
-        for param in self.cruxfile['parameters']:
-            if 'default' in self.cruxfile['parameters'][param] and (param not in parameters):
-                parameters[param] = self.cruxfile['parameters'][param]['default']
+    def __finished(self):
+        """Note that the component's code is done with the execute it was handed
 
-        return parameters
+        :returns: time.monotonic() now
+        """
+        now = self.__clock('user', self.__handed_out)
+        self.__handed_out = None
+        return now
 
-    def __combine(self, objs):
-        """Combine a number of objects, ordered from least to most important
+    def __send(self, msg, defs=None, since=None):
+        """Pack and send a reply to the last message received, handing binary frames to zmq without copying
 
-        :param objs: an array of objects
+        :param msg: Message to send
+        :param defs: I/O definitions to pack the payload with
+        :param since: if not none, time.monotonic() when packing the reply started; the request's timing is reported with it
         """
-        final = {}
-        for obj in objs:
-            for key in obj:
-                final[key] = obj[key]
+        if self.__request_id is not None:
+            msg.headers['id'] = self.__request_id
 
-        return final
+        stamp = None
+        if since is not None and self.__timing is not None:
+            stamp = lambda: {'timing': self.__stamp(since)}
 
-    def __open_all(self, filearr):
-        """Open all files specified
+        self.__socket.send_multipart(
+            self.__envelope + msg.pack(defs=defs, codec=self.__codec, transport=self.__transport, stamp=stamp),
+            copy=False
+        )
 
-        combining according to CruxClient#__combine()
+    def __stamp(self, since):
+        """Finish timing the request being answered, once its reply is packed
 
-        :param filearr: Array of files (or single file as str)
-        :returns: a combined object
+        :param since: time.monotonic() when packing the reply started
+        :returns: dict of phase -> ms
         """
-        if type(filearr) is str:
-            filearr = [filearr]
+        self.__clock('pack', since)
+        return self.__timing
 
-        pool = []
-        for f in filearr:
-            with open(f, 'r') as fp:
-                pool.append(json.load(fp))
+    def __defaultify(self, parameters):
+        """Fill in missing parameters with the defaults
 
-        return self.__combine(pool)
+        :param parameters: Parameters recvd. from the requestor
+        :returns: filled in parameters
+        """
 
+        filled = dict(self.__defaults)
+        filled.update(parameters)
+        return filled
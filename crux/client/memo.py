@@ -0,0 +1,347 @@
+##
+# Crux client result memoization
+# @author Patrick Kage
+
+import os
+import struct
+import hashlib
+import msgpack
+import tempfile
+import collections
+from crux.common import packing
+from crux.common.transport import FILE_EXT
+
+# memory budget for memoized results, in bytes
+MEMO_MAX_BYTES = 64 * 1024 * 1024
+# disk budget for memoized results, in bytes
+MEMO_MAX_DISK_BYTES = 1024 * 1024 * 1024
+
+class Memo:
+    """Cache of execute results, keyed by a hash of the inputs and parameters
+
+    Results are kept packed (as they'd go on the wire), in memory up to a byte
+    budget, least recently used first out. If given a directory, every result is
+    also written there (up to a budget of its own, again least recently used first
+    out), and results which fell out of memory (or were made by an earlier run of
+    the component) are read back from it.
+    """
+    max_bytes = None
+    max_disk_bytes = None
+    directory = None
+
+    # key -> (packed payload, size in bytes), least recently used first
+    __entries = None
+    __bytes = 0
+    __salt = None
+
+    # key -> size in bytes of the files on disk, least recently used first
+    __files = None
+    __disk_bytes = 0
+
+    # counters
+    __hits = 0
+    __disk_hits = 0
+    __misses = 0
+
+    def __init__(self, max_bytes=MEMO_MAX_BYTES, directory=None, salt='', max_disk_bytes=MEMO_MAX_DISK_BYTES):
+        """Create the cache
+
+        :param max_bytes: memory budget in bytes
+        :param directory: directory for the on-disk tier, or None to keep results in memory only
+        :param salt: mixed into every key, so results of different components (or versions) never mix
+        :param max_disk_bytes: disk budget in bytes, for the on-disk tier
+        """
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+        if self.directory is not None and not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        self.__entries = collections.OrderedDict()
+        self.__files = collections.OrderedDict()
+        self.__salt = salt.encode('utf-8')
+
+        if self.directory is not None:
+            self.__scan()
+
+    def key(self, inputs, parameters):
+        """Hash a set of inputs and parameters
+
+        The inputs are hashed as they arrive off the wire (before being unpacked for
+        the component's code), which doesn't depend on compression or transport.
+        Fields living in files (spilled or mapped, see crux.common.transport) are
+        hashed by where they are and when the file was last changed, rather than
+        read in to hash their contents.
+
+        :param inputs: the execute's inputs, msgpack-decoded
+        :param parameters: the parameters, with defaults filled in
+        :returns: hex digest, or None if the inputs can't be hashed
+        """
+        digest = hashlib.blake2b(self.__salt, digest_size=20)
+        try:
+            _feed(digest, inputs)
+            _feed(digest, parameters)
+        except TypeError:
+            return None
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Look up a result
+
+        :param key: key from key()
+        :returns: the packed payload, or None on a miss
+        """
+        if key in self.__entries:
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return _rewrap(self.__entries[key][0])
+
+        payload = self.__load(key)
+        if payload is not None:
+            self.__disk_hits += 1
+            self.__touch(key)
+            self.__remember(key, payload)
+            return _rewrap(payload)
+
+        self.__misses += 1
+        return None
+
+    def put(self, key, payload):
+        """Store a result
+
+        Buffers are copied, so the caller is free to reuse (or release) its own.
+
+        :param key: key from key()
+        :param payload: the packed payload (see IOPlan.pack)
+        """
+        payload = _rewrap(payload, copy=True)
+
+        if self.directory is not None:
+            self.__store(key, payload)
+
+        self.__remember(key, payload)
+
+    def stats(self):
+        """Describe how the cache is doing
+
+        :returns: dict of hits (from memory), disk_hits, misses, entries and bytes (in memory), and disk_entries and disk_bytes (on disk)
+        """
+        return {
+            'hits': self.__hits,
+            'disk_hits': self.__disk_hits,
+            'misses': self.__misses,
+            'entries': len(self.__entries),
+            'bytes': self.__bytes,
+            'disk_entries': len(self.__files),
+            'disk_bytes': self.__disk_bytes
+        }
+
+    def __remember(self, key, payload):
+        """Keep a result in memory, evicting the least recently used ones to fit
+
+        :param key: key from key()
+        :param payload: the packed payload, with its buffers owned by the cache
+        """
+        size = _size(payload)
+        if size > self.max_bytes:
+            return
+
+        if key in self.__entries:
+            self.__bytes -= self.__entries.pop(key)[1]
+        while self.__bytes + size > self.max_bytes:
+            self.__bytes -= self.__entries.popitem(last=False)[1][1]
+
+        self.__entries[key] = (payload, size)
+        self.__bytes += size
+
+    def __load(self, key):
+        """Read a result back from the on-disk tier
+
+        :param key: key from key()
+        :returns: the packed payload, or None if it isn't there
+        """
+        if self.directory is None:
+            return None
+
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as handle:
+                header, *frames = msgpack.unpackb(handle.read(), raw=True)
+        except (OSError, ValueError):
+            return None
+
+        return packing.unpack_object(header, frames=frames)
+
+    def __store(self, key, payload):
+        """Write a result to the on-disk tier, evicting the least recently used ones to fit
+
+        The file is written under a temporary name and moved into place, so nothing
+        (another replica sharing the directory included) ever reads half of it.
+
+        :param key: key from key()
+        :param payload: the packed payload
+        """
+        frames = []
+        header = packing.pack_object(payload, frames=frames)
+        data = msgpack.packb([header] + frames, use_bin_type=True)
+        if len(data) > self.max_disk_bytes:
+            return
+
+        self.__forget(key)
+        while self.__disk_bytes + len(data) > self.max_disk_bytes:
+            self.__forget(next(iter(self.__files)))
+
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as handle:
+                handle.write(data)
+            os.replace(temp, os.path.join(self.directory, key))
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return
+
+        self.__files[key] = len(data)
+        self.__disk_bytes += len(data)
+
+    def __forget(self, key):
+        """Remove a result from the on-disk tier
+
+        :param key: key from key()
+        """
+        if key not in self.__files:
+            return
+        self.__disk_bytes -= self.__files.pop(key)
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            # (already gone, e.g. evicted by another replica)
+            pass
+
+    def __touch(self, key):
+        """Mark a result on disk as just used, here and for later runs
+
+        :param key: key from key()
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        if key in self.__files:
+            self.__files.move_to_end(key)
+        else:
+            # (written by another replica sharing the directory)
+            self.__files[key] = size
+            self.__disk_bytes += size
+
+    def __scan(self):
+        """Take stock of the results an earlier run left on disk, oldest first, trimming them to the budget"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, key, size in sorted(found):
+            self.__files[key] = size
+            self.__disk_bytes += size
+        while self.__disk_bytes > self.max_disk_bytes:
+            self.__forget(next(iter(self.__files)))
+
+def _feed(digest, obj):
+    """Feed an object into a hash, in a form that doesn't depend on dict ordering
+
+    :param digest: hashlib object
+    :param obj: msgpack-decoded object (Frames included)
+    :raises TypeError: on anything else
+    """
+    if obj is None:
+        digest.update(b'n')
+    elif isinstance(obj, bool):
+        digest.update(b't' if obj else b'f')
+    elif isinstance(obj, int):
+        data = str(obj).encode('ascii')
+        digest.update(b'i' + struct.pack('!I', len(data)) + data)
+    elif isinstance(obj, float):
+        digest.update(b'd' + struct.pack('!d', obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        digest.update(b's' + struct.pack('!Q', len(data)) + data)
+    elif isinstance(obj, packing.Frame) and _file_ref(obj) is not None:
+        path, offset, length, mtime = _file_ref(obj)
+        data = path.encode('utf-8')
+        digest.update(b'r' + struct.pack('!Q', len(data)) + data + struct.pack('!QQQ', offset, length, mtime))
+    elif isinstance(obj, (bytes, bytearray, memoryview, packing.Frame)):
+        data = memoryview(obj.buffer if isinstance(obj, packing.Frame) else obj).cast('B')
+        digest.update(b'b' + struct.pack('!Q', data.nbytes))
+        digest.update(data)
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b'l' + struct.pack('!Q', len(obj)))
+        for item in obj:
+            _feed(digest, item)
+    elif isinstance(obj, dict):
+        digest.update(b'm' + struct.pack('!Q', len(obj)))
+        for key in sorted(obj, key=str):
+            _feed(digest, key)
+            _feed(digest, obj[key])
+    else:
+        raise TypeError('cannot hash {}'.format(type(obj).__name__))
+
+def _file_ref(frame):
+    """Find where in a file a Frame lives, if it was sent as a reference to one
+
+    :param frame: packing.Frame
+    :returns: (path, offset, length, mtime in ns), or None if it doesn't live in a file (or the file has gone)
+    """
+    if frame.ref is None or frame.ref[0].code != FILE_EXT:
+        return None
+    path, offset, length, _ = msgpack.unpackb(frame.ref[0].data, encoding='utf-8')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    return path, offset, length, mtime
+
+def _rewrap(obj, copy=False):
+    """Copy a packed payload's structure, with fresh Frames
+
+    Sending a Frame may pin it to wherever a transport put it, which mustn't stick
+    to the cached one.
+
+    :param obj: packed payload
+    :param copy: whether to copy the buffers too (dropping any reference to where they live)
+    :returns: the copy
+    """
+    if isinstance(obj, packing.Frame):
+        if copy:
+            return packing.Frame(bytes(memoryview(obj.buffer).cast('B')))
+        return packing.Frame(obj.buffer)
+    if isinstance(obj, list):
+        return [_rewrap(item, copy) for item in obj]
+    if isinstance(obj, dict):
+        return {key: _rewrap(obj[key], copy) for key in obj}
+    return obj
+
+def _size(obj):
+    """Rough size in memory of a packed payload
+
+    :param obj: packed payload
+    :returns: bytes
+    """
+    if isinstance(obj, packing.Frame):
+        return len(obj)
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return 8 + sum(_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return 8 + sum(_size(key) + _size(obj[key]) for key in obj)
+    return 8
@@ -4,3 +4,6 @@ from . import logging
 from . import messaging
 from . import exception
 from . import manipulation
+from . import table
+from . import transport
+from . import description
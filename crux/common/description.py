@@ -0,0 +1,69 @@
+##
+# crux component description (cruxfile) loading
+# @author Patrick Kage
+
+import os
+import json
+from crux.common import packing
+
+def combine(objs):
+    """Combine a number of objects, ordered from least to most important
+
+    :param objs: an array of objects
+    :returns: a combined object
+    """
+    final = {}
+    for obj in objs:
+        for key in obj:
+            final[key] = obj[key]
+
+    return final
+
+def open_all(filearr, base=''):
+    """Open all files specified
+
+    combining according to combine()
+
+    :param filearr: Array of files (or single file as str)
+    :param base: directory relative paths are resolved against
+    :returns: a combined object
+    """
+    if type(filearr) is str:
+        filearr = [filearr]
+
+    pool = []
+    for f in filearr:
+        with open(os.path.join(base, f), 'r') as fp:
+            pool.append(json.load(fp))
+
+    return combine(pool)
+
+def load_cruxfile(description='crux.json'):
+    """Load a cruxfile, fully resolved
+
+    The input, output and parameter sub-files are opened and merged in, and the
+    codecs list is narrowed down to the ones this crux supports (and the protocol
+    defaulted). This is exactly what a component answers a 'get_cruxfile' request
+    with.
+
+    :param description: path of the cruxfile, sub-files are relative to its directory
+    :raises OSError: if the cruxfile or a sub-file can't be opened
+    :raises ValueError: if the cruxfile or a sub-file isn't valid json
+    :raises KeyError: if the cruxfile is missing inputs, outputs or parameters
+    :returns: the cruxfile
+    """
+    base = os.path.dirname(description)
+    with open(description, 'r') as cfile:
+        cruxfile = json.load(cfile)
+
+    cruxfile['inputs'] = open_all(cruxfile['inputs'], base)
+    cruxfile['outputs'] = open_all(cruxfile['outputs'], base)
+    cruxfile['parameters'] = open_all(cruxfile['parameters'], base)
+
+    # compression codecs we'll accept (and reply with)
+    cruxfile['codecs'] = [codec for codec in cruxfile.get('codecs', []) if codec in packing.CODECS]
+
+    # how requestors should talk to the component, see CruxClient
+    cruxfile['protocol'] = cruxfile.get('protocol', 'rep')
+
+    return cruxfile
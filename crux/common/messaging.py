@@ -3,6 +3,7 @@
 # @author Patrick Kage
 
 import json
+import time
 import msgpack
 from crux.common import packing
 from crux.common.exception import CruxException
@@ -10,13 +11,74 @@ from crux.common.exception import CruxException
 class MessageException(CruxException):
     pass
 
+# phases of a request reported in a reply's 'timing' header, in the order they happen.
+# components report unpack (decoding the request), user (their own code) and pack
+# (encoding the reply), requestors add network (everything else: sending, queueing
+# and, for streams, waiting on the consumer)
+TIMING_PHASES = ['network', 'unpack', 'user', 'pack']
+
+def time_reply(reply, sent):
+    """Complete the timing a component reported in a reply, from the requestor's side
+
+    :param reply: the reply
+    :param sent: time.monotonic() when the request was sent (None if unknown)
+    :returns: the reply, with 'network' and 'total' (ms) added to its 'timing' header, if it has one
+    """
+    timing = reply.headers.get('timing')
+    if sent is not None and isinstance(timing, dict):
+        total = (time.monotonic() - sent) * 1000
+        timing['network'] = max(0.0, total - sum(timing.get(phase, 0.0) for phase in TIMING_PHASES[1:]))
+        timing['total'] = total
+    return reply
+
+def merge_timing(into, timing, phases=None):
+    """Add up the timing of several replies (e.g. the pieces of a stream)
+
+    :param into: dict of phase -> ms to add to
+    :param timing: 'timing' header of a reply (or None)
+    :param phases: phases to add, defaults to all of them
+    :returns: into
+    """
+    if isinstance(timing, dict):
+        for phase in timing:
+            if phases is None or phase in phases:
+                into[phase] = into.get(phase, 0.0) + timing[phase]
+    return into
+
+def format_timing(timing):
+    """Describe where the time of a request went
+
+    :param timing: 'timing' header of a reply
+    :returns: str
+    """
+    phases = ['{} {:.2f}ms'.format(phase, timing[phase]) for phase in TIMING_PHASES if phase in timing]
+    if 'total' in timing:
+        return '{} (total {:.2f}ms)'.format(', '.join(phases), timing['total'])
+    return ', '.join(phases)
+
 class Message:
-    """Message class to facilitate messaging between all crux components"""
+    """Message class to facilitate messaging between all crux components
+
+    On the wire, a message is a list of frames:
+
+     - a small msgpack header (name, success, codec and a map of extra headers)
+     - the msgpack payload (empty if there is none)
+     - any out-of-band buffers (binary I/O fields) the payload references by index
+
+    The payload is only decoded on first access, so routing on the header (or
+    forwarding the message untouched) never pays for decoding the payload.
+    """
     name = None
-    payload = None
     success = None
+    codec = None
+    headers = None
 
-    def __init__(self, data=None, name=None, payload=None, success=None):
+    # decoded payload, or the raw frames it will be decoded from
+    __payload = None
+    __raw = None
+
+    def __init__(self, data=None, name=None, payload=None, success=None, headers=None):
+        self.headers = headers if headers is not None else {}
         if name is not None:
             self.name = name
             if payload is not None:
@@ -26,51 +88,127 @@ class Message:
         elif data is not None:
             self.unpack(data)
 
+    @property
+    def payload(self):
+        """The message payload, decoded on first access
+
+        :raises MessageException: if the payload can't be decoded
+        """
+        if self.__raw is not None:
+            frame, attachments, defs = self.__raw
+            try:
+                payload = packing.unpack_object(frame, frames=attachments)
+            except ValueError:
+                raise MessageException('Failed to unpack message payload!')
+            if defs is not None:
+                payload = packing.unpack_io_object(payload, defs)
+            self.__payload = payload
+            self.__raw = None
+        return self.__payload
+
+    @payload.setter
+    def payload(self, payload):
+        self.__payload = payload
+        self.__raw = None
+
     def unpack(self, data, defs=None):
         """Unpack some data into this object
 
-        :param data: some msgpack-able data
-        :param defs: If not none, unpack this obj efficiently according to the definitions
+        Only the header is decoded here, the payload is decoded on first access.
+
+        :param data: a list of frames (header first), or a single header frame
+        :param defs: If not none, unpack this obj efficiently according to the definitions (or a packing.IOPlan)
         """
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        if len(data) == 0:
+            raise MessageException('Failed to unpack message!')
+
         try:
-            data = packing.unpack_object(data)
-        except ValueError:
+            header = packing.unpack_object(data[0])
+            self.name = header['name']
+        except (ValueError, TypeError, KeyError):
             raise MessageException('Failed to unpack message!')
 
-        self.name = data['name']
-        self.success = data['success'] if 'success' in data else True
-        if 'payload' in data:
-            if defs is None:
-                self.payload = data['payload']
-            else:
-                self.payload = packing.unpack_io_object(data['payload'], defs)
+        self.success = header['success'] if 'success' in header else True
+        self.codec = header['codec'] if 'codec' in header else None
+        self.headers = header['headers'] if 'headers' in header else {}
+
+        # hang onto the payload frame until someone asks for it
+        if len(data) > 1 and memoryview(data[1]).nbytes > 0:
+            self.__payload = None
+            self.__raw = (data[1], data[2:], defs)
         else:
             self.payload = None
 
-    def pack(self, defs=None):
+    def pack(self, defs=None, codec=None, transport=None, stamp=None):
         """Pack this object
 
-        :param defs: If not none, pack this obj efficiently according to the definitions
-        :returns: a binary string containing this message
+        A payload that was received and never accessed is forwarded as-is, without
+        being decoded and re-encoded.
+
+        :param defs: If not none, pack this obj efficiently according to the definitions (or a packing.IOPlan)
+        :param codec: If not none, compress large payloads/frames with this codec (see packing.CODECS)
+        :param transport: If not none, move large frames out of the message with this transport (see crux.common.transport)
+        :param stamp: If not none, called once the payload is packed, returning extra headers (e.g. how long that took)
+        :returns: a list of frames, the header, the payload, then any out-of-band buffers
         """
         if self.name is None:
             # enforce message naming
             raise MessageException('Message must have a name!')
 
-        out = {'name': self.name}
-        if self.payload is not None:
-            if defs is None:
-                out['payload'] = self.payload
+        passthrough = self.__raw is not None and self.__raw[2] is None and defs is None
+
+        frames = []
+        exports = []
+        try:
+            if passthrough:
+                # untouched payload, pass it straight through
+                payload = self.__raw[0]
+                frames = list(self.__raw[1])
             else:
-                out['payload'] = packing.pack_io_object(self.payload, defs)
-        if self.success is not None:
-            out['success'] = self.success
+                payload = self.payload
+                if payload is None:
+                    payload = b''
+                else:
+                    if defs is not None:
+                        payload = packing.pack_io_object(payload, defs)
+                    payload = packing.pack_object(
+                        payload,
+                        frames=frames,
+                        codec=codec,
+                        transport=transport,
+                        exports=exports
+                    )
+
+            header = {'name': self.name}
+            if self.success is not None:
+                header['success'] = self.success
+            if codec is not None:
+                header['codec'] = codec
+
+            # the receiver (or whoever runs the pipeline) needs to know what the payload points to
+            headers = self.headers
+            if not passthrough and 'exports' in headers:
+                headers = {key: headers[key] for key in headers if key != 'exports'}
+            if len(exports) > 0:
+                headers = dict(headers)
+                headers['exports'] = exports
+            if stamp is not None:
+                headers = dict(headers)
+                headers.update(stamp())
+            if len(headers) > 0:
+                header['headers'] = headers
+
+            header = packing.pack_object(header)
+        except ValueError as ve:
+            raise MessageException('Failed to pack message: {}'.format(ve))
 
-        return packing.pack_object(out)
+        return [header, payload] + frames
 
     def __repr__(self):
         return '<Message name="{}", payload={}, success={}>'.format(
             self.name,
-            json.dumps(self.payload) if self.payload is not None else self.payload,
+            json.dumps(self.payload, default=repr) if self.payload is not None else self.payload,
             self.success
         )
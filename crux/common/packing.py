@@ -4,68 +4,478 @@
 
 import io
 import csv
+import bz2
+import lzma
+import zlib
+import struct
 import msgpack
-import binascii
+from crux.common.exception import CruxException
 
-def pack_object(obj):
-    return msgpack.packb(obj)
+# msgpack extension code marking a reference to an out-of-band frame
+FRAME_EXT = 1
+# msgpack extension code marking a compressed object
+COMPRESSED_EXT = 2
 
-def unpack_object(binary):
-    return msgpack.unpackb(binary, encoding='utf-8')
+# supported compression codecs, in order of preference
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'bz2':  (bz2.compress, bz2.decompress)
+}
+CODEC_PREFERENCE = ['zlib', 'lzma', 'bz2']
+
+# objects and frames smaller than this (in bytes) are never compressed
+COMPRESS_THRESHOLD = 4096
+
+class PackingException(CruxException):
+    """An I/O object does not match its definition"""
+
+class Frame:
+    """A buffer carried out-of-band as its own message frame
+
+    Inside a packed envelope this is only an index into the message's frame list,
+    so the buffer itself is never copied into (or hex-encoded within) the envelope.
+    """
+    buffer = None
+    ref = None
+    owner = None
+
+    def __init__(self, buffer, ref=None, owner=None):
+        """Wrap a buffer
+
+        :param buffer: any object supporting the buffer protocol (bytes, memoryview, etc.)
+        :param ref: (msgpack ExtType, handle) if the buffer already lives somewhere a peer can reach (see crux.common.transport), the handle being None if nobody should release it
+        :param owner: object holding the memory the buffer views (e.g. a shared memory segment), closed by release()
+        """
+        self.buffer = buffer
+        self.ref = ref
+        self.owner = owner
+
+    def __len__(self):
+        return memoryview(self.buffer).nbytes
+
+    def release(self):
+        """Drop the buffer, closing what it lives in if no other views into it remain"""
+        if isinstance(self.buffer, memoryview):
+            self.buffer.release()
+        self.buffer = None
+
+        if self.owner is not None:
+            try:
+                self.owner.close()
+            except BufferError:
+                # still viewed elsewhere, the memory goes when the last view does
+                pass
+            self.owner = None
+
+    def __repr__(self):
+        return '<Frame {} bytes>'.format(len(self))
+
+def negotiate_codec(offered):
+    """Pick a compression codec out of the ones a peer supports
+
+    :param offered: list of codec names the peer supports (e.g. the cruxfile's 'codecs')
+    :returns: the first offered codec we support, or None
+    """
+    for codec in offered:
+        if codec in CODECS:
+            return codec
+    return None
+
+def _codec(codec):
+    """Look up a codec
+
+    :param codec: codec name
+    :raises ValueError: on an unknown codec
+    :returns: (compress, decompress)
+    """
+    if codec not in CODECS:
+        raise ValueError('unknown codec "{}"'.format(codec))
+    return CODECS[codec]
+
+def pack_object(obj, frames=None, codec=None, threshold=COMPRESS_THRESHOLD, transport=None, exports=None):
+    """Pack an object into msgpack
+
+    If a codec is given, the packed object and any frames are compressed once they
+    reach the threshold. Compressed data records the codec it was compressed with,
+    so unpack_object needs no extra information.
+
+    If a transport is given (see crux.common.transport), it may take frames out of
+    the message entirely, leaving only a reference to where they were put. Frames
+    which already live in such a place are always sent as references.
+
+    :param obj: object to pack
+    :param frames: if not None, a list to append the buffers of any Frame objects to
+    :param codec: compression codec (see CODECS), or None for no compression
+    :param threshold: minimum size in bytes to bother compressing
+    :param transport: out-of-band transport for large frames, or None to send them inline
+    :param exports: if not None, a list to append the handles of any referenced (not inline) frames to
+    :returns: msgpack bytes
+    :raises TypeError: if the object contains unpackable types
+    :raises ValueError: on an unknown codec
+    """
+    compress = _codec(codec)[0] if codec is not None else None
+
+    def attach(item):
+        if not isinstance(item, Frame) or frames is None:
+            raise TypeError('unable to pack {}'.format(repr(item)))
+
+        if item.ref is None and transport is not None:
+            item.ref = transport.export(item)
+        if item.ref is not None:
+            ext, handle = item.ref
+            if exports is not None and handle is not None:
+                exports.append(handle)
+            return ext
+
+        ref = struct.pack('!I', len(frames))
+        if compress is not None and len(item) >= threshold:
+            frames.append(compress(item.buffer))
+            ref += codec.encode('ascii')
+        else:
+            frames.append(item.buffer)
+        return msgpack.ExtType(FRAME_EXT, ref)
+
+    packed = msgpack.packb(obj, default=attach, use_bin_type=True)
+    if compress is not None and len(packed) >= threshold:
+        packed = msgpack.packb(
+            msgpack.ExtType(COMPRESSED_EXT, codec.encode('ascii') + b'\0' + compress(packed)),
+            use_bin_type=True
+        )
+
+    return packed
+
+def unpack_object(binary, frames=None):
+    """Unpack a msgpack object
+
+    :param binary: msgpack data (anything supporting the buffer protocol)
+    :param frames: out-of-band frames referenced by the object
+    :returns: the unpacked object, with frame references resolved to Frame objects
+    :raises ValueError: on malformed data, unknown codecs or dangling frame references
+    """
+    def resolve(code, data):
+        if code == COMPRESSED_EXT:
+            codec, data = data.split(b'\0', 1)
+            return unpack_object(_codec(codec.decode('ascii'))[1](data), frames=frames)
+        if code != FRAME_EXT:
+            # might be a reference to a buffer placed by a transport
+            from crux.common import transport
+            frame = transport.resolve(code, data)
+            return frame if frame is not None else msgpack.ExtType(code, data)
+
+        idx, = struct.unpack('!I', data[:4])
+        if frames is None or idx >= len(frames):
+            raise ValueError('reference to missing frame {}'.format(idx))
+        if len(data) > 4:
+            return Frame(_codec(data[4:].decode('ascii'))[1](frames[idx]))
+        return Frame(frames[idx])
+
+    try:
+        return msgpack.unpackb(binary, ext_hook=resolve, encoding='utf-8')
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise ValueError('failed to decompress: {}'.format(e))
+
+def _check_shape(shape, expected):
+    """Check a shape against a declared shape, where None matches any extent
+
+    :param shape: actual shape
+    :param expected: declared shape, or None to accept any
+    :returns: True if it matches
+    """
+    if expected is None:
+        return True
+    if len(shape) != len(expected):
+        return False
+    for extent, constraint in zip(shape, expected):
+        if constraint is not None and extent != constraint:
+            return False
+    return True
+
+def pack_ndarray(arr, definition):
+    """Pack a numpy array as a small header and its raw buffer
+
+    :param arr: the array (or anything numpy can turn into one)
+    :param definition: the I/O definition, optionally containing 'dtype' and 'shape'
+    :returns: header dict with the buffer attached as a Frame
+    :raises PackingException: if the array violates the definition
+    """
+    import numpy as np
+
+    arr = np.asarray(arr)
+    if 'dtype' in definition:
+        dtype = np.dtype(definition['dtype'])
+        if arr.dtype != dtype:
+            if not np.can_cast(arr.dtype, dtype, casting='safe'):
+                raise PackingException('cannot safely cast {} to {}'.format(arr.dtype, dtype))
+            arr = arr.astype(dtype)
+    if arr.dtype.hasobject:
+        raise PackingException('object arrays cannot be sent as ndarray')
+    if not _check_shape(arr.shape, definition.get('shape')):
+        raise PackingException('shape {} does not match {}'.format(list(arr.shape), definition['shape']))
+
+    # only copies if the array isn't already laid out in C order (keeping 0-d arrays 0-d)
+    arr = np.require(arr, requirements='C')
+
+    return {
+        'dtype': arr.dtype.str,
+        'shape': list(arr.shape),
+        'data': Frame(arr.reshape(-1).view(np.uint8))
+    }
+
+def unpack_ndarray(header, definition):
+    """Rebuild a numpy array over its received buffer, without copying
+
+    Arrays received off the wire are read-only views of the message frame.
+
+    :param header: header dict produced by pack_ndarray
+    :param definition: the I/O definition, optionally containing 'dtype' and 'shape'
+    :returns: numpy array
+    :raises PackingException: if the array violates the definition
+    """
+    import numpy as np
+
+    dtype = np.dtype(header['dtype'])
+    if 'dtype' in definition and dtype != np.dtype(definition['dtype']):
+        raise PackingException('dtype {} does not match {}'.format(dtype, definition['dtype']))
+    if not _check_shape(header['shape'], definition.get('shape')):
+        raise PackingException('shape {} does not match {}'.format(header['shape'], definition['shape']))
+
+    data = header['data']
+    data = data.buffer if isinstance(data, Frame) else data
+
+    return np.frombuffer(data, dtype=dtype).reshape(header['shape'])
+
+def pack_table(table, definition):
+    """Pack a table as per-column typed buffers
+
+    :param table: a crux.common.table.Table, or a dict of columns
+    :param definition: the I/O definition, optionally containing 'schema' (column order) and 'dtypes'
+    :returns: header dict with the column buffers attached as Frames
+    :raises PackingException: if the table violates the definition, or a column can't be converted to its dtype
+    """
+    import numpy as np
+    from crux.common.table import Table, StringColumn, TableException
+
+    schema = definition.get('schema')
+    dtypes = definition.get('dtypes', {})
+    try:
+        if isinstance(table, Table):
+            # (columns already of their dtype are left as they are)
+            table = Table(table.columns, schema=table.schema, dtypes=dtypes)
+        else:
+            table = Table(table, schema=schema, dtypes=dtypes)
+    except TableException as te:
+        raise PackingException(te.msg)
+    if schema is not None and set(schema) != set(table.schema):
+        raise PackingException('columns {} do not match schema {}'.format(table.schema, schema))
+
+    columns = {}
+    for name in table.schema:
+        col = table[name]
+        if isinstance(col, StringColumn):
+            columns[name] = {
+                'dtype': 'str',
+                'offsets': pack_ndarray(col.offsets, {'dtype': 'int64'}),
+                'data': Frame(col.data)
+            }
+        else:
+            columns[name] = pack_ndarray(col, {'dtype': dtypes[name]} if name in dtypes else {})
+
+    return {
+        'schema': schema if schema is not None else table.schema,
+        'length': len(table),
+        'columns': columns
+    }
+
+def unpack_table(header, definition):
+    """Rebuild a table over its received column buffers, without copying
+
+    :param header: header dict produced by pack_table
+    :param definition: the I/O definition, optionally containing 'schema' and 'dtypes'
+    :returns: crux.common.table.Table
+    :raises PackingException: if the table violates the definition
+    """
+    from crux.common.table import Table, StringColumn
+
+    schema = definition.get('schema', header['schema'])
+    if set(schema) != set(header['columns']):
+        raise PackingException('columns {} do not match schema {}'.format(list(header['columns']), schema))
+
+    dtypes = definition.get('dtypes', {})
+    columns = {}
+    for name in schema:
+        col = header['columns'][name]
+        if (col['dtype'] == 'str') != (dtypes.get(name, col['dtype']) == 'str'):
+            raise PackingException('column {} has dtype {}, not {}'.format(name, col['dtype'], dtypes[name]))
+        if col['dtype'] == 'str':
+            data = col['data'].buffer if isinstance(col['data'], Frame) else col['data']
+            columns[name] = StringColumn(unpack_ndarray(col['offsets'], {}), data)
+        else:
+            columns[name] = unpack_ndarray(col, {'dtype': dtypes[name]} if name in dtypes else {})
+
+    return Table(columns, schema=schema)
+
+def pack_csv(rows, definition):
+    """Pack row-major tabular data as a csv string
+
+    :param rows: list of rows
+    :param definition: the I/O definition
+    :returns: csv string
+    """
+    # create a string object to write to
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerows(rows)
+    return out.getvalue()
+
+def unpack_csv(data, definition):
+    """Unpack a csv string into a list of rows
+
+    :param data: csv string
+    :param definition: the I/O definition
+    :returns: list of rows
+    """
+    return list(csv.reader(io.StringIO(data)))
+
+def pack_binary(data, definition):
+    """Send binary out-of-band, untouched
+
+    :param data: buffer
+    :param definition: the I/O definition
+    :returns: Frame
+    """
+    return data if isinstance(data, Frame) else Frame(data)
+
+def unpack_binary(data, definition):
+    """Hand back the received buffer (a memoryview when off the wire)
+
+    :param data: Frame
+    :param definition: the I/O definition
+    :returns: buffer
+    """
+    return data.buffer if isinstance(data, Frame) else data
+
+# (packer, unpacker) for each I/O type, text/json need no processing
+IO_TYPES = {
+    'csv':     (pack_csv, unpack_csv),
+    'binary':  (pack_binary, unpack_binary),
+    'ndarray': (pack_ndarray, unpack_ndarray),
+    'table':   (pack_table, unpack_table),
+    'text':    (None, None),
+    'json':    (None, None)
+}
+
+class IOPlan:
+    """A compiled pack/unpack plan for a set of I/O definitions
+
+    Built once per set of definitions (input.json, etc.), so that per-message packing is a
+    single dict lookup per field rather than a walk over the definitions.
+    """
+    defs = None
+    __packers = None
+    __unpackers = None
+
+    def __init__(self, defs):
+        """Compile the plan
+
+        :param defs: key definitions (input.json, etc.)
+        """
+        self.defs = defs
+        self.__packers = {}
+        self.__unpackers = {}
+        for key in defs:
+            packer, unpacker = IO_TYPES.get(defs[key]['type'], (None, None))
+            self.__packers[key] = self.__bind(packer, defs[key])
+            self.__unpackers[key] = self.__bind(unpacker, defs[key])
+
+    def __bind(self, fn, definition):
+        """Bind a definition to a packer/unpacker
+
+        :param fn: the packer/unpacker, or None for passthrough
+        :param definition: the field's I/O definition
+        :returns: single-argument function, or None for passthrough
+        """
+        if fn is None:
+            return None
+        return lambda value: fn(value, definition)
+
+    def __apply(self, obj, fns):
+        out = {}
+        for key in obj:
+            try:
+                fn = fns[key]
+            except KeyError:
+                raise KeyError('key \'{}\' not in defs!'.format(key))
+            out[key] = obj[key] if fn is None else fn(obj[key])
+        return out
+
+    def pack(self, obj):
+        """Pack an I/O object
+
+        :param obj: object to pack
+        :returns: interstitial representation of the object
+        :raises KeyError: if the key is not in the key definitions
+        """
+        return self.__apply(obj, self.__packers)
+
+    def unpack(self, obj):
+        """Unpack an I/O object
+
+        :param obj: interstitial to unpack
+        :returns: unpacked I/O object
+        :raises KeyError: if the key is not in the key definitions
+        """
+        return self.__apply(obj, self.__unpackers)
 
 def pack_io_object(obj, defs):
     """Pack an I/O object efficiently
 
+    Binary fields (and ndarray/table buffers) are wrapped as Frames, so they travel as separate zero-copy frames.
+
     :param obj: object to pack
-    :param defs: key definitions (input.json, etc.)
+    :param defs: key definitions (input.json, etc.), or a precompiled IOPlan
     :returns: interstitial representation of the object
     :raises KeyError: if the key is not in the key definitions
     """
-
-    prepacked = {}
-    for key in obj:
-        if not key in defs:
-            raise KeyError('key \'{}\' not in defs!'.format(key))
-
-        if defs[key]['type'] == 'csv':
-            # create a string object to write to
-            out = io.StringIO()
-            writer = csv.writer(out)
-            writer.writerows(obj[key])
-            prepacked[key] = out.getvalue()
-        elif defs[key]['type'] == 'binary':
-            # store binary as hex
-            prepacked[key] = binascii.hexlify(obj['key'])
-        else:
-            # text/json need no processing
-            prepacked[key] = obj[key]
-
-    return prepacked
+    if not isinstance(defs, IOPlan):
+        defs = IOPlan(defs)
+    return defs.pack(obj)
 
 def unpack_io_object(obj, defs):
     """Unpack an I/O object efficiently
 
     :param obj: interstitial to unpack
-    :param defs: key definitions (input.json, etc.)
+    :param defs: key definitions (input.json, etc.), or a precompiled IOPlan
     :returns: unpacked I/O object
     :raises KeyError: if the key is not in the key definitions
     """
+    if not isinstance(defs, IOPlan):
+        defs = IOPlan(defs)
+    return defs.unpack(obj)
+
+def join_chunks(chunks):
+    """Join a stream of partial (interstitial) outputs into one output
+
+    Text and csv chunks are concatenated, binary chunks are joined into one buffer,
+    lists are extended, and any other field takes its last value.
+
+    :param chunks: iterable of partial output dicts
+    :returns: the combined output dict
+    """
+    parts = {}
+    for chunk in chunks:
+        for key in chunk:
+            parts.setdefault(key, []).append(chunk[key])
 
     out = {}
-    for key in obj:
-        if not key in defs:
-            raise KeyError('key \'{}\' not in defs!'.format(key))
-
-        if defs[key]['type'] == 'csv':
-            # create a string object to read from
-            csv_f = io.StringIO(obj[key])
-            reader = csv.reader(csv_f)
-            out[key] = list(reader)
-        elif defs[key]['type'] == 'binary':
-            # store binary as hex
-            out[key] = binascii.unhexlify(obj['key'])
+    for key in parts:
+        values = parts[key]
+        if all(isinstance(v, str) for v in values):
+            out[key] = ''.join(values)
+        elif all(isinstance(v, Frame) for v in values):
+            out[key] = values[0] if len(values) == 1 else Frame(b''.join(v.buffer for v in values))
+        elif all(isinstance(v, list) for v in values):
+            out[key] = [item for v in values for item in v]
         else:
-            # text/json need no processing
-            out[key] = obj[key]
+            out[key] = values[-1]
     return out
-
@@ -3,6 +3,9 @@
 # @author Patrick Kage
 
 import zmq
+import time
+import asyncio
+import zmq.asyncio
 from crux.common.messaging import Message
 from crux.common.exception import CruxException
 
@@ -45,12 +48,25 @@ class ManagedSocket:
         """Disconnect from the address"""
         self.__socket.disconnect(self.__address)
 
-    def send(self, data):
+    def close(self):
+        """Close the socket, dropping any unsent messages"""
+        self.__socket.close(linger=0)
+
+    def send(self, frames):
         """Send some data
 
-        :param data: data to send on the socket
+        Frames are handed to zmq without copying, so buffers must not be mutated until sent.
+
+        :param frames: list of frames to send on the socket (see Message.pack)
         """
-        self.__socket.send(data)
+        self.__socket.send_multipart(frames, copy=False)
+
+    def __recv_frames(self):
+        """Receive a multipart message without copying
+
+        :returns: list of memoryviews, one per frame
+        """
+        return [frame.buffer for frame in self.__socket.recv_multipart(copy=False)]
 
     def recv(self, timeout=None):
         """Receive some data on a socket
@@ -62,7 +78,7 @@ class ManagedSocket:
         :returns: Message
         """
         if timeout is None:
-            return Message(data=self.__socket.recv())
+            return Message(data=self.__recv_frames())
         else:
             # timeouts get a little hairy, but what we're gonna do is:
             # 1) register socket with a poller
@@ -76,12 +92,12 @@ class ManagedSocket:
             # poll
             socks = dict(poll.poll(timeout))
             if socks.get(self.__socket):
-                ret = Message(data=self.__socket.recv())
+                ret = Message(data=self.__recv_frames())
                 poll.unregister(self.__socket)
                 return ret
             else:
                 # the socket is broken, trash it
-                self.__socket.setsockopen(zmq.LINGER, 0)
+                self.__socket.setsockopt(zmq.LINGER, 0)
                 self.__socket.close()
                 poll.unregister(self.__socket)
 
@@ -89,14 +105,218 @@ class ManagedSocket:
                 self.__socket = self.__context.socket(self.__socktype)
                 self.__socket.connect(self.__address)
 
-                raise RequestTimeoutException('request to {} timed out'.format(address))
+                raise RequestTimeoutException('request to {} timed out'.format(self.__address))
 
-    def call(self, message, timeout=None):
+    def call(self, message, timeout=None, codec=None):
         """Perform a Message-wrapped call
 
         :param message: Message object to send
         :param timeout: in milliseconds
+        :param codec: compression codec to pack the message with
         :raises RequestTimeoutException: on timeout
         """
-        self.send(message.pack())
+        self.send(message.pack(codec=codec))
         return self.recv(timeout=timeout)
+
+
+class PipelinedSocket:
+    """PipelinedSocket
+
+    DEALER socket for talking to components serving in 'router' mode. Every request
+    is tagged with an id (the 'id' header), which the component echoes on its reply,
+    so any number of requests can be in flight at once and replies matched up in
+    whatever order they arrive. A timed out request is simply forgotten, its reply
+    dropped if it ever turns up, so the socket never needs cycling.
+    """
+    # the socket
+    __socket = None
+    __address = None
+
+    # request ids
+    __next_id = 0
+    # ids sent and not yet received or given up on
+    __pending = None
+    # replies which arrived while waiting on a different request
+    __replies = None
+
+    def __init__(self, context):
+        """Initialize the socket
+
+        :param context: zmq context
+        """
+        self.__socket = context.socket(zmq.DEALER)
+        self.__pending = set()
+        self.__replies = {}
+
+    def connect(self, addr):
+        """Connect the socket
+
+        :param addr: address to connect to
+        """
+        self.__address = addr
+        self.__socket.connect(addr)
+
+    def disconnect(self):
+        """Disconnect from the address"""
+        self.__socket.disconnect(self.__address)
+
+    def close(self):
+        """Close the socket, dropping any unsent messages"""
+        self.__socket.close(linger=0)
+
+    def in_flight(self):
+        """Count the requests still awaiting a reply
+
+        :returns: number of requests
+        """
+        return len(self.__pending) + len(self.__replies)
+
+    def send(self, message, codec=None):
+        """Send a request
+
+        :param message: Message object to send (its 'id' header is set)
+        :param codec: compression codec to pack the message with
+        :returns: the request id, to receive the reply with
+        """
+        request_id = self.__next_id
+        self.__next_id += 1
+
+        message.headers['id'] = request_id
+        # the empty delimiter frame makes us look like a REQ socket to the other end
+        self.__socket.send_multipart([b''] + message.pack(codec=codec), copy=False)
+        self.__pending.add(request_id)
+        return request_id
+
+    def recv(self, request_id, timeout=None):
+        """Receive the reply to a request
+
+        :param request_id: id returned by send()
+        :param timeout: timeout in milliseconds
+        :raises RequestTimeoutException: on timeout
+        :raises KeyError: if the request isn't in flight
+        :returns: Message
+        """
+        if request_id in self.__replies:
+            return self.__replies.pop(request_id)
+        if request_id not in self.__pending:
+            raise KeyError('request {} is not in flight'.format(request_id))
+
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        while True:
+            remaining = None if deadline is None else max(0, int((deadline - time.monotonic()) * 1000))
+            if remaining is not None and not self.__socket.poll(remaining, zmq.POLLIN):
+                # give up on it, the reply will be dropped if it arrives late
+                self.__pending.discard(request_id)
+                raise RequestTimeoutException('request to {} timed out'.format(self.__address))
+
+            frames = self.__socket.recv_multipart(copy=False)
+            reply = Message(data=[frame.buffer for frame in frames[1:]])
+
+            reply_id = reply.headers.get('id')
+            if reply_id not in self.__pending:
+                # an answer to a request we've given up on
+                continue
+            self.__pending.discard(reply_id)
+
+            if reply_id == request_id:
+                return reply
+            self.__replies[reply_id] = reply
+
+    def call(self, message, timeout=None, codec=None):
+        """Perform a Message-wrapped call
+
+        :param message: Message object to send
+        :param timeout: in milliseconds
+        :param codec: compression codec to pack the message with
+        :raises RequestTimeoutException: on timeout
+        """
+        return self.recv(self.send(message, codec=codec), timeout=timeout)
+
+
+class AsyncManagedSocket:
+    """AsyncManagedSocket
+
+    asyncio flavour of ManagedSocket, built on zmq.asyncio. Waiting on a reply
+    yields to the event loop instead of blocking it. Calls on one socket are
+    serialized, so concurrent callers never break the request/reply lockstep.
+    """
+    # the socket
+    __socket = None
+    __context = None
+    __socktype = None
+    __address = None
+    __lock = None
+
+    def __init__(self, context, socktype):
+        """Initialize the socket
+
+        :param context: zmq.asyncio.Context
+        :param socktype: socket type
+        """
+        self.__context = context
+        self.__socktype = socktype
+        self.__socket = context.socket(socktype)
+        self.__lock = asyncio.Lock()
+
+    def connect(self, addr):
+        """Connect the socket
+
+        :param addr: address to connect to
+        """
+        self.__address = addr
+        self.__socket.connect(addr)
+
+    def disconnect(self):
+        """Disconnect from the address"""
+        self.__socket.disconnect(self.__address)
+
+    def close(self):
+        """Close the socket, dropping any unsent messages"""
+        self.__socket.close(linger=0)
+
+    def __reset(self):
+        """Trash the socket and connect a fresh one in its place"""
+        self.__socket.close(linger=0)
+        self.__socket = self.__context.socket(self.__socktype)
+        self.__socket.connect(self.__address)
+
+    async def send(self, frames):
+        """Send some data
+
+        :param frames: list of frames to send on the socket (see Message.pack)
+        """
+        await self.__socket.send_multipart(frames, copy=False)
+
+    async def recv(self, timeout=None):
+        """Receive some data on a socket
+
+        If a timeout is specified, then the socket will be cycled
+
+        :param timeout: timeout in milliseconds
+        :raises RequestTimeoutException: on timeout
+        :returns: Message
+        """
+        if timeout is not None and not await self.__socket.poll(timeout, zmq.POLLIN):
+            # the socket is broken, trash it
+            self.__reset()
+            raise RequestTimeoutException('request to {} timed out'.format(self.__address))
+
+        frames = await self.__socket.recv_multipart(copy=False)
+        return Message(data=[frame.buffer for frame in frames])
+
+    async def call(self, message, timeout=None, codec=None):
+        """Perform a Message-wrapped call
+
+        :param message: Message object to send
+        :param timeout: in milliseconds
+        :param codec: compression codec to pack the message with
+        :raises RequestTimeoutException: on timeout
+        """
+        async with self.__lock:
+            try:
+                await self.send(message.pack(codec=codec))
+                return await self.recv(timeout=timeout)
+            except asyncio.CancelledError:
+                # the reply will never be read, so the socket is out of step
+                self.__reset()
+                raise
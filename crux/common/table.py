@@ -0,0 +1,165 @@
+##
+# Crux columnar tables
+# @author Patrick Kage
+
+from crux.common.exception import CruxException
+
+class TableException(CruxException):
+    pass
+
+class StringColumn:
+    """A column of strings stored as one utf-8 buffer plus offsets
+
+    Items are only decoded when accessed.
+    """
+    offsets = None
+    data = None
+
+    def __init__(self, offsets, data):
+        """Wrap the buffers of a string column
+
+        :param offsets: int64 numpy array of len(column) + 1 byte offsets into data
+        :param data: utf-8 encoded buffer of all the strings back to back
+        """
+        self.offsets = offsets
+        self.data = memoryview(data).cast('B')
+
+    @classmethod
+    def from_strings(cls, strings):
+        """Build a column out of a sequence of strings
+
+        :param strings: iterable of str
+        :returns: StringColumn
+        """
+        import numpy as np
+
+        encoded = [str(item).encode('utf-8') for item in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(item) for item in encoded], out=offsets[1:])
+        return cls(offsets, b''.join(encoded))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('column index out of range')
+        return str(self.data[self.offsets[idx]:self.offsets[idx + 1]], 'utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __repr__(self):
+        return '<StringColumn {} items>'.format(len(self))
+
+class Table:
+    """A columnar table: named, equal-length columns
+
+    Numeric columns are numpy arrays, text columns are StringColumns. Columns can be
+    read one at a time without ever building rows.
+    """
+    schema = None
+    columns = None
+
+    def __init__(self, columns, schema=None, dtypes=None):
+        """Create a table
+
+        :param columns: dict of column name to column (numpy array, StringColumn or sequence)
+        :param schema: column order, defaults to the order of columns
+        :param dtypes: dict of column name to the dtype to convert it to ('str' or a numpy dtype string), others are inferred
+        :raises TableException: if the columns don't line up with the schema or each other, or can't be converted to their dtypes
+        """
+        if schema is None:
+            schema = list(columns)
+        if set(schema) != set(columns):
+            raise TableException('columns {} do not match schema {}'.format(list(columns), schema))
+
+        self.schema = list(schema)
+        dtypes = dtypes if dtypes is not None else {}
+        self.columns = {name: self.__coerce(name, columns[name], dtypes.get(name)) for name in self.schema}
+
+        lengths = set(len(col) for col in self.columns.values())
+        if len(lengths) > 1:
+            raise TableException('columns have differing lengths')
+
+    @classmethod
+    def from_rows(cls, rows, schema=None, dtypes=None):
+        """Build a table out of row-major data (e.g. a csv reader)
+
+        Items of a csv are all strings, so numeric columns have to be given their
+        dtypes to be parsed into numbers.
+
+        :param rows: iterable of rows
+        :param schema: column names, otherwise taken from the first row
+        :param dtypes: dict of column name to dtype ('str' or a numpy dtype string), others are inferred
+        :returns: Table
+        :raises TableException: if the rows don't line up, or a column can't be converted to its dtype
+        """
+        rows = iter(rows)
+        if schema is None:
+            schema = next(rows)
+        cols = list(zip(*rows))
+        if len(cols) == 0:
+            cols = [()] * len(schema)
+        return cls(dict(zip(schema, cols)), schema=schema, dtypes=dtypes)
+
+    def __coerce(self, name, col, dtype=None):
+        """Turn a column into a numpy array or StringColumn
+
+        Strings are parsed into numeric dtypes; numbers are only cast where no
+        information is lost.
+
+        :param name: name of the column
+        :param col: column data
+        :param dtype: 'str' or a numpy dtype string to convert to, or None to infer it
+        :returns: numpy array or StringColumn
+        :raises TableException: if the column can't be converted to dtype
+        """
+        if dtype == 'str':
+            return col if isinstance(col, StringColumn) else StringColumn.from_strings(col)
+
+        import numpy as np
+        if dtype is None:
+            if isinstance(col, StringColumn):
+                return col
+            arr = np.asarray(col)
+            if arr.dtype.kind in 'biuf':
+                return arr
+            return StringColumn.from_strings(col)
+
+        try:
+            dtype = np.dtype(dtype)
+            if dtype.kind not in 'biufc':
+                raise TableException('column {} has unsupported dtype {}'.format(name, dtype))
+            arr = np.asarray(list(col) if isinstance(col, StringColumn) else col)
+            if arr.dtype.kind in 'biuf' and not np.can_cast(arr.dtype, dtype, casting='safe'):
+                raise TableException('cannot safely cast column {} from {} to {}'.format(name, arr.dtype, dtype))
+            return arr.astype(dtype, copy=False)
+        except (ValueError, TypeError) as e:
+            raise TableException('column {} cannot be converted to {}: {}'.format(name, dtype, e))
+
+    def __len__(self):
+        if len(self.schema) == 0:
+            return 0
+        return len(self.columns[self.schema[0]])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def rows(self):
+        """Iterate over rows (materializes each row as a tuple)
+
+        :returns: generator of tuples
+        """
+        cols = [self.columns[name] for name in self.schema]
+        for idx in range(len(self)):
+            yield tuple(col[idx] for col in cols)
+
+    def __repr__(self):
+        return '<Table {} rows, columns={}>'.format(len(self), self.schema)
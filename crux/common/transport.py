@@ -0,0 +1,329 @@
+##
+# Crux out-of-band payload transports
+# @author Patrick Kage
+
+import os
+import mmap
+import uuid
+import msgpack
+import tempfile
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from crux.common.packing import Frame
+from crux.common.exception import CruxException
+
+# msgpack extension code marking a reference to a shared memory segment
+SHM_EXT = 3
+# msgpack extension code marking a reference to a region of a scratch file
+FILE_EXT = 4
+
+# frames smaller than this (in bytes) aren't worth a segment
+SHM_THRESHOLD = 65536
+# prefix of the names of the segments this transport creates (and the only ones it'll unlink)
+SHM_PREFIX = 'crux_'
+
+# frames smaller than this (in bytes) aren't worth spilling to disk
+SPILL_THRESHOLD = 64 * 1024 * 1024
+
+# directories scratch files may live in, besides the one this process spills to
+_spill_dirs = set()
+
+class Segment(SharedMemory):
+    """A shared memory segment whose lifetime is managed by the pipeline run, not this process
+
+    Segments are neither unlinked when this process exits nor complain on garbage
+    collection while views into them are still alive (the mapping simply lives on
+    until the last view is dropped). The segment's file descriptor is closed as soon
+    as it's mapped, so views outliving the segment object never hold one open.
+    """
+    def __init__(self, name=None, create=False, size=0):
+        super().__init__(name=name, create=create, size=size)
+        # the python resource tracker would unlink the segment when *we* exit
+        resource_tracker.unregister(self._name, 'shared_memory')
+
+        # the mapping doesn't need the descriptor (and close() skips it once it's gone)
+        if getattr(self, '_fd', -1) >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def unlink(self):
+        # the base class unregisters from the resource tracker again when unlinking
+        resource_tracker.register(self._name, 'shared_memory')
+        super().unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+class SharedMemoryTransport:
+    """Write large frames once into shared memory, sending only segment handles
+
+    Only useful between processes on the same host. The segments are released by
+    whoever manages the run (see release()), never by the processes using them.
+    """
+    threshold = None
+
+    def __init__(self, threshold=SHM_THRESHOLD):
+        """Create the transport
+
+        :param threshold: minimum frame size in bytes to move into shared memory
+        """
+        self.threshold = threshold
+
+    def export(self, frame):
+        """Move a frame into a new shared memory segment
+
+        :param frame: packing.Frame to export
+        :returns: (msgpack ExtType reference, handle), or None to send the frame inline
+        """
+        nbytes = len(frame)
+        if nbytes < self.threshold:
+            return None
+
+        segment = None
+        while segment is None:
+            try:
+                # (kept short, some platforms limit names to 31 characters)
+                segment = Segment(name=SHM_PREFIX + uuid.uuid4().hex[:20], create=True, size=nbytes)
+            except FileExistsError:
+                pass
+        segment.buf[:nbytes] = memoryview(frame.buffer).cast('B')
+        name = segment.name
+        segment.close()
+
+        return (
+            msgpack.ExtType(SHM_EXT, msgpack.packb([name, nbytes], use_bin_type=True)),
+            'shm:' + name
+        )
+
+class SpillTransport:
+    """Spill large frames to files in a scratch directory, sending only (path, offset, length)
+
+    Receivers memory-map the file rather than reading it in. The files are removed by
+    whoever manages the run (see release()).
+    """
+    threshold = None
+    directory = None
+
+    def __init__(self, directory=None, threshold=SPILL_THRESHOLD):
+        """Create the transport
+
+        :param directory: scratch directory, shared by producers and consumers (defaults to a crux_spill temp dir)
+        :param threshold: minimum frame size in bytes to spill
+        """
+        if directory is None:
+            directory = spill_directory()
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        trust_spill_dir(directory)
+
+        self.directory = directory
+        self.threshold = threshold
+
+    def export(self, frame):
+        """Write a frame out to a new scratch file
+
+        :param frame: packing.Frame to export
+        :returns: (msgpack ExtType reference, handle), or None to send the frame inline
+        """
+        nbytes = len(frame)
+        if nbytes < self.threshold:
+            return None
+
+        path = os.path.join(self.directory, str(uuid.uuid4()))
+        with open(path, 'wb') as handle:
+            handle.write(memoryview(frame.buffer).cast('B'))
+
+        return (
+            msgpack.ExtType(FILE_EXT, msgpack.packb([path, 0, nbytes, True], use_bin_type=True)),
+            'file:' + path
+        )
+
+class TransportChain:
+    """Offer each frame to several transports in turn, first taker wins"""
+    transports = None
+
+    def __init__(self, transports):
+        """Create the chain
+
+        :param transports: list of transports, in order of preference
+        """
+        self.transports = transports
+
+    def export(self, frame):
+        """Export a frame with the first transport that will take it
+
+        :param frame: packing.Frame to export
+        :returns: (msgpack ExtType reference, handle), or None to send the frame inline
+        """
+        for transport in self.transports:
+            ref = transport.export(frame)
+            if ref is not None:
+                return ref
+        return None
+
+def from_environment(env=None):
+    """Set up the transport a launcher asked a component to use
+
+    :param env: environment to read (defaults to os.environ)
+    :returns: a transport, or None if large frames should go inline
+    """
+    if env is None:
+        env = os.environ
+
+    transports = []
+    if 'CRUX_SPILL' in env:
+        transports.append(SpillTransport(directory=env.get('CRUX_SPILL_DIR'), threshold=int(env['CRUX_SPILL'])))
+    if 'CRUX_SHM' in env:
+        transports.append(SharedMemoryTransport(threshold=int(env['CRUX_SHM'])))
+
+    if len(transports) == 0:
+        return None
+    elif len(transports) == 1:
+        return transports[0]
+    return TransportChain(transports)
+
+def spill_directory(env=None):
+    """Get the directory this process spills to
+
+    :param env: environment to read (defaults to os.environ)
+    :returns: CRUX_SPILL_DIR if set, otherwise the default crux_spill temp dir
+    """
+    if env is None:
+        env = os.environ
+    return env.get('CRUX_SPILL_DIR') or os.path.join(tempfile.gettempdir(), 'crux_spill')
+
+def trust_spill_dir(directory):
+    """Accept scratch files in another directory (e.g. the one a launcher told its components to spill to)
+
+    :param directory: the directory
+    """
+    _spill_dirs.add(os.path.realpath(directory))
+
+def is_scratch(path):
+    """Check that a file lies in a spill directory, and so is a pipeline run's to remove
+
+    Scratch flags come from whoever sent the reference, so this is what decides
+    whether a file may be removed, never the flag alone.
+
+    :param path: path of the file
+    :returns: True if so
+    """
+    path = os.path.realpath(path)
+    for directory in _spill_dirs | {os.path.realpath(spill_directory())}:
+        if path != directory and os.path.commonpath([path, directory]) == directory:
+            return True
+    return False
+
+def is_segment(name):
+    """Check whether a shared memory segment is one of the transport's own, and so may be unlinked
+
+    :param name: name of the segment
+    :returns: True if it was created by a SharedMemoryTransport
+    """
+    return name.startswith(SHM_PREFIX) and '/' not in name
+
+def resolve(code, data):
+    """Resolve a transport reference into a Frame over the referenced memory
+
+    :param code: msgpack extension code
+    :param data: extension data
+    :raises ValueError: on an unknown code or a missing segment
+    :returns: packing.Frame, or None if the code isn't a transport reference
+    """
+    if code == FILE_EXT:
+        return _resolve_file(code, data)
+    if code != SHM_EXT:
+        return None
+
+    name, nbytes = msgpack.unpackb(data, encoding='utf-8')
+    try:
+        segment = Segment(name=name)
+    except FileNotFoundError:
+        raise ValueError('shared memory segment {} no longer exists'.format(name))
+
+    # the segment is closed along with the frame (see Frame.release())
+    return Frame(segment.buf[:nbytes], ref=(msgpack.ExtType(code, data), 'shm:' + name), owner=segment)
+
+def map_file(path, offset=0, length=None):
+    """Map (part of) an existing file, to hand downstream without reading it in
+
+    The resulting Frame is sent as a reference to the file rather than its contents,
+    so receivers must be able to see the same path (i.e. be on the same host). The
+    file is never removed by the pipeline.
+
+    :param path: path of the file
+    :param offset: byte offset into the file to start at
+    :param length: number of bytes to map, defaults to the rest of the file
+    :returns: packing.Frame over a read-only mapping of the file
+    """
+    path = os.path.abspath(path)
+    if length is None:
+        length = os.path.getsize(path) - offset
+
+    return _resolve_file(FILE_EXT, msgpack.packb([path, offset, length, False], use_bin_type=True))
+
+def _resolve_file(code, data):
+    """Memory-map the region of a file a reference points at
+
+    :param code: msgpack extension code
+    :param data: extension data, [path, offset, length, whether it's a scratch file]
+    :raises ValueError: if the file is missing, or claims to be a scratch file outside the spill directories
+    :returns: packing.Frame
+    """
+    path, offset, nbytes, scratch = msgpack.unpackb(data, encoding='utf-8')
+    if scratch and not is_scratch(path):
+        raise ValueError('scratch file {} is outside the spill directory'.format(path))
+
+    # only scratch files are the run's to clean up
+    ref = (msgpack.ExtType(code, data), 'file:' + path if scratch else None)
+    if nbytes == 0:
+        return Frame(b'', ref=ref)
+
+    # mappings have to start on an allocation boundary
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    try:
+        with open(path, 'rb') as handle:
+            mapped = mmap.mmap(handle.fileno(), nbytes + offset - start, offset=start, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        raise ValueError('file {} no longer exists'.format(path))
+
+    return Frame(memoryview(mapped)[offset - start:], ref=ref)
+
+def release_exports(msg):
+    """Release the out-of-band buffers a message points at, when nobody will pass it on
+
+    Whoever runs a pipeline releases its intermediates; callers talking to components
+    directly (a REPL, the web API) have to release what the replies point at
+    themselves, once they're done with the payload. The payload is decoded first, so
+    it stays readable (mappings outlive the release).
+
+    :param msg: the received Message
+    """
+    try:
+        msg.payload
+    except CruxException:
+        # undecodable, but whatever it points at still has to go
+        pass
+    for handle in msg.headers.get('exports', []):
+        release(handle)
+
+def release(handle):
+    """Release an exported buffer once nothing will reference it again
+
+    Processes that already mapped it keep their mappings until they drop them.
+    Files outside the spill directories (see is_scratch()) and segments not made
+    by the transport (see is_segment()) are left alone.
+
+    :param handle: handle returned alongside the reference by export()
+    """
+    kind, name = handle.split(':', 1)
+    try:
+        if kind == 'shm' and is_segment(name):
+            Segment(name=name).unlink()
+        elif kind == 'file' and is_scratch(name):
+            os.remove(name)
+    except FileNotFoundError:
+        pass
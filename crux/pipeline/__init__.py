@@ -1,2 +1,3 @@
 from . import pipeline
 from . import component
+from . import registry
@@ -3,32 +3,274 @@
 # @author Patrick Kage
 
 import json
+import time
 import zmq
-from crux.common.socket import ManagedSocket
+import zmq.asyncio
+from crux.common import packing
+from crux.common.socket import ManagedSocket, PipelinedSocket, AsyncManagedSocket
 from crux.common.logging import Logger
-from crux.common.messaging import Message
+from crux.common.messaging import Message, TIMING_PHASES, time_reply, merge_timing
+from crux.common.exception import CruxException
 
 
-class Component:
-    """A description of a running crux component"""
+class ComponentBusyError(CruxException):
+    """The component is still streaming a previous reply"""
+
+class StreamError(CruxException):
+    """The component failed partway through a stream"""
+
+
+class Stream:
+    """The partial outputs of a streamed reply, as they arrive
+
+    Iterate over it to pull the chunks. Closing it early (or dropping it) lets the
+    component go, even if it was never iterated: the handle can't make another
+    request until the stream's over.
+    """
+    # function turning each chunk into native outputs (set by Component.execute()), or None to yield them packed
+    unpack = None
+
+    __chunks = None
+    __cancel = None
+    __started = False
+    __closed = False
+
+    def __init__(self, chunks, cancel):
+        """Wrap a stream
+
+        :param chunks: generator pulling the chunks (letting the component go when closed)
+        :param cancel: function letting the component go, if the generator was never started
+        """
+        self.__chunks = chunks
+        self.__cancel = cancel
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__closed:
+            raise StopIteration
+        self.__started = True
+        try:
+            chunk = next(self.__chunks)
+        except BaseException:
+            # the generator's over, and has let the component go
+            self.__closed = True
+            raise
+        return chunk if self.unpack is None else self.unpack(chunk)
+
+    def close(self):
+        """End the stream, cancelling it if the component hasn't finished it
+
+        :raises RequestTimeoutException: if the component doesn't answer
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__started:
+            self.__chunks.close()
+        else:
+            self.__cancel()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class AsyncStream:
+    """The partial outputs of a streamed reply, as they arrive (see Stream), for AsyncComponent
+
+    Iterate over it with `async for`, and `await aclose()` it to walk away early.
+    Dropped without that, the handle is freed up, but the component is only let go
+    once it gives up on the stream itself.
+    """
+    # function turning each chunk into native outputs (set by AsyncComponent.execute()), or None to yield them packed
+    unpack = None
+
+    __chunks = None
+    __cancel = None
+    __abandon = None
+    __started = False
+    __closed = False
+
+    def __init__(self, chunks, cancel, abandon):
+        """Wrap a stream
+
+        :param chunks: async generator pulling the chunks (letting the component go when closed)
+        :param cancel: coroutine function letting the component go, if the generator was never started
+        :param abandon: function freeing up the handle, if the stream is dropped unclosed
+        """
+        self.__chunks = chunks
+        self.__cancel = cancel
+        self.__abandon = abandon
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.__closed:
+            raise StopAsyncIteration
+        self.__started = True
+        try:
+            chunk = await self.__chunks.__anext__()
+        except BaseException:
+            # the generator's over, and has let the component go
+            self.__closed = True
+            raise
+        return chunk if self.unpack is None else self.unpack(chunk)
+
+    async def aclose(self):
+        """End the stream, cancelling it if the component hasn't finished it
+
+        :raises RequestTimeoutException: if the component doesn't answer
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.__started:
+            await self.__chunks.aclose()
+        else:
+            await self.__cancel()
+
+    def __del__(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__abandon()
+
+
+class BaseComponent:
+    """What Component and AsyncComponent share: the component's description, and
+    building and reading the messages exchanged with it (the round trips are theirs)
+    """
     # description
     cruxfile  = None
     address   = None
+    codec     = None
+
+    # logical name, if requests go through a daemon's broker
+    name      = None
+
+    # compiled I/O plans for the component's inputs/outputs
+    input_plan  = None
+    output_plan = None
+
+    # how many chunks to ask for at once when receiving a stream
+    STREAM_CREDIT = 4
+
+    def describe(self, cruxfile):
+        """Set up the handle from the component's resolved cruxfile
+
+        :param cruxfile: the cruxfile, as the component answers 'get_cruxfile'
+        """
+        self.cruxfile = cruxfile
+
+        # compress traffic if the component advertises a codec we support
+        self.codec = packing.negotiate_codec(self.cruxfile.get('codecs', []))
+
+        # compile the I/O plans once, rather than per request
+        self.input_plan = packing.IOPlan(self.cruxfile.get('inputs', {}))
+        self.output_plan = packing.IOPlan(self.cruxfile.get('outputs', {}))
+
+    def execute_message(self, inputs, parameters=None):
+        """Build an execute request
+
+        :param inputs: dict of native inputs
+        :param parameters: dict of parameters, or None
+        :returns: Message
+        """
+        return Message(
+            name='execute',
+            payload={
+                'parameters': parameters if parameters is not None else {},
+                'inputs': self.input_plan.pack(inputs)
+            }
+        )
+
+    def unpack_reply(self, reply):
+        """Unpack a successful execute reply's payload into native outputs
+
+        A streamed reply's chunks are unpacked as they're pulled.
+
+        :param reply: the reply
+        :returns: the reply
+        """
+        if reply.success and reply.name == 'return' and reply.payload is not None:
+            reply.payload = self.output_plan.unpack(reply.payload)
+        elif reply.success and reply.name == 'stream':
+            reply.payload.unpack = self.output_plan.unpack
+
+        return reply
+
+    def address_message(self, msg):
+        """Address a request to the component, through a broker if the handle has a name
+
+        :param msg: the request
+        :returns: the request
+        """
+        if self.name is not None:
+            msg.headers['component'] = self.name
+        return msg
+
+
+def _take_chunks(head, reply, sent=None):
+    """Read the reply to a 'stream_next', noting what it points at and where the time went on the stream's head
+
+    :param head: the reply which started the stream
+    :param reply: the reply
+    :param sent: time.monotonic() when the request was sent (the head's timing is finished once the stream's done)
+    :raises StreamError: if the component failed partway through
+    :returns: (list of chunks, whether the stream is done)
+    """
+    if not reply.success:
+        raise StreamError(reply.payload)
+
+    if 'exports' in reply.headers:
+        head.headers.setdefault('exports', []).extend(reply.headers['exports'])
+    if 'timing' in head.headers:
+        merge_timing(head.headers['timing'], reply.headers.get('timing'), TIMING_PHASES[1:])
+
+    done = reply.payload['done']
+    if done:
+        time_reply(head, sent)
+    return reply.payload['chunks'], done
+
+
+class Component(BaseComponent):
+    """A description of a running crux component
+
+    Components serving in 'router' mode (see the cruxfile's 'protocol') are talked to
+    over a DEALER socket, so several requests can be in flight at once (see submit()
+    and collect()). Everything else gets one request at a time over REQ.
+
+    Given a name, the handle talks to a daemon's broker instead (the address is the
+    daemon's), which spreads the requests over the named component's replicas.
+    """
+    pipelined = False
 
     # zmq stuff
     __socket  = None
     __context = None
+    __streaming = False
+    # ticket of the request outstanding in REQ mode
+    __outstanding = None
+    __next_ticket = 0
+    # ticket -> time.monotonic() when the request was sent
+    __sent = None
 
     # housekeeping
     __log     = None
 
-    def __init__(self, address, socket=None, context=None, timeout=None):
+    def __init__(self, address, socket=None, context=None, timeout=None, cruxfile=None, name=None):
         """Initialize the component
 
         :param address: the address of the component
         :param socket: the socket to use for communication, if we're sharing (one will be created if not provided)
         :param timeout: timeout for resolving the component
         :param context: the context to use to create a socket (if no socket provided), one will be created if not used
+        :param cruxfile: the component's resolved cruxfile, if already known (e.g. from the daemon), saves asking the component for it
+        :param name: the component's path or name, to have a daemon (at address) broker requests to its replicas
         """
         # logging?
         self.__log = Logger(logging=True)
@@ -41,23 +283,410 @@ class Component:
         else:
             self.__context = context
 
-        # if we haven't got a socket yet, get one
-        self.__socket = ManagedSocket(self.__context, zmq.REQ)
+        # connect the socket (REQ until we know the component can take more, a broker always can)
+        self.address = address
+        self.name = name
+        self.__sent = {}
+        self.__connect(name is not None or (cruxfile is not None and cruxfile.get('protocol') == 'router'))
+
+        # get the cruxfile, unless we've been handed it
+        if cruxfile is None:
+            try:
+                cruxfile = self.request(Message(name='get_cruxfile'), timeout=timeout).payload
+            except BaseException:
+                # nobody will ever get the handle to close it
+                self.__socket.close()
+                raise
+        self.describe(cruxfile)
+
+        # switch over if it turns out the component serves in router mode
+        if self.cruxfile.get('protocol') == 'router' and not self.pipelined:
+            self.__socket.close()
+            self.__connect(True)
+
+    def __connect(self, pipelined):
+        """Create and connect the socket
+
+        :param pipelined: if true, use a DEALER socket which can have several requests in flight
+        """
+        self.pipelined = pipelined
+        if pipelined:
+            self.__socket = PipelinedSocket(self.__context)
+        else:
+            self.__socket = ManagedSocket(self.__context, zmq.REQ)
+
+        self.__log('connecting to {}'.format(self.address))
+        self.__socket.connect(self.address)
+
+    def close(self):
+        """Close the connection to the component"""
+        self.__socket.close()
+
+    def execute(self, inputs, parameters=None, timeout=None):
+        """Execute the component on some native (unpacked) inputs
+
+        :param inputs: dict of inputs, as the component's code would see them
+        :param parameters: dict of parameters (missing ones take the component's defaults)
+        :param timeout: timeout in ms
+        :returns: the reply, with a successful payload unpacked into native outputs (or a Stream of them)
+        """
+        return self.unpack_reply(self.request(self.execute_message(inputs, parameters), timeout=timeout))
+
+    def execute_many(self, runs, timeout=None, window=None):
+        """Execute the component on several sets of inputs, keeping it continuously busy
+
+        In pipelined mode up to `window` executes are kept in flight, so the component
+        picks up the next one as soon as it has replied to the last. Otherwise they're
+        run one after another.
+
+        :param runs: list of (inputs, parameters) pairs
+        :param timeout: timeout in ms per execute
+        :param window: most executes in flight at once (default: all of them)
+        :returns: list of replies, in the order of runs
+        """
+        if not self.pipelined:
+            return [self.execute(inputs, parameters, timeout=timeout) for inputs, parameters in runs]
+
+        window = window if window is not None else len(runs)
+        tickets = []
+        replies = []
+        for inputs, parameters in runs:
+            if len(tickets) - len(replies) >= window:
+                replies.append(self.unpack_reply(self.collect(tickets[len(replies)], timeout=timeout)))
+            tickets.append(self.submit(self.execute_message(inputs, parameters)))
+
+        for ticket in tickets[len(replies):]:
+            replies.append(self.unpack_reply(self.collect(ticket, timeout=timeout)))
+
+        return replies
+
+    def execute_batch(self, runs, timeout=None):
+        """Execute the component on several sets of inputs in a single request
+
+        The whole batch travels as one 'execute_batch' message and comes back as one
+        reply, so the component can run it vectorized (see CruxClient.wait_batch()).
+        Components which don't understand batches get the runs one by one instead
+        (pipelined, if they can take it).
+
+        :param runs: list of (inputs, parameters) pairs
+        :param timeout: timeout in ms for the whole batch
+        :returns: list of replies, one per run in order, each with its own success flag
+        """
+        reply = self.request(Message(
+            name='execute_batch',
+            payload={'items': [self.execute_message(inputs, parameters).payload for inputs, parameters in runs]}
+        ), timeout=timeout)
+
+        if reply.name == 'nyi':
+            self.__log.warn('component at {} does not take batches, executing one by one'.format(self.address))
+            return self.execute_many(runs, timeout=timeout)
+
+        if not reply.success or reply.name != 'return_batch':
+            # the batch as a whole was rejected
+            return [reply for _ in runs]
+
+        return [
+            self.unpack_reply(Message(name='return', payload=result['payload'], success=result['success']))
+            for result in reply.payload['results']
+        ]
+
+    def submit(self, msg):
+        """Send a request without waiting for the reply
+
+        In pipelined mode any number of requests can be submitted before collecting
+        their replies. In REQ mode only one can be outstanding.
 
-        # connect the socket
+        :param msg: the message to post to the client
+        :raises ComponentBusyError: if a stream is open, or (REQ mode) a request is outstanding
+        :returns: a ticket to collect the reply with
+        """
+        if self.__streaming:
+            raise ComponentBusyError('component at {} is still streaming'.format(self.address))
+
+        return self.__post(msg)
+
+    def collect(self, ticket, timeout=None, credit=None):
+        """Wait for the reply to a submitted request
+
+        See request() for how streamed replies are handled.
+
+        :param ticket: ticket returned by submit()
+        :param timeout: timeout in ms
+        :param credit: chunks to request at once when streaming (default Component.STREAM_CREDIT)
+        :raises ComponentBusyError: if a stream is still open
+        :raises RequestTimeoutException: on timeout
+        :returns: the reply
+        """
+        if self.__streaming:
+            raise ComponentBusyError('component at {} is still streaming'.format(self.address))
+
+        sent = self.__sent.get(ticket)
+        reply = self.__fetch(ticket, timeout)
+
+        if reply.name == 'stream':
+            self.__streaming = True
+            reply.payload = Stream(
+                self.__stream(reply, timeout, credit if credit is not None else self.STREAM_CREDIT, sent),
+                lambda: self.__cancel_stream(timeout)
+            )
+
+        return reply
+
+    def __post(self, msg):
+        """Send a request
+
+        :param msg: the message to send
+        :raises ComponentBusyError: if (REQ mode) a request is outstanding
+        :returns: ticket
+        """
+        self.address_message(msg)
+
+        sent = time.monotonic()
+        if self.pipelined:
+            ticket = self.__socket.send(msg, codec=self.codec)
+        else:
+            if self.__outstanding is not None:
+                raise ComponentBusyError('component at {} already has a request outstanding'.format(self.address))
+
+            self.__socket.send(msg.pack(codec=self.codec))
+            self.__outstanding = ticket = self.__next_ticket
+            self.__next_ticket += 1
+
+        self.__sent[ticket] = sent
+        return ticket
+
+    def __fetch(self, ticket, timeout):
+        """Receive the reply to a request
+
+        :param ticket: ticket from __post()
+        :param timeout: timeout in ms
+        :raises RequestTimeoutException: on timeout
+        :returns: the reply
+        """
+        sent = self.__sent.pop(ticket, None)
+        if self.pipelined:
+            return time_reply(self.__socket.recv(ticket, timeout=timeout), sent)
+
+        if ticket != self.__outstanding:
+            raise KeyError('request {} is not outstanding'.format(ticket))
+        try:
+            return time_reply(self.__socket.recv(timeout=timeout), sent)
+        finally:
+            # a timed out socket has been cycled, so the request is gone either way
+            self.__outstanding = None
+
+    def request(self, msg, timeout=None, credit=None):
+        """Do a request on this component
+
+        If the component streams its reply, the reply's payload is a Stream over the
+        partial outputs. Chunks are requested as the stream is consumed: the next
+        batch is asked for as soon as one arrives, so the component produces it while
+        the consumer works through the current one, but can't run further ahead than
+        that. No other request can be made until the stream has been exhausted or
+        closed.
+
+        Replies to executes carry a 'timing' header breaking down where the request's
+        time went, in ms (see messaging.TIMING_PHASES). The time the component spends
+        on a stream's later chunks is added to the head's as they're consumed, and the
+        total covers the whole stream once it's done.
+
+        Out-of-band buffers the reply points at (its 'exports' header) are the
+        caller's to release, see crux.common.transport.release_exports().
+
+        :param msg: the message to post to the client
+        :param timeout: timeout in ms
+        :param credit: chunks to request at once when streaming (default Component.STREAM_CREDIT)
+        :raises ComponentBusyError: if a stream is still open
+        :returns: the reply
+        """
+        return self.collect(self.submit(msg), timeout=timeout, credit=credit)
+
+    def __stream(self, head, timeout, credit, sent=None):
+        """Pull a stream of chunks from the component
+
+        Out-of-band buffers referenced by the chunks are added to the head's 'exports'
+        header, and the time spent on them to its 'timing' header.
+
+        :param head: the reply which started the stream
+        :param timeout: timeout in ms per batch of chunks
+        :param credit: chunks to request at once
+        :param sent: time.monotonic() when the request was sent
+        :raises StreamError: if the component fails partway through
+        :returns: generator of partial outputs
+        """
+        done = False
+        ticket = self.__post(Message(name='stream_next', payload=credit))
+        try:
+            while not done:
+                reply = self.__fetch(ticket, timeout)
+                ticket = None
+                chunks, done = _take_chunks(head, reply, sent)
+
+                # have the next batch made while this one is consumed
+                if not done:
+                    ticket = self.__post(Message(name='stream_next', payload=credit))
+
+                for chunk in chunks:
+                    yield chunk
+        except GeneratorExit:
+            # the consumer walked away early, let the component go
+            if ticket is not None:
+                reply = self.__fetch(ticket, timeout)
+                # a failed stream is already over
+                done = not reply.success or reply.payload['done']
+            if not done:
+                self.__fetch(self.__post(Message(name='stream_cancel')), timeout)
+            raise
+        finally:
+            self.__streaming = False
+
+    def __cancel_stream(self, timeout):
+        """Let the component go from a stream nothing was ever asked of
+
+        :param timeout: timeout in ms
+        """
+        try:
+            self.__fetch(self.__post(Message(name='stream_cancel')), timeout)
+        finally:
+            self.__streaming = False
+
+
+class AsyncComponent(BaseComponent):
+    """asyncio flavour of Component, for use from inside an event loop
+
+    Resolving the component needs a round trip, so it's done by awaiting resolve()
+    rather than in the constructor:
+
+        component = await AsyncComponent(address, context=ctx).resolve(timeout=2500)
+
+    As with Component, given a name the handle talks to a daemon's broker instead.
+    """
+    # zmq stuff
+    __socket  = None
+    __context = None
+    __streaming = False
+
+    # housekeeping
+    __log     = None
+
+    def __init__(self, address, context=None, cruxfile=None, name=None):
+        """Initialize the component
+
+        :param address: the address of the component
+        :param context: zmq.asyncio.Context to create the socket with, one will be created if not provided
+        :param cruxfile: the component's resolved cruxfile, if already known (e.g. from the daemon), saves resolving it
+        :param name: the component's path or name, to have a daemon (at address) broker requests to its replicas
+        """
+        self.__log = Logger(logging=True)
+
+        if context is None:
+            self.__log.warn('creating new zmq context for component! something is probably wrong')
+            context = zmq.asyncio.Context()
+        self.__context = context
+
+        self.__socket = AsyncManagedSocket(self.__context, zmq.REQ)
+
+        self.address = address
+        self.name = name
         self.__log('connecting to {}'.format(address))
         self.__socket.connect(address)
 
-        # get the cruxfile
-        self.cruxfile = self.request(Message(name='get_cruxfile'), timeout=timeout).payload
+        if cruxfile is not None:
+            self.describe(cruxfile)
 
-    def request(self, msg, timeout=None):
+    async def resolve(self, timeout=None):
+        """Fetch the component's cruxfile and set up codec and I/O plans
+
+        Does nothing if the handle was built from a known cruxfile.
+
+        :param timeout: timeout in ms
+        :raises RequestTimeoutException: if the component doesn't answer
+        :returns: self
+        """
+        if self.cruxfile is None:
+            self.describe((await self.request(Message(name='get_cruxfile'), timeout=timeout)).payload)
+
+        return self
+
+    def close(self):
+        """Close the connection to the component"""
+        self.__socket.close()
+
+    async def execute(self, inputs, parameters=None, timeout=None):
+        """Execute the component on some native (unpacked) inputs
+
+        :param inputs: dict of inputs, as the component's code would see them
+        :param parameters: dict of parameters (missing ones take the component's defaults)
+        :param timeout: timeout in ms
+        :returns: the reply, with a successful payload unpacked into native outputs (or an AsyncStream of them)
+        """
+        return self.unpack_reply(await self.request(self.execute_message(inputs, parameters), timeout=timeout))
+
+    async def request(self, msg, timeout=None, credit=None):
         """Do a request on this component
 
+        Same semantics as Component.request, except that a streamed reply's payload
+        is an AsyncStream over the partial outputs.
+
         :param msg: the message to post to the client
         :param timeout: timeout in ms
+        :param credit: chunks to request at once when streaming (default STREAM_CREDIT)
+        :raises ComponentBusyError: if a stream is still open
         :returns: the reply
         """
-        return self.__socket.call(msg, timeout=timeout)
+        if self.__streaming:
+            raise ComponentBusyError('component at {} is still streaming'.format(self.address))
+
+        self.address_message(msg)
+
+        sent = time.monotonic()
+        reply = time_reply(await self.__socket.call(msg, timeout=timeout, codec=self.codec), sent)
+
+        if reply.name == 'stream':
+            self.__streaming = True
+            reply.payload = AsyncStream(
+                self.__stream(reply, timeout, credit if credit is not None else self.STREAM_CREDIT, sent),
+                lambda: self.__cancel_stream(timeout),
+                self.__abandon_stream
+            )
+
+        return reply
+
+    async def __stream(self, head, timeout, credit, sent=None):
+        """Pull a stream of chunks from the component
 
+        :param head: the reply which started the stream
+        :param timeout: timeout in ms per batch of chunks
+        :param credit: chunks to request at once
+        :param sent: time.monotonic() when the request was sent
+        :raises StreamError: if the component fails partway through
+        :returns: async generator of partial outputs
+        """
+        done = False
+        try:
+            while not done:
+                reply = await self.__socket.call(Message(name='stream_next', payload=credit), timeout=timeout, codec=self.codec)
+                chunks, done = _take_chunks(head, reply, sent)
+                for chunk in chunks:
+                    yield chunk
+        except GeneratorExit:
+            # the consumer walked away early, let the component go
+            await self.__socket.call(Message(name='stream_cancel'), timeout=timeout)
+            raise
+        finally:
+            self.__streaming = False
+
+    async def __cancel_stream(self, timeout):
+        """Let the component go from a stream nothing was ever asked of
+
+        :param timeout: timeout in ms
+        """
+        try:
+            await self.__socket.call(Message(name='stream_cancel'), timeout=timeout)
+        finally:
+            self.__streaming = False
 
+    def __abandon_stream(self):
+        """Free up the handle from a stream dropped without being closed"""
+        self.__log.warn('stream from {} dropped without being closed'.format(self.address))
+        self.__streaming = False
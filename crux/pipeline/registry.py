@@ -0,0 +1,219 @@
+##
+# Crux component handle registry
+# @author Patrick Kage
+
+import zmq
+import asyncio
+import zmq.asyncio
+from crux.common.logging import Logger
+from crux.pipeline.component import Component, AsyncComponent
+
+
+class ComponentRegistry:
+    """Cache of connected Component handles, keyed by address
+
+    Resolving a component costs a socket, a connect and a get_cruxfile round trip.
+    The registry pays that once per address, and hands the same handle (and its
+    cached cruxfile) out again until the entry is invalidated, either explicitly
+    (e.g. on a timeout), by syncing against the daemon's process status, or by
+    asking for the address with a cruxfile other than the cached one.
+    """
+    # address -> Component
+    __components = None
+    # address -> pid of the process the handle was resolved against (if known)
+    __pids = None
+
+    # zmq stuff
+    __context = None
+
+    # housekeeping
+    __log = None
+
+    def __init__(self, context=None):
+        """Create the registry
+
+        :param context: zmq context to create component sockets with, one will be created if not provided
+        """
+        self.__log = Logger(logging=True, name='registry')
+        self.__context = context if context is not None else zmq.Context()
+        self.__components = {}
+        self.__pids = {}
+
+    def get(self, address, timeout=None, cruxfile=None):
+        """Get a handle to the component at an address, resolving it if it isn't cached
+
+        :param address: address of the component
+        :param timeout: timeout in ms for resolving the component
+        :param cruxfile: the component's resolved cruxfile, if known (no round trip needed then, and a cached handle with a different one is replaced)
+        :raises RequestTimeoutException: if the component doesn't answer
+        :returns: Component
+        """
+        self.refresh(address, cruxfile)
+        if address not in self.__components:
+            self.__components[address] = Component(address, context=self.__context, timeout=timeout, cruxfile=cruxfile)
+        return self.__components[address]
+
+    def refresh(self, address, cruxfile):
+        """Drop a cached handle resolved against a different cruxfile (e.g. another component now at the address)
+
+        :param address: address of the component
+        :param cruxfile: the component's current cruxfile, or None if not known
+        """
+        if cruxfile is not None and address in self.__components and self.__components[address].cruxfile != cruxfile:
+            self.invalidate(address)
+
+    def lookup(self, address):
+        """Get a cached component handle without resolving anything
+
+        :param address: address of the component
+        :returns: Component, or None if not cached
+        """
+        return self.__components.get(address)
+
+    def put(self, address, component):
+        """Cache a component handle, replacing (and closing) any existing one
+
+        :param address: address of the component
+        :param component: the handle
+        """
+        if address in self.__components and self.__components[address] is not component:
+            self.__components[address].close()
+        self.__components[address] = component
+
+    def cached(self, address):
+        """Check if a component handle is cached
+
+        :param address: address of the component
+        :returns: True if cached
+        """
+        return address in self.__components
+
+    def invalidate(self, address):
+        """Drop a cached component handle
+
+        :param address: address of the component
+        """
+        if address in self.__components:
+            self.__log('invalidating {}'.format(address))
+            self.__components[address].close()
+            del self.__components[address]
+        if address in self.__pids:
+            del self.__pids[address]
+
+    def sync(self, status):
+        """Invalidate handles to processes which died or were restarted
+
+        :param status: process status from the daemon (address -> {'pid': ...}), or a plain list of live addresses
+        """
+        if not isinstance(status, dict):
+            status = {address: {} for address in status}
+
+        for address in list(self.__components):
+            if address not in status:
+                self.invalidate(address)
+            elif 'pid' in status[address]:
+                pid = status[address]['pid']
+                if address in self.__pids and self.__pids[address] != pid:
+                    # same address, different process
+                    self.invalidate(address)
+                self.__pids[address] = pid
+
+    def clear(self):
+        """Drop every cached component handle"""
+        for address in list(self.__components):
+            self.invalidate(address)
+
+
+class AsyncComponentRegistry(ComponentRegistry):
+    """ComponentRegistry handing out AsyncComponents, for use from inside an event loop
+
+    Concurrent lookups of the same uncached address share a single resolution.
+    """
+    # address -> task resolving the component
+    __pending = None
+
+    __context = None
+
+    def __init__(self, context=None):
+        """Create the registry
+
+        :param context: zmq.asyncio.Context to create component sockets with, one will be created if not provided
+        """
+        context = context if context is not None else zmq.asyncio.Context()
+        super().__init__(context=context)
+        self.__context = context
+        self.__pending = {}
+
+    async def get(self, address, timeout=None, cruxfile=None):
+        """Get a handle to the component at an address, resolving it if it isn't cached
+
+        :param address: address of the component
+        :param timeout: timeout in ms for resolving the component
+        :param cruxfile: the component's resolved cruxfile, if known (no round trip needed then, and a cached handle with a different one is replaced)
+        :raises RequestTimeoutException: if the component doesn't answer
+        :returns: AsyncComponent
+        """
+        self.refresh(address, cruxfile)
+        component = self.lookup(address)
+        if component is not None:
+            return component
+
+        if cruxfile is not None and address not in self.__pending:
+            component = AsyncComponent(address, context=self.__context, cruxfile=cruxfile)
+            self.put(address, component)
+            return component
+
+        if address not in self.__pending:
+            task = asyncio.ensure_future(self.__resolve(address, timeout))
+            # every waiter may have given up by the time it fails, don't complain about it
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self.__pending[address] = task
+
+        # one caller giving up shouldn't cancel the resolution for everyone else
+        return await asyncio.shield(self.__pending[address])
+
+    async def __resolve(self, address, timeout):
+        """Resolve a component and cache it
+
+        :param address: address of the component
+        :param timeout: timeout in ms
+        :returns: AsyncComponent
+        """
+        component = AsyncComponent(address, context=self.__context)
+        try:
+            await component.resolve(timeout=timeout)
+        except BaseException:
+            component.close()
+            raise
+        finally:
+            del self.__pending[address]
+
+        self.put(address, component)
+        return component
+
+
+# the registries shared by everything in this process
+_shared = None
+_shared_async = None
+
+def shared_registry(context=None):
+    """Get the process-wide component registry
+
+    :param context: zmq context to use if the registry hasn't been created yet
+    :returns: ComponentRegistry
+    """
+    global _shared
+    if _shared is None:
+        _shared = ComponentRegistry(context=context)
+    return _shared
+
+def shared_async_registry(context=None):
+    """Get the process-wide asyncio component registry
+
+    :param context: zmq.asyncio.Context to use if the registry hasn't been created yet
+    :returns: AsyncComponentRegistry
+    """
+    global _shared_async
+    if _shared_async is None:
+        _shared_async = AsyncComponentRegistry(context=context)
+    return _shared_async
@@ -34,14 +34,17 @@ def init(path, name, author):
 @click.argument('description_file')
 @click.option('--daemon-addr', default='tcp://127.0.0.1:30020', metavar='uri', help='daemon to use')
 @click.option('--no-daemon', default=False, help='load processes manually', is_flag=True)
-def run_pipeline(description_file, daemon_addr, no_daemon):
+@click.option('--shared-memory', default=False, help='hand large payloads over in shared memory (with --no-daemon)', is_flag=True)
+@click.option('--spill-threshold', metavar='bytes', type=int, default=None, help='spill payload fields of at least this size to disk (with --no-daemon)')
+@click.option('--fork-server', default=False, help='fork python components off a preloaded process (with --no-daemon)', is_flag=True)
+def run_pipeline(description_file, daemon_addr, no_daemon, shared_memory, spill_threshold, fork_server):
     print('{}, da: {}, nd: {}'.format(
         description_file,
         daemon_addr,
         no_daemon
     ))
     if no_daemon:
-        pipeline.run_pipeline(description_file)
+        pipeline.run_pipeline(description_file, shared_memory=shared_memory, spill_threshold=spill_threshold, fork_server=fork_server)
     else:
         pipeline.run_pipeline(description_file, daemon_addr=daemon_addr)
 
@@ -74,6 +77,31 @@ def daemon_procstart(ctx, path):
     """Start a process managed by the daemon"""
     click.echo(DaemonAPI(ctx.obj['URI'], context=ctx.obj['ctx']).process_start(path).payload)
 
+@daemon.command('process_acquire')
+@click.argument('path')
+@click.pass_context
+def daemon_procacquire(ctx, path):
+    """Borrow an idle replica of a component from the daemon (starting one if need be)"""
+    click.echo(DaemonAPI(ctx.obj['URI'], context=ctx.obj['ctx']).process_acquire(path).payload)
+
+@daemon.command('process_release')
+@click.argument('addr')
+@click.pass_context
+def daemon_procrelease(ctx, addr):
+    """Hand a replica borrowed with process_acquire back to the daemon, to be reused"""
+    DaemonAPI(ctx.obj['URI'], context=ctx.obj['ctx']).process_release(addr)
+    click.echo('Command issued.')
+
+@daemon.command('broker_status')
+@click.pass_context
+def daemon_brokerstatus(ctx):
+    """Show the components the daemon brokers requests to, and how loaded their replicas are"""
+    status = DaemonAPI(ctx.obj['URI'], context=ctx.obj['ctx']).broker_status().payload
+    for name in status:
+        click.echo('{} ({}), {} queued'.format(name, status[name]['path'], status[name]['queued']))
+        for addr in status[name]['replicas']:
+            click.echo('    {} {}'.format(addr, status[name]['replicas'][addr]))
+
 @daemon.command('process_killall')
 @click.pass_context
 def daemon_prockillall(ctx):
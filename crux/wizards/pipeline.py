@@ -12,7 +12,7 @@ from crux.common.logging import Logger
 from crux.backend.pipelineagent import PipelineAgent, BrokenPipelineError
 
 
-def run_pipeline(descfile, daemon_addr=None):
+def run_pipeline(descfile, daemon_addr=None, shared_memory=False, spill_threshold=None, fork_server=False):
     # create a logger
     log = Logger(logging=True, name='harness')
 
@@ -21,8 +21,8 @@ def run_pipeline(descfile, daemon_addr=None):
 
     # loading the agent
     if daemon_addr is None:
-        pp = ProcessPool(use_ipc=True)
-        log.info('using a process pool with IPC transport')
+        pp = ProcessPool(use_ipc=True, use_shm=shared_memory, spill_threshold=spill_threshold, launcher='fork' if fork_server else 'exec')
+        log.info('using a process pool with IPC transport{}'.format(' and shared memory' if shared_memory else ''))
         agent = PipelineAgent(context=context, pool=pp)
     else:
         log.info('using a daemon located at {}'.format(daemon_addr))
@@ -39,9 +39,14 @@ def run_pipeline(descfile, daemon_addr=None):
         try:
             pbar.update(0)
             for count, step, result in agent.run(desc):
+                if result.name == 'stream':
+                    # the last step's output, pulled through as it's made
+                    size = sum(len(piece['text']) for piece in result.payload if 'text' in piece)
+                else:
+                    size = len(result.payload['text']) if result.payload is not None and 'text' in result.payload else None
                 log.debug('exec {} {}'.format(
                     step['component'],
-                    ('(' + str(len(result.payload['text'])) + ' bytes)') if result.payload is not None and 'text' in result.payload else ''
+                    ('(' + str(size) + ' bytes)') if size is not None else ''
                 ))
                 pbar.update(count)
         except BrokenPipelineError as bpe:
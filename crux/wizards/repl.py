@@ -5,10 +5,12 @@
 import cmd
 import sys
 import json
+import time
 import zmq
 from termcolor import colored
-from crux.common.messaging import Message, MessageException
+from crux.common.messaging import Message, MessageException, time_reply, format_timing
 from crux.common.logging import Logger
+from crux.common.transport import release_exports
 
 
 class CruxREPL(cmd.Cmd):
@@ -72,12 +74,17 @@ class CruxREPL(cmd.Cmd):
         ))
         print('{}: {}'.format(
             colored('payload', 'blue'),
-            json.dumps(msg.payload) if msg.payload is not None else colored('None', 'red')
+            json.dumps(msg.payload, default=repr) if msg.payload is not None else colored('None', 'red')
         ))
         print('{}: {}'.format(
             colored('success', 'blue'),
             json.dumps(msg.success) if msg.success is not None else colored('None', 'red')
         ))
+        if msg.headers.get('timing'):
+            print('{}: {}'.format(
+                colored('timing', 'blue'),
+                format_timing(msg.headers['timing'])
+            ))
 
     def do_EOF(self, arg):
         """End the program"""
@@ -158,8 +165,11 @@ class CruxREPL(cmd.Cmd):
         except MessageException as me:
             self.__log.error(me.msg)
         else:
-            self.__socket.send(packed)
-            self.last_msg = Message(data=self.__socket.recv())
+            sent = time.monotonic()
+            self.__socket.send_multipart(packed)
+            self.last_msg = time_reply(Message(data=self.__socket.recv_multipart()), sent)
+            # nobody downstream will release what the reply points at
+            release_exports(self.last_msg)
             self.__log('sending...')
 
     def do_assert(self, args):
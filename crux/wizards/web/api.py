@@ -4,14 +4,46 @@
 # @author Patrick Kage
 
 import zmq
+import base64
+import asyncio
+import zmq.asyncio
 from aiohttp import web
 from crux.common.socket import RequestTimeoutException
 from crux.common.logging import Logger
 from crux.common.messaging import Message
+from crux.common.packing import Frame, PackingException
+from crux.common.table import Table, StringColumn
+from crux.common.transport import release_exports
 from crux.common.validation import validate_uri
-from crux.pipeline.component import Component
-from crux.backend.daemon_api import DaemonAPI
+from crux.pipeline.registry import shared_async_registry
+from crux.backend.daemon_api import AsyncDaemonAPI
 from crux.backend.pipelineagent import PipelineAgent
+from crux.pipeline.component import StreamError
+
+def _jsonable(value):
+    """Turn (part of) a reply's payload into something JSON can hold
+
+    Binary comes back base64-encoded, arrays as nested lists and tables as dicts of columns.
+
+    :param value: native or packed value
+    :returns: JSON-serializable value
+    """
+    if isinstance(value, Frame):
+        value = value.buffer
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, Table):
+        return {name: _jsonable(value[name]) for name in value.schema}
+    if isinstance(value, StringColumn):
+        return list(value)
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if hasattr(value, 'tolist'):
+        # numpy arrays and scalars
+        return value.tolist()
+    return value
 
 class CruxAPIServer:
     # housekeeping
@@ -20,17 +52,22 @@ class CruxAPIServer:
     # zmq stuff
     __context = None
     REQ_TIMEOUT = 2500 # milliseconds
+    LIST_DEADLINE = 2500 # milliseconds, for listing every component
 
     # daemon api
     dapi = None
 
+    # cached component handles
+    components = None
+
     # currently editing pipeline
     pline = None
     agent = None
 
     def __init__(self):
         self.log = Logger(name='webapi', logging=True)
-        self.__context = zmq.Context()
+        self.__context = zmq.asyncio.Context()
+        self.components = shared_async_registry(context=self.__context)
 
     def attach_routes(self, app):
         """Attach webapi routes
@@ -71,7 +108,7 @@ class CruxAPIServer:
 
         self.log.info('connecting daemon {}'.format(req.query['daemon']))
         if self.dapi is None:
-            self.dapi = DaemonAPI(req.query['daemon'], context=self.__context)
+            self.dapi = AsyncDaemonAPI(req.query['daemon'], context=self.__context)
         else:
             self.dapi.disconnect()
             self.dapi.connect(req.query['daemon'])
@@ -93,12 +130,44 @@ class CruxAPIServer:
 
     # --- component methods ---
 
-    def resolve_component(self, addr, timeout=None):
-        return Component(addr, context=self.__context, timeout=timeout if timeout is not None else self.REQ_TIMEOUT)
+    async def resolve_component(self, addr, timeout=None):
+        """Get a (cached) handle to a component
+
+        :param addr: address of the component
+        :param timeout: timeout in ms for resolving the component if it isn't cached
+        :raises RequestTimeoutException: if the component doesn't answer
+        :returns: Component
+        """
+        try:
+            return await self.components.get(addr, timeout=timeout if timeout is not None else self.REQ_TIMEOUT)
+        except RequestTimeoutException:
+            self.components.invalidate(addr)
+            raise
+
+    async def sync_components(self):
+        """Drop cached handles to processes the daemon says died or restarted
+
+        :raises RequestTimeoutException: if the daemon doesn't answer
+        :returns: list of live component addresses, or None if the daemon couldn't be asked
+        """
+        status = await self.dapi.process_status()
+        if not status.success:
+            # older daemons can only list addresses
+            status = await self.dapi.process_list()
+            if not status.success:
+                return None
+
+        self.components.sync(status.payload)
+        return list(status.payload)
 
     async def get_all_components(self, req):
         """get_all_components
 
+        Every component is asked at once, and the whole listing is bounded by a single
+        deadline (LIST_DEADLINE), no matter how many components there are or how many
+        of them hang. Components which didn't answer in time are left out of
+        'components', and marked in 'status' (address -> 'ok', 'timeout' or 'error').
+
         HTTP method: GET
 
         :param req: request from webserver
@@ -108,27 +177,59 @@ class CruxAPIServer:
         if self.dapi is None:
             return self.create_error('no daemon connected')
 
-        # enumerate all component addresses
-        processes = self.dapi.process_list()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.LIST_DEADLINE / 1000
+
+        # enumerate all component addresses, dropping stale handles on the way
+        try:
+            processes = await asyncio.wait_for(self.sync_components(), self.LIST_DEADLINE / 1000)
+        except asyncio.TimeoutError:
+            processes = None
+        except RequestTimeoutException:
+            return self.create_error('request to daemon {} timed out!'.format(self.dapi.get_addr()))
 
         # fail if enumeration fails
-        if not processes.success:
+        if processes is None:
             self.log.warn('failed to get processes')
             return self.create_error('failed to get processes')
-        else:
-            processes = processes.payload
 
-        # extract cruxfile from all components
+        # the daemon keeps the cruxfiles of everything it launched, so only ask the rest
+        cruxfiles = {}
+        try:
+            reply = await asyncio.wait_for(self.dapi.process_cruxfiles(processes), max(deadline - loop.time(), 0))
+            if reply.success:
+                cruxfiles = reply.payload
+        except (asyncio.TimeoutError, RequestTimeoutException):
+            pass
+
+        # extract cruxfile from all components at once, cached handles answer immediately
+        remaining = max(deadline - loop.time(), 0)
+        tasks = {
+            address: asyncio.ensure_future(self.components.get(address, cruxfile=cruxfiles[address]))
+            if address in cruxfiles else
+            asyncio.ensure_future(self.resolve_component(address, timeout=int(remaining * 1000)))
+            for address in processes
+        }
+        if len(tasks) > 0:
+            await asyncio.wait(list(tasks.values()), timeout=remaining)
+
         out = {}
-        for address in processes:
-            try:
-                out[address] = self.resolve_component(address, timeout=self.REQ_TIMEOUT).cruxfile
-            except RequestTimeoutException as rte:
-                pass
+        status = {}
+        for address, task in tasks.items():
+            if not task.done():
+                # the resolution itself carries on (and times out) in the registry
+                task.cancel()
+                status[address] = 'timeout'
+            elif task.exception() is not None:
+                status[address] = 'timeout' if isinstance(task.exception(), RequestTimeoutException) else 'error'
+            else:
+                out[address] = task.result().cruxfile
+                status[address] = 'ok'
 
         # pass back
         return web.json_response({
             'components': out,
+            'status': status,
             'success': True
         })
 
@@ -146,7 +247,7 @@ class CruxAPIServer:
         self.log.info('getting component {}'.format(req.query['address']))
 
         try:
-            component = self.resolve_component(req.query['address']).cruxfile
+            component = (await self.resolve_component(req.query['address'])).cruxfile
         except RequestTimeoutException as rte:
             return self.create_error('Request to {} timed out!'.format(req.query['address']))
 
@@ -171,7 +272,10 @@ class CruxAPIServer:
 
         self.log.info('loading {} onto daemon'.format(req.query['path']))
 
-        resp = self.dapi.process_start(req.query['path'])
+        try:
+            resp = await self.dapi.process_start(req.query['path'])
+        except RequestTimeoutException as rte:
+            return self.create_error('request to daemon {} timed out!'.format(self.dapi.get_addr()))
 
         if not resp.success:
             return self.create_error('process loading failed: {}'.format(resp.payload))
@@ -184,6 +288,10 @@ class CruxAPIServer:
     async def send_to_component(self, req):
         """Send a query to a component
 
+        Executes take native inputs and give native outputs, a streamed result is
+        gathered into a list of its chunks. Binary, arrays and tables in the reply
+        are turned into JSON (see _jsonable).
+
         HTTP method: POST
         Query params: address
 
@@ -201,7 +309,7 @@ class CruxAPIServer:
             return self.create_error('name not in message!')
 
         try:
-            component = self.resolve_component(req.query['address'])
+            component = await self.resolve_component(req.query['address'])
         except RequestTimeoutException as rte:
             return self.create_error('request to {} timed out!'.format(req.query['address']))
 
@@ -214,15 +322,41 @@ class CruxAPIServer:
 
         # make the request
         try:
-            response = component.request(request, timeout=self.REQ_TIMEOUT)
+            if request.name == 'execute' and isinstance(request.payload, dict):
+                response = await component.execute(
+                    request.payload.get('inputs', {}),
+                    request.payload.get('parameters'),
+                    timeout=self.REQ_TIMEOUT
+                )
+            else:
+                response = await component.request(request, timeout=self.REQ_TIMEOUT)
+        except RequestTimeoutException as rte:
+            self.components.invalidate(req.query['address'])
+            return self.create_error('request to {} timed out!'.format(req.query['address']))
+        except PackingException as pe:
+            return self.create_error('request to {} failed: {}'.format(req.query['address'], pe.msg))
+        except KeyError as ke:
+            return self.create_error('request to {} failed: {}'.format(req.query['address'], ke.args[0]))
+
+        # prepare the JSON response (converting before the buffers are released)
+        try:
+            if response.success and response.name == 'stream':
+                payload = [_jsonable(chunk) async for chunk in response.payload]
+            else:
+                payload = _jsonable(response.payload)
         except RequestTimeoutException as rte:
+            self.components.invalidate(req.query['address'])
             return self.create_error('request to {} timed out!'.format(req.query['address']))
+        except StreamError as se:
+            return self.create_error('stream from {} failed: {}'.format(req.query['address'], se.msg))
+        finally:
+            # nobody downstream will release what the reply points at
+            release_exports(response)
 
-        # prepare the JSON response
         resp = {
             'name': response.name,
             'success': response.success,
-            'payload': response.payload
+            'payload': payload
         }
 
         # respond
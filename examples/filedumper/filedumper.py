@@ -10,11 +10,21 @@ import os
 import json
 from crux.client import CruxClient as Crux
 
+# bytes to write at a time when dumping binary
+CHUNK_SIZE = 16 * 1024 * 1024
+
 
 def dump_file(cfg, content):
     with open(cfg['path'], 'w') as handle:
         data = handle.write(content)
 
+def stream_file(cfg, content):
+    # write in bounded chunks, so a mapped input is only ever paged in a bit at a time
+    view = memoryview(content).cast('B')
+    with open(cfg['path'], 'wb') as handle:
+        for offset in range(0, len(view), CHUNK_SIZE):
+            handle.write(view[offset:offset + CHUNK_SIZE])
+
 if __name__ == "__main__":
     # initialize everything
     cc = Crux('crux.json')
@@ -27,8 +37,11 @@ if __name__ == "__main__":
             break
 
         try:
-            # load the file
-            output = dump_file(config, data['content'])
+            # dump the file
+            if 'bin' in data:
+                output = stream_file(config, data['bin'])
+            else:
+                output = dump_file(config, data['content'])
 
             # output that data back to the backend
             cc.output(output)
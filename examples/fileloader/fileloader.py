@@ -9,10 +9,15 @@
 import os
 import json
 from crux.client import CruxClient as Crux
+from crux.common.transport import map_file
 
 
 def load_file(cfg):
-    with open(cfg['path'], 'r') as handle:
+    # map the file rather than reading it, so it's handed on without being loaded
+    if cfg['export'] == 'mmap':
+        return {'bin': map_file(cfg['path'])}
+
+    with open(cfg['path'], 'rb' if cfg['export'] == 'binary' else 'r') as handle:
         data = handle.read()
 
     if cfg['export'] == 'json':
@@ -20,7 +25,7 @@ def load_file(cfg):
     elif cfg['export'] == 'csv':
         raise NotImplementedError()
     elif cfg['export'] == 'binary':
-        return {'binary': data}
+        return {'bin': data}
     else:
         return {'text': data}
 
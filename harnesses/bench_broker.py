@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+
+##
+# Benchmark: executes per second on one component, direct vs. brokered over its replicas
+# @author Patrick Kage
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import zmq
+from crux.backend.daemon import Daemon
+from crux.backend.daemon_api import DaemonAPI
+from crux.backend.pool import ProcessPool
+from crux.pipeline.component import Component
+
+EXECUTES = 64
+REPLICAS = min(4, os.cpu_count() or 1)
+DAEMON_ADDR = 'tcp://127.0.0.1:30120'
+
+# a cpu-bound component, answering one execute at a time
+COMPONENT = '''
+from crux.client import CruxClient
+
+def handler(inputs, parameters):
+    total = 0
+    for i in range(2000000):
+        total += i % 7
+    return {'text': str(total)}
+
+CruxClient('crux.json', logging=False).serve(handler)
+'''
+
+def make_component(directory):
+    """Write out the component, allowed to run as many replicas as we're benchmarking
+
+    :param directory: where to put it
+    """
+    with open(os.path.join(directory, 'crux.json'), 'w') as handle:
+        json.dump({
+            'name': 'bench_broker',
+            'version': '0.0.1',
+            'startup': '{} component.py'.format(sys.executable),
+            'replicas': {'min': 1, 'max': REPLICAS},
+            'inputs': 'io.json',
+            'outputs': 'io.json',
+            'parameters': 'parameters.json'
+        }, handle)
+    with open(os.path.join(directory, 'io.json'), 'w') as handle:
+        json.dump({'text': {'type': 'text'}}, handle)
+    with open(os.path.join(directory, 'parameters.json'), 'w') as handle:
+        json.dump({}, handle)
+    with open(os.path.join(directory, 'component.py'), 'w') as handle:
+        handle.write(COMPONENT)
+
+def run(component):
+    """Execute the component EXECUTES times, as many at once as the handle can
+
+    :param component: the handle
+    :returns: seconds taken
+    """
+    started = time.perf_counter()
+    replies = component.execute_many([({'text': str(i)}, None) for i in range(EXECUTES)], timeout=120000)
+    assert all(reply.success for reply in replies)
+    return time.perf_counter() - started
+
+def main():
+    context = zmq.Context()
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_component(directory)
+        print('{} executes, {} replicas'.format(EXECUTES, REPLICAS))
+
+        pool = ProcessPool(use_ipc=True)
+        try:
+            component = Component(pool.launch(directory), context=context, timeout=30000)
+            print('  direct: {:8.1f} executes/s'.format(EXECUTES / run(component)))
+            component.close()
+        finally:
+            pool.terminate_all()
+
+        daemon = Daemon(logging=False, bind_addr=DAEMON_ADDR, pub_addr='tcp://127.0.0.1:30121', context=context)
+        thread = threading.Thread(target=daemon.listen)
+        thread.start()
+        try:
+            component = Component(DAEMON_ADDR, context=context, timeout=30000, name=directory)
+            # the first run brings the replicas up
+            run(component)
+            print('brokered: {:8.1f} executes/s'.format(EXECUTES / run(component)))
+            component.close()
+        finally:
+            DaemonAPI(DAEMON_ADDR, context=context).shutdown()
+            thread.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+
+##
+# Benchmark: compression ratio vs. added CPU per I/O type and codec
+# @author Patrick Kage
+
+import os
+import time
+import random
+from crux.common import packing
+from crux.common.messaging import Message
+
+ROUNDS = 5
+
+def sample_payloads():
+    """Build a representative payload for each I/O type
+
+    :returns: dict of type to (payload, defs)
+    """
+    rows = [[str(i), '{:.6f}'.format(random.random()), random.choice(['coast', 'burn', 'idle'])] for i in range(50000)]
+    return {
+        'json': (
+            {'v': {'samples': [{'t': i, 'x': random.random(), 'mode': 'coast'} for i in range(20000)]}},
+            {'v': {'type': 'json'}}
+        ),
+        'csv': (
+            {'v': rows},
+            {'v': {'type': 'csv'}}
+        ),
+        'text': (
+            {'v': '\n'.join('step {} nominal, residual {:.4f}'.format(i, random.random()) for i in range(50000))},
+            {'v': {'type': 'text'}}
+        ),
+        'binary': (
+            {'v': os.urandom(1 << 20)},
+            {'v': {'type': 'binary'}}
+        )
+    }
+
+def wire_size(frames):
+    return sum(memoryview(f).nbytes for f in frames)
+
+def round_trip(payload, defs, codec):
+    """Time a pack/unpack round trip
+
+    :returns: (seconds per round trip, bytes on the wire)
+    """
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        frames = Message(name='return', payload=payload).pack(defs=defs, codec=codec)
+        Message().unpack(frames, defs=defs)
+    return (time.perf_counter() - start) / ROUNDS, wire_size(frames)
+
+if __name__ == "__main__":
+    print('{:8} {:6} {:>12} {:>8} {:>12}'.format('type', 'codec', 'wire bytes', 'ratio', 'added ms'))
+    for iotype, (payload, defs) in sample_payloads().items():
+        base_time, base_size = round_trip(payload, defs, None)
+        print('{:8} {:6} {:12} {:8.2f} {:12.2f}'.format(iotype, 'none', base_size, 1.0, 0.0))
+        for codec in packing.CODEC_PREFERENCE:
+            elapsed, size = round_trip(payload, defs, codec)
+            print('{:8} {:6} {:12} {:8.2f} {:12.2f}'.format(
+                iotype,
+                codec,
+                size,
+                base_size / size,
+                (elapsed - base_time) * 1000
+            ))
@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+
+##
+# Benchmark: component startup time, exec'd vs. forked off a preloaded zygote
+# @author Patrick Kage
+
+import os
+import sys
+import json
+import time
+import tempfile
+import statistics
+import importlib.util
+import zmq
+from crux.backend.pool import ProcessPool
+from crux.pipeline.component import Component
+from crux.common.messaging import Message
+
+LAUNCHES = 10
+
+# a stand-in for a simulation library that's slow to import
+HEAVY = 'numpy' if importlib.util.find_spec('numpy') is not None else 'email.mime.multipart'
+
+COMPONENT = '''
+import {heavy}
+from crux.client import CruxClient
+
+cc = CruxClient('crux.json', logging=False)
+while True:
+    data, config, done = cc.wait()
+    if done:
+        break
+    cc.output({{'text': data['text']}})
+'''
+
+def make_component(directory):
+    """Write out a trivial component importing the heavy library
+
+    :param directory: where to put it
+    """
+    with open(os.path.join(directory, 'crux.json'), 'w') as handle:
+        json.dump({
+            'name': 'bench_launch',
+            'version': '0.0.1',
+            'startup': '{} component.py'.format(sys.executable),
+            'preload': [HEAVY],
+            'inputs': 'io.json',
+            'outputs': 'io.json',
+            'parameters': 'parameters.json'
+        }, handle)
+    with open(os.path.join(directory, 'io.json'), 'w') as handle:
+        json.dump({'text': {'type': 'text'}}, handle)
+    with open(os.path.join(directory, 'parameters.json'), 'w') as handle:
+        json.dump({}, handle)
+    with open(os.path.join(directory, 'component.py'), 'w') as handle:
+        handle.write(COMPONENT.format(heavy=HEAVY))
+
+def bench(launcher, path, context):
+    """Time launches until each component answers its first request
+
+    :param launcher: ProcessPool launcher to use
+    :param path: path of the component
+    :param context: zmq context
+    :returns: list of startup times in seconds
+    """
+    pool = ProcessPool(use_ipc=True, launcher=launcher)
+    times = []
+    try:
+        if launcher == 'fork':
+            # the zygote itself is started (and preloaded) once, ahead of time
+            Component(pool.launch(path), context=context).request(Message(name='shutdown'))
+
+        for _ in range(LAUNCHES):
+            started = time.perf_counter()
+            component = Component(pool.launch(path), context=context, timeout=30000)
+            times.append(time.perf_counter() - started)
+            component.request(Message(name='shutdown'))
+            component.close()
+    finally:
+        pool.terminate_all()
+    return times
+
+def main():
+    context = zmq.Context()
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_component(directory)
+        print('startup until first reply, {} launches each (preloading {})'.format(LAUNCHES, HEAVY))
+        for launcher in ('exec', 'fork'):
+            times = bench(launcher, directory, context)
+            print('{:>5}: median {:8.1f}ms, min {:8.1f}ms, max {:8.1f}ms'.format(
+                launcher,
+                statistics.median(times) * 1000,
+                min(times) * 1000,
+                max(times) * 1000
+            ))
+
+if __name__ == '__main__':
+    main()
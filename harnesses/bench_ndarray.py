@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+
+##
+# Benchmark: ndarray I/O type vs. the JSON list path
+# @author Patrick Kage
+
+import time
+import numpy as np
+from crux.common.messaging import Message
+
+SIZE = int(1e6)
+ROUNDS = 10
+
+def bench(name, payload, defs, restore):
+    """Time a pack/unpack round trip of a payload
+
+    :param name: label to print
+    :param payload: the payload to send
+    :param defs: I/O definitions to pack/unpack with
+    :param restore: function turning the unpacked field back into an array
+    """
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        frames = Message(name='return', payload=payload).pack(defs=defs)
+        msg = Message()
+        msg.unpack(frames, defs=defs)
+        arr = restore(msg.payload['state'])
+    elapsed = (time.perf_counter() - start) / ROUNDS
+
+    size = sum(memoryview(f).nbytes for f in frames)
+    print('{:8}: {:9.2f} ms/round trip, {:11} bytes on the wire'.format(name, elapsed * 1000, size))
+    return arr
+
+if __name__ == "__main__":
+    state = np.random.random(SIZE)
+
+    json_arr = bench(
+        'json',
+        {'state': state.tolist()},
+        {'state': {'type': 'json'}},
+        np.array
+    )
+    nd_arr = bench(
+        'ndarray',
+        {'state': state},
+        {'state': {'type': 'ndarray', 'dtype': 'float64', 'shape': [None]}},
+        lambda arr: arr
+    )
+
+    assert np.array_equal(json_arr, state)
+    assert np.array_equal(nd_arr, state)
@@ -0,0 +1,39 @@
+#! /usr/bin/env python
+
+##
+# Check: ndarrays of any shape and layout survive a round trip through a message
+# @author Patrick Kage
+
+import numpy as np
+from crux.common.messaging import Message
+
+CASES = {
+    'scalar (0-d)': np.asarray(3.5),
+    'empty':        np.zeros((0, 3)),
+    'vector':       np.arange(5, dtype=np.float64),
+    'fortran':      np.asfortranarray(np.arange(6, dtype=np.float64).reshape(2, 3)),
+    'strided':      np.arange(20, dtype=np.float64).reshape(4, 5)[::2, 1::2],
+}
+
+def round_trip(arr):
+    """Pack an array into a message and unpack it again
+
+    :param arr: the array
+    :returns: (header as sent, array as received)
+    """
+    defs = {'state': {'type': 'ndarray', 'dtype': 'float64'}}
+    frames = Message(name='return', payload={'state': arr}).pack(defs=defs)
+
+    sent = Message()
+    sent.unpack(frames)
+    received = Message()
+    received.unpack(frames, defs=defs)
+    return sent.payload['state'], received.payload['state']
+
+if __name__ == '__main__':
+    for name, arr in CASES.items():
+        header, out = round_trip(arr)
+        assert header['shape'] == list(arr.shape), (name, header['shape'], arr.shape)
+        assert out.shape == arr.shape, (name, out.shape, arr.shape)
+        assert np.array_equal(out, arr), name
+        print('{:12}: shape {} ok'.format(name, list(out.shape)))
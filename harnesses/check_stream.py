@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+
+##
+# Check: streamed outputs come back from execute() as the same native values as returned ones
+# @author Patrick Kage
+
+import os
+import json
+import tempfile
+import threading
+import numpy as np
+import zmq
+from crux.client import CruxClient
+from crux.pipeline.component import Component
+from crux.common.messaging import Message
+
+ADDR = 'inproc://check_stream'
+PIECES = 3
+
+def make_component(directory):
+    """Write out a cruxfile with binary and ndarray outputs
+
+    :param directory: where to put it
+    :returns: path of the cruxfile
+    """
+    with open(os.path.join(directory, 'crux.json'), 'w') as handle:
+        json.dump({
+            'name': 'check_stream',
+            'version': '0.0.1',
+            'inputs': os.path.join(directory, 'inputs.json'),
+            'outputs': os.path.join(directory, 'outputs.json'),
+            'parameters': os.path.join(directory, 'parameters.json')
+        }, handle)
+    with open(os.path.join(directory, 'inputs.json'), 'w') as handle:
+        json.dump({'n': {'type': 'json'}}, handle)
+    with open(os.path.join(directory, 'outputs.json'), 'w') as handle:
+        json.dump({
+            'blob': {'type': 'binary'},
+            'state': {'type': 'ndarray', 'dtype': 'float64', 'shape': [None, 3]}
+        }, handle)
+    with open(os.path.join(directory, 'parameters.json'), 'w') as handle:
+        json.dump({'stream': {'type': 'bool', 'default': False}}, handle)
+    return os.path.join(directory, 'crux.json')
+
+def piece(idx):
+    """The idx-th partial output"""
+    return {'blob': bytes([idx]) * 5, 'state': np.arange(6, dtype=np.float64).reshape(2, 3) * idx}
+
+def serve(client):
+    """Answer executes until shut down, streaming when asked to
+
+    :param client: the CruxClient
+    """
+    while True:
+        inputs, parameters, done = client.wait()
+        if done:
+            break
+        if parameters['stream']:
+            client.output(piece(idx) for idx in range(PIECES))
+        else:
+            client.output(piece(inputs['n']))
+
+def same(a, b):
+    """Whether two native outputs hold the same values, and of the same types"""
+    return (
+        type(a['blob']) == type(b['blob']) and bytes(a['blob']) == bytes(b['blob']) and
+        isinstance(a['state'], np.ndarray) and isinstance(b['state'], np.ndarray) and
+        np.array_equal(a['state'], b['state']) and a['state'].dtype == b['state'].dtype
+    )
+
+if __name__ == '__main__':
+    context = zmq.Context()
+    with tempfile.TemporaryDirectory() as directory:
+        client = CruxClient(make_component(directory), bind=ADDR, context=context, logging=False)
+        thread = threading.Thread(target=serve, args=(client,))
+        thread.start()
+
+        component = Component(ADDR, context=context, timeout=5000)
+        try:
+            returned = [component.execute({'n': idx}, timeout=5000).payload for idx in range(PIECES)]
+            reply = component.execute({'n': 0}, {'stream': True}, timeout=5000)
+            assert reply.success and reply.name == 'stream'
+            streamed = list(reply.payload)
+
+            assert len(streamed) == PIECES
+            for ret, chunk in zip(returned, streamed):
+                assert same(ret, chunk), (ret, chunk)
+            print('streamed outputs match returned ones')
+        finally:
+            component.request(Message(name='shutdown'))
+            thread.join()